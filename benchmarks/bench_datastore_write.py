@@ -0,0 +1,101 @@
+'''Measure the throughput of ``DataStore.save`` for uploads of different sizes.
+
+The current write path is compared with the previous implementation, which copied
+uploads with 4KB ``read``/``write`` calls. Two kinds of source stream are used:
+
+- ``file``: a file on disk, which supports ``readinto``
+- ``wsgi``: a stream with only ``read``, like the request body of most WSGI servers
+
+Usage::
+
+    python benchmarks/bench_datastore_write.py [--sizes 1,64,512] [--repeat 3] [--dir /data]
+
+Sizes are in MB. Use ``--dir`` to benchmark the file system where MODEL_DATA_DIR lives.
+Note that the page cache makes repeated runs faster than writes to a cold disk.
+'''
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from tucluster.resources.utils import DataStore
+
+
+class LegacyDataStore(DataStore):
+    '''The write path before buffers were reused and files preallocated
+    '''
+    def _write(self, path, stream, length=None):
+        with self._fopen(path, 'wb') as fout:
+            while True:
+                chunk = stream.read(4096)
+                if not chunk:
+                    break
+                fout.write(chunk)
+
+
+class ReadOnlyStream(object):
+    '''Wrap a file so that only ``read`` is available
+    '''
+    def __init__(self, fobj):
+        self._fobj = fobj
+
+    def read(self, size=-1):
+        return self._fobj.read(size)
+
+    def close(self):
+        self._fobj.close()
+
+
+def _source(path, kind):
+    fobj = io.open(path, 'rb')
+    return fobj if kind == 'file' else ReadOnlyStream(fobj)
+
+
+def run(store, source_path, size, kind, repeat):
+    '''Return the best throughput in MB/s of ``repeat`` saves
+    '''
+    best = None
+    for index in range(repeat):
+        source = _source(source_path, kind)
+        start = time.perf_counter()
+        store.save(source, 'bench', 'file{}.bin'.format(index), length=size)
+        elapsed = time.perf_counter() - start
+        source.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return size / (1024 * 1024) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1,64,512', help='Upload sizes in MB')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dir', default=None, help='Directory to write to')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(dir=args.dir)
+    try:
+        stores = (
+            ('legacy (4KB)', LegacyDataStore(os.path.join(root, 'legacy'))),
+            ('current', DataStore(os.path.join(root, 'current'))),
+        )
+        print('{:>8} {:>6} {:>14} {:>12}'.format('size MB', 'source', 'store', 'MB/s'))
+        for size_mb in (int(size) for size in args.sizes.split(',')):
+            size = size_mb * 1024 * 1024
+            source_path = os.path.join(root, 'source.bin')
+            with open(source_path, 'wb') as fobj:
+                for _ in range(size_mb):
+                    fobj.write(os.urandom(1024 * 1024))
+
+            for kind in ('file', 'wsgi'):
+                for name, store in stores:
+                    throughput = run(store, source_path, size, kind, args.repeat)
+                    print('{:>8} {:>6} {:>14} {:>12.1f}'.format(size_mb, kind, name, throughput))
+                    shutil.rmtree(os.path.join(store._storage_path, 'bench'))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ result_backend = 'redis://redis:6379/0'
 result_persistent = True
 task_result_expires = None
 send_events = True
+task_send_sent_event = True
 task_track_started = True
 smtp_host = 'smtp.gmail.com'
 smtp_port = 587
@@ -10,4 +10,6 @@ settings['MODEL_DATA_DIR'] = os.path.join(os.path.dirname(__file__), 'data')
 settings['MONGODB'] = {
     "db": "mongoenginetest",
     "host": "mongomock://localhost"
-}
\ No newline at end of file
+}
+# Do not listen for celery task events
+settings['SYNC_TASK_STATE'] = False
@@ -4,7 +4,8 @@ import pytest
 from falcon import testing
 
 from tucluster.conf import settings
-from tucluster.app import api, db
+from tucluster.app import api
+from tucluster.fmdb import Model, ModelIndex, ModelRun, Upload, Job
 
 
 @pytest.fixture
@@ -18,5 +19,7 @@ def client():
     yield testing.TestClient(api)
     # Remove the data directory after testing
     shutil.rmtree(settings['MODEL_DATA_DIR'])
-    # Drop the test database
-    db.drop_database("mongoenginetest")
+    # Drop the test collections. Each document keeps its' collection, which
+    # (with mongomock 3.8) is not emptied by dropping the whole database
+    for document in (Model, ModelIndex, ModelRun, Upload, Job):
+        document.drop_collection()
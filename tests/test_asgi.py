@@ -0,0 +1,128 @@
+'''Tests for serving the API with an ASGI server
+'''
+import asyncio
+import json
+import os
+from tucluster.asgi import create_app
+from tucluster.app import application
+from tucluster.conf import settings
+from tucluster.fmdb import Model
+from tucluster.fmdb.serializers import id_from_path
+from .fixtures import client
+
+app = create_app(application, threads=4, spool_size=8)
+
+
+async def request(app, method, path, chunks=(), headers=(), query_string=b'',
+                  disconnect_after=None):
+    '''Make a request to an ASGI application.
+
+    Returns:
+        tuple: The status, headers and list of body chunks of the response
+    '''
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query_string,
+        'headers': [(name.encode(), value.encode()) for name, value in headers],
+    }
+    messages = [
+        {'type': 'http.request', 'body': chunk, 'more_body': index < len(chunks) - 1}
+        for index, chunk in enumerate(chunks)
+    ] or [{'type': 'http.request', 'body': b''}]
+    sent = []
+    disconnected = asyncio.Event()
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+        body = [m for m in sent if m['type'] == 'http.response.body']
+        if disconnect_after is not None and len(body) >= disconnect_after:
+            disconnected.set()
+            # Let the application notice the disconnect
+            await asyncio.sleep(0.01)
+
+    await app(scope, receive, send)
+    start = sent[0]
+    headers = {name.decode(): value.decode() for name, value in start['headers']}
+    return start['status'], headers, [m['body'] for m in sent[1:]]
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def call(method, path, **kwargs):
+    '''Make a request to the ASGI application, see ``request``
+    '''
+    return run(request(app, method, path, **kwargs))
+
+
+class TestASGI:
+
+    def test_get_models(self, client):
+        Model(name='asgi').save()
+        status, headers, body = call('GET', '/models')
+        assert status == 200
+        assert [model['name'] for model in json.loads(b''.join(body))] == ['asgi']
+
+    def test_post_chunked_body(self, client):
+        '''The request body may arrive in several messages, and is spooled to disk
+        '''
+        data = json.dumps({'name': 'chunked', 'description': 'a' * 100}).encode()
+        status, headers, _ = call(
+            'POST', '/models', chunks=[data[:10], data[10:50], data[50:]],
+            headers=[('content-type', 'application/json')]
+        )
+        assert status == 201
+        assert headers['location'] == '/models/chunked'
+        assert Model.objects.get(name='chunked').description == 'a' * 100
+        assert os.path.isdir(os.path.join(settings['MODEL_DATA_DIR'], '.spool'))
+
+    def test_stream_file(self, client):
+        '''Files are sent in blocks, and sending stops when the client disconnects
+        '''
+        path = os.path.join(settings['MODEL_DATA_DIR'], 'grid.bin')
+        data = os.urandom(600 * 1024)
+        with open(path, 'wb') as fobj:
+            fobj.write(data)
+        fid = id_from_path(path)
+
+        status, headers, body = call('GET', '/files/{}'.format(fid))
+        assert status == 200
+        assert headers['content-length'] == str(len(data))
+        assert b''.join(body) == data
+        assert len(body) > 2
+
+        status, _, body = call('GET', '/files/{}'.format(fid), disconnect_after=1)
+        assert status == 200
+        assert len(body) == 1
+
+    def test_event_subscribers_own_pool(self, client):
+        '''Waiting for task events does not hold the threads handling other requests
+        '''
+        events_app = create_app(application, threads=1, event_threads=1)
+        finished = []
+
+        async def get(path, query_string=b''):
+            status, _, _ = await request(events_app, 'GET', path, query_string=query_string)
+            finished.append((path, status))
+
+        async def both():
+            poll = asyncio.ensure_future(get('/tasks/events', b'ids=none&wait=1'))
+            await asyncio.sleep(0.1)
+            await get('/models')
+            await poll
+
+        run(both())
+        assert finished == [('/models', 200), ('/tasks/events', 200)]
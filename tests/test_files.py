@@ -1,13 +1,26 @@
 '''Tests for files API
 '''
+import gzip
+import io
 import os
 import pathlib
+import threading
+import time
+import zipfile
 import json
 import falcon
+import pytest
 from falcon import testing
+from tucluster.fmdb import serializers
 from tucluster.fmdb.serializers import directory_tree_serializer, id_from_path
 from tucluster.conf import settings
 from tucluster.resources.files import FileItem
+from tucluster.resources.cache import DirectoryCache
+from tucluster.resources.utils import DataStore
+from tucluster.resources.jobs import JobExecutor, QueueFull
+from tucluster.middleware import compression
+from tucluster.fmdb import Job
+from tucluster import app
 from .fixtures import client
 
 class TestFiles:
@@ -69,3 +82,396 @@ class TestFiles:
         fid = id_from_path(restricted_path)
         response = client.simulate_get('/files/{}'.format(fid))
         assert response.status == falcon.HTTP_BAD_REQUEST
+
+    def _write_file(self, content):
+        fpath = pathlib.Path(settings['MODEL_DATA_DIR']) / 'range.txt'
+        fpath.write_bytes(content)
+        return id_from_path(str(fpath))
+
+    def test_get_file_range(self, client):
+        '''Test we can download part of a file
+        '''
+        fid = self._write_file(b'0123456789')
+        response = client.simulate_get(
+            '/files/{}'.format(fid),
+            headers={'Range': 'bytes=2-5'}
+        )
+        assert response.status == falcon.HTTP_PARTIAL_CONTENT
+        assert response.content == b'2345'
+        assert response.headers['Content-Range'] == 'bytes 2-5/10'
+
+        # Suffix ranges return the end of the file
+        response = client.simulate_get(
+            '/files/{}'.format(fid),
+            headers={'Range': 'bytes=-3'}
+        )
+        assert response.content == b'789'
+
+    def test_get_file_multiple_ranges(self, client):
+        '''Test several ranges are returned as a multipart body
+        '''
+        fid = self._write_file(b'0123456789')
+        response = client.simulate_get(
+            '/files/{}'.format(fid),
+            headers={'Range': 'bytes=0-1,8-'}
+        )
+        assert response.status == falcon.HTTP_PARTIAL_CONTENT
+        assert response.headers['Content-Type'].startswith('multipart/byteranges')
+        assert int(response.headers['Content-Length']) == len(response.content)
+        assert b'Content-Range: bytes 0-1/10\r\n\r\n01\r\n' in response.content
+        assert b'Content-Range: bytes 8-9/10\r\n\r\n89\r\n' in response.content
+
+    def test_get_file_bad_range(self, client):
+        '''Test a range outside the file is not satisfiable
+        '''
+        fid = self._write_file(b'0123456789')
+        response = client.simulate_get(
+            '/files/{}'.format(fid),
+            headers={'Range': 'bytes=20-30'}
+        )
+        assert response.status == falcon.HTTP_REQUESTED_RANGE_NOT_SATISFIABLE
+
+    def test_get_file_not_modified(self, client):
+        '''Test repeat downloads of an unchanged file return 304
+        '''
+        fid = self._write_file(b'0123456789')
+        response = client.simulate_get('/files/{}'.format(fid))
+        assert response.status == falcon.HTTP_OK
+
+        etag = response.headers['ETag']
+        response = client.simulate_get(
+            '/files/{}'.format(fid),
+            headers={'If-None-Match': etag}
+        )
+        assert response.status == falcon.HTTP_NOT_MODIFIED
+
+        response = client.simulate_get(
+            '/files/{}'.format(fid),
+            headers={'If-Modified-Since': response.headers['Last-Modified']}
+        )
+        assert response.status == falcon.HTTP_NOT_MODIFIED
+
+    def test_get_file_range_sendfile(self, client):
+        '''Test range responses expose the file descriptor in sendfile mode
+        '''
+        fid = self._write_file(b'0123456789')
+        settings['FILE_SERVING'] = 'sendfile'
+        try:
+            response = client.simulate_get(
+                '/files/{}'.format(fid),
+                headers={'Range': 'bytes=4-'}
+            )
+        finally:
+            settings['FILE_SERVING'] = 'stream'
+        assert response.status == falcon.HTTP_PARTIAL_CONTENT
+        assert response.content == b'456789'
+
+    def test_get_file_accel_redirect(self, client):
+        '''Test file downloads can be offloaded to nginx
+        '''
+        fid = self._write_file(b'0123456789')
+        settings['FILE_SERVING'] = 'x-accel-redirect'
+        try:
+            response = client.simulate_get('/files/{}'.format(fid))
+        finally:
+            settings['FILE_SERVING'] = 'stream'
+        assert response.status == falcon.HTTP_OK
+        assert response.headers['X-Accel-Redirect'] == '/protected/range.txt'
+        assert response.content == b''
+
+    def test_get_folder_tree_depth(self, client):
+        '''Test we can list a folder one level at a time
+        '''
+        path = os.path.join(settings['MODEL_DATA_DIR'], 'model')
+        self._touch_files(path)
+        response = client.simulate_get(
+            '/files/tree/{}'.format(id_from_path(path)),
+            query_string='depth=1'
+        )
+        assert response.status == falcon.HTTP_OK
+        children = response.json['children']
+        assert [child['name'] for child in children] == ['file.txt', 'file2.txt', 'subdir']
+        assert 'children' not in children[2]
+        assert children[0]['size'] == 0
+        assert 'mtime' in children[0]
+
+    def test_get_folder_tree_pagination(self, client):
+        '''Test we can paginate and filter the contents of a folder
+        '''
+        path = os.path.join(settings['MODEL_DATA_DIR'], 'model')
+        self._touch_files(path)
+        response = client.simulate_get(
+            '/files/tree/{}'.format(id_from_path(path)),
+            query_string='offset=1&limit=1'
+        )
+        assert response.json['total'] == 3
+        assert [child['name'] for child in response.json['children']] == ['file2.txt']
+
+        response = client.simulate_get(
+            '/files/tree/{}'.format(id_from_path(path)),
+            query_string='glob=file1*'
+        )
+        children = response.json['children']
+        assert [child['name'] for child in children] == ['subdir']
+        assert [child['name'] for child in children[0]['children']] == ['file1.txt']
+
+    def test_get_folder_tree_not_modified(self, client):
+        '''Test repeat requests for an unchanged tree return 304
+        '''
+        path = os.path.join(settings['MODEL_DATA_DIR'], 'model')
+        self._touch_files(path)
+        fid = id_from_path(path)
+        response = client.simulate_get('/files/tree/{}'.format(fid))
+        etag = response.headers['ETag']
+        response = client.simulate_get(
+            '/files/tree/{}'.format(fid),
+            headers={'If-None-Match': etag}
+        )
+        assert response.status == falcon.HTTP_NOT_MODIFIED
+
+        # Adding a file changes the tree
+        (pathlib.Path(path) / 'subdir' / 'new.txt').touch()
+        response = client.simulate_get(
+            '/files/tree/{}'.format(fid),
+            headers={'If-None-Match': etag}
+        )
+        assert response.status == falcon.HTTP_OK
+        assert response.headers['ETag'] != etag
+
+
+    def test_get_folder_zip(self, client):
+        '''Test we can download a folder as a zip archive
+        '''
+        dirpth = self._touch_files(os.path.join(settings['MODEL_DATA_DIR'], 'results'))
+        (dirpth / 'subdir' / 'depth.flt').write_bytes(b'1.0 ' * 10000)
+        # Times before 1980 can't be stored in a zip file
+        os.utime(str(dirpth / 'file.txt'), (0, 0))
+        fid = id_from_path(str(dirpth))
+
+        response = client.simulate_get('/files/zip/{}'.format(fid))
+        assert response.status == falcon.HTTP_OK
+        assert response.headers['content-type'] == 'application/zip'
+        with zipfile.ZipFile(io.BytesIO(response.content)) as zfile:
+            assert zfile.namelist() == [
+                'file.txt', 'file2.txt', 'subdir/depth.flt', 'subdir/file1.txt'
+            ]
+            assert zfile.read('subdir/depth.flt') == b'1.0 ' * 10000
+            assert zfile.getinfo('file.txt').date_time == (1980, 1, 1, 0, 0, 0)
+
+        response = client.simulate_get(
+            '/files/zip/{}'.format(fid),
+            query_string='glob=*.flt&compression=deflate'
+        )
+        with zipfile.ZipFile(io.BytesIO(response.content)) as zfile:
+            info, = zfile.infolist()
+            assert info.compress_type == zipfile.ZIP_DEFLATED
+            assert info.compress_size < info.file_size
+            assert zfile.testzip() is None
+
+    def test_get_file_compressed(self, client):
+        '''Text files are compressed for clients which accept it, and the
+        compressed file is cached
+        '''
+        content = b'0.000 1.250 2.500\n' * 10000
+        fpath = pathlib.Path(settings['MODEL_DATA_DIR']) / 'depth.asc'
+        fpath.write_bytes(content)
+        fid = id_from_path(str(fpath))
+
+        response = client.simulate_get('/files/{}'.format(fid))
+        assert 'content-encoding' not in response.headers
+        assert response.content == content
+
+        headers = {'Accept-Encoding': 'gzip;q=1.0, identity;q=0.5'}
+        response = client.simulate_get('/files/{}'.format(fid), headers=headers)
+        assert response.status == falcon.HTTP_OK
+        assert response.headers['content-encoding'] == 'gzip'
+        assert response.headers['vary'] == 'Accept-Encoding'
+        assert gzip.decompress(response.content) == content
+        assert len(response.content) < len(content) / 5
+        etag = response.headers['etag']
+        assert etag.endswith('-gzip"')
+
+        cached = os.listdir(os.path.join(settings['MODEL_DATA_DIR'], '.compressed'))
+        assert len(cached) == 1
+        response = client.simulate_get('/files/{}'.format(fid), headers=headers)
+        assert gzip.decompress(response.content) == content
+        assert response.headers['content-length'] == str(len(response.content))
+
+        headers['If-None-Match'] = etag
+        response = client.simulate_get('/files/{}'.format(fid), headers=headers)
+        assert response.status == falcon.HTTP_NOT_MODIFIED
+
+        # Ranges of the file are not compressed
+        response = client.simulate_get(
+            '/files/{}'.format(fid),
+            headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=0-9'}
+        )
+        assert response.status == falcon.HTTP_PARTIAL_CONTENT
+        assert response.content == content[:10]
+
+        # An interrupted download of the compressed file is resumed
+        response = client.simulate_get('/files/{}'.format(fid), headers={'Accept-Encoding': 'gzip'})
+        full = response.content
+        response = client.simulate_get(
+            '/files/{}'.format(fid),
+            headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=100-', 'If-Range': etag}
+        )
+        assert response.status == falcon.HTTP_PARTIAL_CONTENT
+        assert response.headers['content-encoding'] == 'gzip'
+        assert response.headers['content-range'] == 'bytes 100-{0}/{1}'.format(
+            len(full) - 1, len(full))
+        assert response.content == full[100:]
+
+    def test_get_large_file_uncompressed(self):
+        '''Files larger than the limit are sent as they are, so they can be resumed
+        '''
+        class Resource(object):
+            def on_get(self, req, resp):
+                resp.content_type = 'text/plain'
+                resp.etag = '"abc"'
+                resp.context['compression_cache_key'] = 'large.asc'
+                resp.set_stream(io.BytesIO(content), len(content))
+
+        content = b'0.000 1.250 2.500\n' * 10000
+        api = falcon.API(middleware=[
+            compression.CompressionMiddleware(max_file_size=len(content) - 1)
+        ])
+        api.add_route('/large', Resource())
+        response = testing.TestClient(api).simulate_get(
+            '/large', headers={'Accept-Encoding': 'gzip'})
+        assert 'content-encoding' not in response.headers
+        assert response.headers['etag'] == '"abc"'
+        assert response.content == content
+
+    def test_fail_folder_zip(self, client):
+        fid = id_from_path(os.path.dirname(__file__))
+        response = client.simulate_get('/files/zip/{}'.format(fid))
+        assert response.status == falcon.HTTP_BAD_REQUEST
+
+
+    def test_get_folder_tree_deferred(self, client, monkeypatch):
+        '''A slow tree walk continues as a job, and the request gets a 202 response
+        '''
+        release = threading.Event()
+        walk = serializers.directory_tree_serializer
+
+        def slow_walk(*args, **kwargs):
+            release.wait(5)
+            return walk(*args, **kwargs)
+
+        monkeypatch.setattr(serializers, 'directory_tree_serializer', slow_walk)
+        monkeypatch.setattr(app.executor, '_wait', 0.01)
+        fid = id_from_path(settings['MODEL_DATA_DIR'])
+        response = client.simulate_get('/files/tree/{}'.format(fid), query_string='depth=1')
+        assert response.status == falcon.HTTP_ACCEPTED
+        location = response.headers['location']
+        assert location == '/jobs/{}'.format(response.json['_id']['$oid'])
+
+        release.set()
+        for _ in range(100):
+            job = client.simulate_get(location).json
+            if job['state'] == 'complete':
+                break
+            time.sleep(0.01)
+        assert job['result'] == {'location': '/files/tree/{}?depth=1'.format(fid)}
+        assert client.simulate_get('/jobs').json['operations']['tree']['deferred'] == 1
+
+    def test_executor_back_pressure(self):
+        '''Operations are rejected once the queue is full
+        '''
+        executor = JobExecutor(Job, workers=1, max_queue=1)
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+
+        running = executor.submit('slow', slow)
+        started.wait(5)
+        queued = executor.submit('slow', lambda: None)
+        try:
+            with pytest.raises(QueueFull):
+                executor.submit('slow', lambda: None)
+        finally:
+            release.set()
+        running.result()
+        queued.result()
+        metrics = executor.metrics()['slow']
+        assert (metrics['completed'], metrics['rejected'], metrics['queued']) == (2, 1, 0)
+
+
+class TestDirectoryCache:
+    def test_scan_cached(self, tmpdir):
+        '''Test listings are reused until the folder changes
+        '''
+        folder = tmpdir.mkdir('results')
+        folder.join('a.txt').write('a')
+        # Backdate the folder so the listing is cached
+        os.utime(str(folder), (1, 1))
+        cache = DirectoryCache(size=2)
+        assert cache.scan(str(folder)) == serializers.scan_directory(str(folder))
+
+        # An unchanged folder is served from the cache
+        folder.join('b.txt').write('b')
+        os.utime(str(folder), (1, 1))
+        assert [entry[0] for entry in cache.scan(str(folder))] == ['a.txt']
+
+        # A change of mtime causes the folder to be listed again
+        os.utime(str(folder), (2, 2))
+        assert [entry[0] for entry in cache.scan(str(folder))] == ['a.txt', 'b.txt']
+
+
+class TestDataStore:
+    def test_content_addressed_save(self, tmpdir):
+        '''Identical files are stored once and linked into each folder
+        '''
+        store = DataStore(str(tmpdir), content_addressed=True)
+        _, fid1 = store.save(io.BytesIO(b'terrain'), 'model1', 'dem.asc')
+        _, fid2 = store.save(io.BytesIO(b'terrain'), 'model2', 'dem.asc')
+        _, fid3 = store.save(io.BytesIO(b'boundary'), 'model2', 'bc.csv')
+        stat1, stat2 = store.stat(fid1), store.stat(fid2)
+        assert stat1.st_ino == stat2.st_ino
+        assert store.stat(fid3).st_ino != stat1.st_ino
+        assert store.verify() == []
+
+        # Replacing a linked file does not change the other models
+        store.save(io.BytesIO(b'new terrain'), 'model2', 'dem.asc')
+        with store.open(fid1)[0] as fobj:
+            assert fobj.read() == b'terrain'
+
+        # The old grid is no longer used by any model once model1 is removed
+        store.remove(id_from_path(str(tmpdir.join('model1'))))
+        assert store.collect_garbage() == len(b'terrain')
+        assert store.verify() == []
+
+    def test_verify_content_addressed(self, tmpdir):
+        store = DataStore(str(tmpdir), content_addressed=True)
+        _, fid = store.save(io.BytesIO(b'terrain'), 'model1', 'dem.asc')
+        path = store.validate_fid(fid)
+        os.chmod(path, 0o644)
+        with open(path, 'wb') as fobj:
+            fobj.write(b'corrupt')
+        assert len(store.verify()) == 1
+
+    def test_remove_in_background(self, tmpdir):
+        '''Folders are moved out of the way and deleted by the executor
+        '''
+        executor = JobExecutor(Job, workers=1)
+        store = DataStore(str(tmpdir), executor=executor)
+        _, fid = store.save(io.BytesIO(b'data'), 'model1', 'dem.asc')
+        store.remove(id_from_path(str(tmpdir.join('model1'))))
+        assert not tmpdir.join('model1').exists()
+        executor._pool.shutdown(wait=True)
+        assert tmpdir.join('.trash').listdir() == []
+
+    def test_save_preallocated(self, tmpdir):
+        '''Files are allocated from the given length, and truncated if less data is sent
+        '''
+        store = DataStore(str(tmpdir), chunk_size=256 * 1024)
+        data = os.urandom(3 * 1024 * 1024 + 100)
+        _, fid = store.save(io.BytesIO(data), 'model1', 'dem.asc', length=len(data))
+        with store.open(fid)[0] as fobj:
+            assert fobj.read() == data
+
+        _, fid = store.save(io.BytesIO(data), 'model1', 'short.asc', length=len(data) + 4096)
+        assert store.stat(fid).st_size == len(data)
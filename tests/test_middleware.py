@@ -0,0 +1,144 @@
+'''Tests for middleware
+'''
+import json
+import pstats
+import sys
+import time
+import falcon
+import pytest
+from falcon import testing
+from tucluster import conf
+from tucluster.conf import settings
+from tucluster.fmdb.serializers import id_from_path
+from tucluster.resources.files import FileItem
+from tucluster.resources.utils import DataStore
+from tucluster.middleware.profiling import ProfilingMiddleware
+
+
+class TestMiddleware:
+    def test_partial_config(self, tmpdir, monkeypatch):
+        '''A block of the configuration file only needs the values it changes
+        '''
+        config_file = tmpdir.join('config.json')
+        config_file.write(json.dumps({'COMPRESSION': {'enabled': True, 'min_size': 512}}))
+        monkeypatch.setenv('TUCLUSTER_CONFIG', str(config_file))
+        config = getattr(conf, '__get_config')()
+        assert config['COMPRESSION']['min_size'] == 512
+        assert config['COMPRESSION']['cache_size'] == settings['COMPRESSION']['cache_size']
+        assert config['ASGI'] == settings['ASGI']
+        assert settings['COMPRESSION']['min_size'] != 512
+
+    def test_request_metrics(self, tmpdir):
+        '''Requests and streamed bytes are counted per route
+        '''
+        prometheus_client = pytest.importorskip('prometheus_client')
+        from tucluster.middleware.metrics import (
+            Metrics, MetricsMiddleware, MetricsResource, MongoCommandListener, current_route
+        )
+
+        class Chunks(object):
+            def on_get(self, req, resp):
+                resp.stream = iter([b'abc', b'defg'])
+
+        class Event(object):
+            command_name = 'getMore'
+            duration_micros = 1000
+
+        class Runs(object):
+            # A list read from the database in batches as it is sent
+            def on_get(self, req, resp):
+                def documents():
+                    yield b'['
+                    listener.succeeded(Event())
+                    yield b']'
+                resp.stream = documents()
+
+        registry = prometheus_client.CollectorRegistry()
+        metrics = Metrics(registry)
+        listener = MongoCommandListener(metrics)
+        middleware = MetricsMiddleware(metrics)
+        api = falcon.API(middleware=[middleware])
+        api.add_route('/files/{fid}', FileItem(DataStore(str(tmpdir))))
+        api.add_route('/chunks', Chunks())
+        api.add_route('/runs', Runs())
+        api.add_route('/metrics', MetricsResource(registry))
+
+        tmpdir.join('a.txt').write('x' * 100)
+        client = testing.TestClient(api)
+        fid = id_from_path(str(tmpdir.join('a.txt')))
+        assert client.simulate_get('/files/{}'.format(fid)).content == b'x' * 100
+        assert client.simulate_get('/chunks').content == b'abcdefg'
+        client.simulate_get('/files/{}'.format(fid), headers={'Range': 'bytes=200-300'})
+        assert client.simulate_get('/runs').content == b'[]'
+        assert current_route() == 'none'
+
+        def sample(name, **labels):
+            return registry.get_sample_value(name, labels)
+
+        assert sample('tucluster_streamed_bytes_total', route='/files/{fid}') == 100
+        assert sample('tucluster_streamed_bytes_total', route='/chunks') == 7
+        assert sample('tucluster_mongo_command_duration_seconds_count',
+                      route='/runs', command='getMore') == 1
+        assert sample('tucluster_mongo_command_duration_seconds_count',
+                      route='none', command='getMore') is None
+        assert sample('tucluster_requests_total',
+                      method='GET', route='/files/{fid}', status='200') == 1
+        assert sample('tucluster_requests_total',
+                      method='GET', route='/files/{fid}', status='416') == 1
+        assert sample('tucluster_request_duration_seconds_count',
+                      method='GET', route='/chunks') == 1
+        response = client.simulate_get('/metrics')
+        assert response.headers['Content-Type'] == prometheus_client.CONTENT_TYPE_LATEST
+        assert 'tucluster_requests_total{method="GET",route="/chunks",status="200"} 1.0' in \
+            response.text
+
+    def test_profile_requests(self, tmpdir):
+        '''Requests which ask to be profiled, or are sampled and slow, are saved
+        '''
+        profiles = tmpdir.join('profiles')
+        api = falcon.API(middleware=[ProfilingMiddleware(str(profiles), threshold=60, keep=2)])
+        api.add_route('/files/{fid}', FileItem(DataStore(str(tmpdir))))
+        client = testing.TestClient(api)
+        tmpdir.join('a.txt').write('abc')
+        url = '/files/{}'.format(id_from_path(str(tmpdir.join('a.txt'))))
+
+        response = client.simulate_get(url)
+        assert 'X-Profile' not in response.headers
+        assert profiles.listdir() == []
+
+        response = client.simulate_get(url, headers={'X-Profile': '1'})
+        name = response.headers['X-Profile']
+        summary = json.loads(profiles.join(name + '.json').read())
+        assert summary['route'] == '/files/{fid}'
+        assert summary['status'] == falcon.HTTP_OK
+        # Audit events, or the calls to filesystem builtins before python 3.8
+        assert summary['filesystem']['open' if hasattr(sys, 'addaudithook') else 'io.open'] >= 1
+        assert profiles.join(name + '.prof').size() > 0
+
+        # Streamed bodies are profiled as they are sent
+        class Slow(object):
+            def on_get(self, req, resp):
+                def chunks():
+                    yield b'a'
+                    time.sleep(0.05)
+                    yield b'b'
+                resp.stream = chunks()
+
+        api.add_route('/slow', Slow())
+        response = client.simulate_get('/slow', headers={'X-Profile': '1'})
+        assert response.content == b'ab'
+        name = response.headers['X-Profile']
+        assert json.loads(profiles.join(name + '.json').read())['seconds'] >= 0.05
+        stats = pstats.Stats(str(profiles.join(name + '.prof')))
+        assert any(function == 'chunks' for _, _, function in stats.stats)
+
+        # Sampled requests over the threshold are saved, keeping the most recent
+        sampled = ProfilingMiddleware(str(profiles), header=None, sample_rate=1, threshold=0,
+                                      keep=2)
+        api = falcon.API(middleware=[sampled])
+        api.add_route('/files/{fid}', FileItem(DataStore(str(tmpdir))))
+        client = testing.TestClient(api)
+        for _ in range(3):
+            assert 'X-Profile' not in client.simulate_get(url).headers
+        assert len(profiles.listdir()) == 4
+        assert not profiles.join(name + '.json').exists()
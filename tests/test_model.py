@@ -1,13 +1,28 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import base64
+import datetime
+import hashlib
+import io
 import os
+import time
 import uuid
 import zipfile
 import json
 import falcon
+import pytest
 from falcon import testing
-from tucluster.fmdb import Model, ModelRun
+from tucluster import app
+from tucluster.fmdb import (
+    Model, ModelIndex, ModelRun, Upload, path_from_id, id_from_path, indexing, control
+)
+from tucluster.fmdb.indexing import scan_entry_points
 from tucluster.conf import settings
+from tucluster.resources import tasks
+from tucluster.resources.tasks import TaskStateCache
+from tucluster.resources.uploads import expire_uploads
+from tucluster.resources.utils import DataStore
+from tucluster.app import task_events
 from .fixtures import client
 
 def create_zip():
@@ -22,6 +37,17 @@ def create_zip():
     os.remove(fname)
     return path
 
+def wait_for_job(client, response, timeout=5):
+    '''Poll the job given in the location of a response until it finishes
+    '''
+    assert response.status == falcon.HTTP_ACCEPTED
+    deadline = time.time() + timeout
+    while True:
+        job = client.simulate_get(response.headers['location']).json
+        if job['state'] in ('complete', 'failed') or time.time() > deadline:
+            return job
+        time.sleep(0.01)
+
 class TestModel:
 
     def _create_model(self):
@@ -69,9 +95,62 @@ class TestModel:
             body=fake_zip_bytes,
             headers={'content-type': 'application/zip'}
         )
-        assert response.status == falcon.HTTP_CREATED
-        assert 'Location' in response.headers
-        assert '_id' in response.json
+        assert response.status == falcon.HTTP_ACCEPTED
+        assert response.headers['location'].startswith('/jobs/')
+        job = wait_for_job(client, response)
+        assert job['state'] == 'complete'
+        assert job['progress']['files'] == 1
+        assert job['progress']['bytes'] == job['progress']['length'] == len(fake_zip_bytes)
+
+        response = client.simulate_get(job['result']['location'])
+        assert response.status == falcon.HTTP_OK
+        assert response.json['entry_points'] == ['test.tcf']
+
+    def test_posted_model_is_extracted(self, client):
+        '''An archive written to a stream (deflated, with data descriptors)
+        is extracted after it is uploaded. Unsafe paths are skipped.
+        '''
+        class Unseekable(io.RawIOBase):
+            def __init__(self):
+                self.data = bytearray()
+            def writable(self):
+                return True
+            def write(self, data):
+                self.data += data
+                return len(data)
+
+        output = Unseekable()
+        with zipfile.ZipFile(output, mode='w', compression=zipfile.ZIP_DEFLATED) as zfile:
+            zfile.writestr('runs/test.tcf', 'RANDOM STATEMENT == RANDOM' * 100)
+            zfile.writestr('../outside.txt', 'escaped')
+        response = client.simulate_post(
+            '/models',
+            body=bytes(output.data),
+            headers={'content-type': 'application/zip'}
+        )
+        job = wait_for_job(client, response)
+        folder = path_from_id(client.simulate_get(job['result']['location']).json['folder'])
+        with open(os.path.join(folder, 'runs', 'test.tcf')) as fobj:
+            assert fobj.read() == 'RANDOM STATEMENT == RANDOM' * 100
+        assert not os.path.exists(os.path.join(folder, '..', 'outside.txt'))
+
+    def test_post_corrupt_zip(self, client):
+        '''A corrupt archive fails the job which extracts it
+        '''
+        path = create_zip()
+        with open(path, 'rb') as zfile:
+            data = bytearray(zfile.read())
+        # Corrupt the stored data of the first entry
+        data[40] ^= 0xFF
+        response = client.simulate_post(
+            '/models',
+            body=bytes(data),
+            headers={'content-type': 'application/zip'}
+        )
+        job = wait_for_job(client, response)
+        assert job['state'] == 'failed'
+        assert job['error']
+        assert Model.objects.count() == 0
 
     def test_create_empty_model(self, client):
         '''The API can create a ``Model`` without any data
@@ -146,6 +225,150 @@ class TestModel:
         )
         assert response.status == falcon.HTTP_ACCEPTED
 
+    def test_entry_points_indexed(self, client):
+        '''Entry points are found in sub folders, and only rescanned when files are added
+        '''
+        folder = os.path.join(settings['MODEL_DATA_DIR'], 'indexed')
+        os.makedirs(os.path.join(folder, 'runs'))
+        for name in ('runs/base.tcf', 'runs/notes.txt', 'setup.py'):
+            with open(os.path.join(folder, name), 'w') as fobj:
+                fobj.write('data')
+        model = Model(name=str(uuid.uuid4()), folder=id_from_path(folder)).save()
+        assert model.entry_points == ['runs/base.tcf', 'setup.py']
+
+        # Metadata updates do not look at the folder
+        os.remove(os.path.join(folder, 'setup.py'))
+        response = client.simulate_patch(
+            '/models/{}'.format(model.name),
+            body=json.dumps({'description': 'new description'}),
+            headers={'content-type': 'application/json'}
+        )
+        assert response.status == falcon.HTTP_NO_CONTENT
+        model.reload()
+        assert model.entry_points == ['runs/base.tcf', 'setup.py']
+
+        response = client.simulate_patch(
+            '/models/{}'.format(model.name),
+            body=b'data',
+            headers={
+                'content-disposition': 'attachment; filename="option.tcf"',
+                'content-type': 'application/octet-stream'
+            }
+        )
+        assert response.status == falcon.HTTP_ACCEPTED
+        model.reload()
+        assert model.entry_points == ['option.tcf', 'runs/base.tcf']
+
+    def test_dependencies_indexed(self, client, monkeypatch):
+        '''Control files are parsed into the inputs of each entry point, with the model area
+        '''
+        folder = os.path.join(settings['MODEL_DATA_DIR'], 'dependencies')
+        os.makedirs(os.path.join(folder, 'runs'))
+        os.makedirs(os.path.join(folder, 'model', 'gis'))
+        files = {
+            'runs/base.tcf': (
+                'Geometry Control File == ..\\model\\Geo.tgc  ! the geometry\n'
+                'Output Folder == ..\\results\n'
+            ),
+            'model/geo.tgc': (
+                'Read GIS Location == gis\\2d_loc.mif\n'
+                'Grid Size (X,Y) == 0.2, 0.1\n'
+                'Read GIS Code == gis\\2d_code.shp\n'
+            ),
+            'model/gis/2d_loc.mif': (
+                'Version 300\nCoordSys Earth Projection 1, 104\nData\n\nLine 1.0 50.0 2.0 50.0\n'
+            ),
+            'model/gis/2d_loc.mid': '',
+        }
+        for name, content in files.items():
+            with open(os.path.join(folder, name), 'w') as fobj:
+                fobj.write(content)
+        model = Model(name=str(uuid.uuid4()), folder=id_from_path(folder)).save()
+
+        response = client.simulate_get('/models/{}/dependencies'.format(model.name))
+        assert response.status == falcon.HTTP_OK
+        summary, = response.json['entryPoints']
+        assert summary['path'] == 'runs/base.tcf'
+        assert summary['inputs'] == [
+            'model/geo.tgc', 'model/gis/2d_code.dbf', 'model/gis/2d_code.shp',
+            'model/gis/2d_code.shx', 'model/gis/2d_loc.mid', 'model/gis/2d_loc.mif'
+        ]
+        assert summary['missing'] == [
+            'model/gis/2d_code.dbf', 'model/gis/2d_code.shp', 'model/gis/2d_code.shx'
+        ]
+        ring = summary['area']['coordinates'][0]
+        expected = [[1.0, 50.0], [1.2, 50.0], [1.2, 50.1], [1.0, 50.1], [1.0, 50.0]]
+        assert [[round(x, 6), round(y, 6)] for x, y in ring] == expected
+
+        run = ModelRun(entry_point='runs/base.tcf', engine='tuflow', model=model).save()
+        response = client.simulate_get(
+            '/models/{}/dependencies'.format(model.name),
+            params={'file': 'model/gis/2d_loc.mif'}
+        )
+        assert response.json['entryPoints'] == ['runs/base.tcf']
+        assert response.json['runs'] == [str(run.id)]
+
+        # Unchanged control files are not parsed again
+        def fail(text):
+            raise AssertionError('parsed unchanged file')
+        monkeypatch.setattr(control, 'parse_control_file', fail)
+        model.index_entry_points()
+        assert model.dependencies['entry_points'][0]['missing']
+
+        # The index is kept apart from the model, and removed with it
+        raw = Model.objects(name=model.name).as_pymongo().first()
+        assert 'dependencies' not in raw and 'folder_index' not in raw
+        model.delete()
+        assert ModelIndex.objects(model=model.id).count() == 0
+
+    def test_scan_entry_points_incremental(self, tmpdir):
+        '''Unchanged folders are not listed again
+        '''
+        tmpdir.mkdir('runs').join('a.tcf').write('data')
+        scan = scan_entry_points(str(tmpdir))
+        assert scan.entry_points == scan.changed == ['runs/a.tcf']
+
+        # Backdate the folders so they are outside the racy interval
+        for path in (str(tmpdir), str(tmpdir.join('runs'))):
+            os.utime(path, (1, 1))
+        scan = scan_entry_points(str(tmpdir))
+        listed = []
+        original = indexing._list_folder
+        indexing._list_folder = lambda *args: listed.append(args[0]) or original(*args)
+        try:
+            tmpdir.join('runs', 'a.tcf').write('changed data')
+            rescan = scan_entry_points(str(tmpdir), scan.index)
+        finally:
+            indexing._list_folder = original
+        assert listed == []
+        assert rescan.entry_points == rescan.changed == ['runs/a.tcf']
+
+    def test_paginate_models(self, client):
+        '''The API can list ``Model`` documents a page at a time
+        '''
+        names = [self._create_model().name for _ in range(5)]
+        seen = []
+        url = '/models'
+        query_string = 'sort=date_created&limit=2&fields=name'
+        while True:
+            response = client.simulate_get(url, query_string=query_string)
+            assert response.status == falcon.HTTP_OK
+            page = response.json
+            assert len(page) <= 2
+            assert all(set(doc) == {'_id', 'name'} for doc in page)
+            seen.extend(doc['name'] for doc in page)
+            link = response.headers.get('Link')
+            if not link:
+                break
+            url, query_string = link[1:link.index('>')].split('?')
+        assert seen == names
+
+    def test_bad_sort_models(self, client):
+        '''The API rejects sorting by unindexed fields
+        '''
+        response = client.simulate_get('/models', query_string='sort=email')
+        assert response.status == falcon.HTTP_BAD_REQUEST
+
 
 class TestMonitoring:
     '''Test we can monitor tasks as they are running
@@ -160,3 +383,213 @@ class TestMonitoring:
 
         response = client.simulate_get('/tasks/{}'.format(str(run.task_id)))
         assert response.status == falcon.HTTP_OK
+
+    def test_get_many_task_status(self, client):
+        '''Test we can get the status of several tasks in one request
+        '''
+        response = client.simulate_get('/tasks', query_string='ids=task1,task2')
+        assert response.status == falcon.HTTP_OK
+        assert set(response.json) == {'task1', 'task2'}
+        assert response.json['task1']['state'] == 'PENDING'
+
+        response = client.simulate_post('/tasks', body=json.dumps({'ids': ['task3']}))
+        assert response.status == falcon.HTTP_OK
+        assert set(response.json) == {'task3'}
+
+    def test_lookup_tasks_backends(self, monkeypatch):
+        '''Test results are fetched from backends whose ``mget`` returns a list, a dict
+        or is not implemented
+        '''
+        stored = {b'celery-task-meta-task1': {'status': 'SUCCESS', 'result': 'fid'}}
+
+        class Backend(object):
+            def get_key_for_task(self, task_id):
+                return 'celery-task-meta-{}'.format(task_id).encode('utf-8')
+
+            def decode_result(self, value):
+                return value
+
+        class ListBackend(Backend):
+            def mget(self, keys):
+                return [stored.get(key) for key in keys]
+
+        class DictBackend(Backend):
+            def mget(self, keys):
+                return {key.decode('utf-8'): stored[key] for key in keys if key in stored}
+
+        class UnimplementedBackend(Backend):
+            def mget(self, keys):
+                raise NotImplementedError
+
+        for backend in (ListBackend(), DictBackend()):
+            monkeypatch.setattr(tasks.app, 'backend', backend)
+            cache = TaskStateCache()
+            assert tasks.lookup_tasks(['task1', 'task2'], cache) == {
+                'task1': ('SUCCESS', 'fid'),
+                'task2': ('PENDING', None)
+            }
+            assert cache.get('task2') == ('PENDING', None)
+
+        # Without a working ``mget`` each task is fetched with an ``AsyncResult``
+        class Result(object):
+            def __init__(self, task_id):
+                meta = stored.get('celery-task-meta-{}'.format(task_id).encode('utf-8'), {})
+                self.state = meta.get('status', 'PENDING')
+                self.result = meta.get('result')
+                self.date_done = None
+
+        monkeypatch.setattr(tasks.app, 'backend', UnimplementedBackend())
+        monkeypatch.setattr(tasks.app, 'AsyncResult', Result)
+        assert tasks.lookup_tasks(['task1', 'task2']) == {
+            'task1': ('SUCCESS', 'fid'),
+            'task2': ('PENDING', None)
+        }
+
+    def test_task_state_cache(self):
+        '''Test unfinished task states expire but finished states do not
+        '''
+        now = [0]
+        cache = TaskStateCache(ttl=1, clock=lambda: now[0])
+        cache.set('running', 'STARTED', None)
+        cache.set('done', 'SUCCESS', {'results': 'fid'})
+        assert cache.get('running') == ('STARTED', None)
+        now[0] = 2
+        assert cache.get('running') is None
+        assert cache.get('done') == ('SUCCESS', {'results': 'fid'})
+
+    def test_long_poll_task_events(self, client):
+        '''Test we can catch up with recent task events by long-polling
+        '''
+        task_events.publish({'id': 'task1', 'state': 'STARTED', 'timestamp': 10.0})
+        task_events.publish({'id': 'task2', 'state': 'SUCCESS', 'timestamp': 11.0})
+        response = client.simulate_get(
+            '/tasks/events',
+            query_string='ids=task2&since=0&wait=0'
+        )
+        assert response.status == falcon.HTTP_OK
+        assert [event['state'] for event in response.json] == ['SUCCESS']
+
+        response = client.simulate_get(
+            '/tasks/events',
+            query_string='since=10.5&wait=0'
+        )
+        assert [event['id'] for event in response.json] == ['task2']
+
+
+class TestUpload:
+    '''Test model data can be uploaded in chunks
+    '''
+    def _patch(self, client, location, offset, chunk, checksum=None):
+        headers = {
+            'Upload-Offset': str(offset),
+            'Content-Type': 'application/offset+octet-stream',
+            'Upload-Checksum': 'sha1 {}'.format(
+                checksum or base64.b64encode(hashlib.sha1(chunk).digest()).decode()
+            )
+        }
+        return client.simulate_patch(location, body=chunk, headers=headers)
+
+    def test_chunked_upload(self, client):
+        '''Chunks may be sent out of order and a model is created when all have arrived
+        '''
+        with open(create_zip(), 'rb') as zfile:
+            data = zfile.read()
+        response = client.simulate_post('/uploads', body=json.dumps({'length': len(data)}))
+        assert response.status == falcon.HTTP_CREATED
+        location = response.headers['Location']
+
+        middle = len(data) // 2
+        response = self._patch(client, location, middle, data[middle:])
+        assert response.status == falcon.HTTP_NO_CONTENT
+        response = client.simulate_head(location)
+        assert response.headers['Upload-Offset'] == '0'
+        assert client.simulate_get(location).json['received'] == [[middle, len(data)]]
+
+        response = self._patch(client, location, 0, data[:middle])
+        assert response.status == falcon.HTTP_OK
+        assert response.json['state'] == 'complete'
+        model = Model.objects.get(id=response.json['model']['$oid'])
+        assert response.headers['Location'] == '/models/{}'.format(model.name)
+        assert model.entry_points == ['test.tcf']
+
+        # The upload can not be changed once complete
+        response = self._patch(client, location, 0, data[:middle])
+        assert response.status == falcon.HTTP_CONFLICT
+
+    def test_corrupt_chunk(self, client):
+        '''A chunk which does not match its' checksum is rejected
+        '''
+        model = Model(name=str(uuid.uuid4())).save()
+        body = {
+            'length': 8,
+            'model': model.name,
+            'content_type': 'text/plain',
+            'filename': 'notes.txt'
+        }
+        response = client.simulate_post('/uploads', body=json.dumps(body))
+        location = response.headers['Location']
+
+        checksum = base64.b64encode(hashlib.sha1(b'abcdefgh').digest()).decode()
+        response = self._patch(client, location, 0, b'abcdXfgh', checksum)
+        assert response.status == '460 Checksum Mismatch'
+        assert client.simulate_get(location).json['offset'] == 0
+
+        response = self._patch(client, location, 0, b'abcdefgh')
+        assert response.status == falcon.HTTP_OK
+        path = path_from_id(response.json['fid'])
+        with open(path, 'rb') as fobj:
+            assert fobj.read() == b'abcdefgh'
+
+    def test_corrupt_chunk_resent(self, client):
+        '''A corrupt copy of a chunk which was already received does not overwrite it
+        '''
+        model = Model(name=str(uuid.uuid4())).save()
+        body = {'length': 8, 'model': model.name, 'content_type': 'text/plain',
+                'filename': 'resent.txt'}
+        location = client.simulate_post('/uploads', body=json.dumps(body)).headers['Location']
+
+        assert self._patch(client, location, 0, b'abcd').status == falcon.HTTP_NO_CONTENT
+        checksum = base64.b64encode(hashlib.sha1(b'abcd').digest()).decode()
+        response = self._patch(client, location, 0, b'abXd', checksum)
+        assert response.status == '460 Checksum Mismatch'
+
+        response = self._patch(client, location, 4, b'efgh')
+        assert response.status == falcon.HTTP_OK
+        with open(path_from_id(response.json['fid']), 'rb') as fobj:
+            assert fobj.read() == b'abcdefgh'
+
+    def test_finalize_failure(self, client, monkeypatch):
+        '''An upload which can't be added to its' model is marked as failed
+        '''
+        def fail(*args, **kwargs):
+            raise OSError('Disk full')
+
+        monkeypatch.setattr(app.data_store, 'save_zip', fail)
+        location = client.simulate_post(
+            '/uploads', body=json.dumps({'length': 4})
+        ).headers['Location']
+        with pytest.raises(OSError):
+            self._patch(client, location, 0, b'abcd')
+        upload = client.simulate_get(location).json
+        assert (upload['state'], upload['error']) == ('failed', 'Disk full')
+
+    def test_expire_uploads(self, client, tmpdir):
+        '''Abandoned uploads and upload files without an upload are removed
+        '''
+        data_store = DataStore(str(tmpdir))
+        old = datetime.datetime.now() - datetime.timedelta(days=2)
+        abandoned = Upload(length=4, date_updated=old).save()
+        interrupted = Upload(length=4, date_updated=old, state='finalizing').save()
+        active = Upload(length=4).save()
+        for uid in (abandoned.id, interrupted.id, active.id, 'orphan'):
+            data_store.create_upload(str(uid), 4)
+
+        expire_uploads(data_store, Upload, 24 * 3600)
+        assert data_store.upload_ids() == [str(active.id)]
+        assert not Upload.objects(id=abandoned.id)
+        assert Upload.objects.get(id=interrupted.id).state == 'failed'
+
+    def test_chunk_outside_upload(self, client):
+        response = client.simulate_post('/uploads', body=json.dumps({'length': 4}))
+        response = self._patch(client, response.headers['Location'], 2, b'abc')
+        assert response.status == falcon.HTTP_BAD_REQUEST
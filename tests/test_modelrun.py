@@ -1,12 +1,18 @@
 '''Tests for Runs api
 '''
+import datetime
+import gzip
 import uuid
 import json
 import os
 import falcon
+import pytest
 from falcon import testing
-from tucluster.fmdb import Model, ModelRun, id_from_path
+from tucluster.fmdb import Model, ModelIndex, ModelRun, id_from_path, indexes
 from tucluster.conf import settings
+from tucluster.resources import geo, pagination, runs, tasks
+from tucluster.resources.runs import RunStateSync
+from tucluster.resources.geo import geo_filter
 from .fixtures import client
 
 
@@ -44,6 +50,30 @@ class TestModelRun:
         assert response.status == falcon.HTTP_CREATED
         assert 'Location' in response.headers
 
+    def test_post_model_run_missing_inputs(self, client, tmpdir):
+        '''Runs whose control files refer to missing files are rejected unless forced
+        '''
+        tmpdir.join('model.tcf').write(
+            'Origin == 10.0, 20.0\nGrid Size (X,Y) == 1, 1\nRead GRID Zpts == dem.asc\n'
+        )
+        model = Model(name=str(uuid.uuid4()), folder=id_from_path(str(tmpdir))).save()
+        body = {
+            'entrypoint': 'model.tcf',
+            'modelName': model.name,
+            'engine': 'tuflow',
+            'mock': True
+        }
+        response = client.simulate_post('/runs', body=json.dumps(body))
+        assert response.status == falcon.HTTP_BAD_REQUEST
+        assert 'dem.asc' in response.json['description']
+
+        body['force'] = True
+        response = client.simulate_post('/runs', body=json.dumps(body))
+        assert response.status == falcon.HTTP_CREATED
+        assert response.json['model_area']['coordinates'] == [
+            [[10, 20], [11, 20], [11, 21], [10, 21], [10, 20]]
+        ]
+
     def test_post_model_run_anuga(self, client):
         '''The API can start a background task to run a tuflow model
         for the given Model name and control file name
@@ -96,6 +126,67 @@ class TestModelRun:
         assert response.text == queryset.to_json()
         assert response.status == falcon.HTTP_OK
 
+    def test_filter_runs_baseline(self, client):
+        baseline = self._create_modelrun()
+        baseline.update(is_baseline=True)
+        other = self._create_modelrun()
+        response = client.simulate_get('/runs', query_string='baseline=true')
+        assert [run['_id']['$oid'] for run in response.json] == [str(baseline.id)]
+        response = client.simulate_get('/runs', query_string='baseline=false')
+        assert [run['_id']['$oid'] for run in response.json] == [str(other.id)]
+
+    def test_filter_runs_model_id(self, client):
+        '''Runs can be filtered by the name or id of their model
+        '''
+        model = Model(name=str(uuid.uuid4())).save()
+        run = ModelRun(entry_point='a.tcf', engine='tuflow', model=model).save()
+        self._create_modelrun()
+        for query_string in ('model=' + model.name, 'modelId={}'.format(model.id)):
+            response = client.simulate_get('/runs', query_string=query_string)
+            assert [doc['_id']['$oid'] for doc in response.json] == [str(run.id)]
+        for query_string in ('model=missing', 'modelId=missing'):
+            response = client.simulate_get('/runs', query_string=query_string)
+            assert response.status == falcon.HTTP_BAD_REQUEST
+
+    def test_indexes_cover_api_queries(self, monkeypatch):
+        # The test database may have been dropped since the collections were first used
+        Model.ensure_indexes()
+        ModelIndex.ensure_indexes()
+        ModelRun.ensure_indexes()
+        if not ModelRun._get_collection().index_information():
+            # Older mongomock versions don't record indexes, so check the declared ones
+            monkeypatch.setattr(indexes, 'index_keys', lambda document: [['_id']] + [
+                [field for field, _ in spec['fields']]
+                for spec in document._meta['index_specs']
+            ])
+        assert indexes.uncovered_queries() == []
+        query = indexes.Query('unindexed', ModelRun, ['result_summary'])
+        assert indexes.uncovered_queries([query]) == [query]
+
+    def test_geo_filter(self, client):
+        '''Spatial query parameters are converted to 2dsphere queries
+        '''
+        def query(string):
+            return geo_filter(falcon.Request(testing.create_environ(query_string=string)), 'area')
+
+        assert query('') is None
+        assert query('intersects=-1.5,53.8') == {'area': {'$geoIntersects': {
+            '$geometry': {'type': 'Point', 'coordinates': [-1.5, 53.8]}
+        }}}
+        assert query('bbox=0,50,1,51') == {'area': {'$geoWithin': {'$geometry': {
+            'type': 'Polygon', 'coordinates': [[[0, 50], [1, 50], [1, 51], [0, 51], [0, 50]]]
+        }}}}
+        assert query('near=1,2&distance=500') == {'area': {'$near': {
+            '$geometry': {'type': 'Point', 'coordinates': [1, 2]}, '$maxDistance': 500
+        }}}
+
+        for string in ('bbox=1,2,3', 'bbox=1,50,0,51', 'near=200,0', 'intersects={"a":1}',
+                       'near=1,2&bbox=0,50,1,51'):
+            assert client.simulate_get('/runs', query_string=string).status == \
+                falcon.HTTP_BAD_REQUEST
+        assert client.simulate_get('/models', query_string='near=1').status == \
+            falcon.HTTP_BAD_REQUEST
+
     def test_get_run(self, client):
         '''The API can return a single ``ModelRun`` document
         '''
@@ -116,3 +207,209 @@ class TestModelRun:
             })
         )
         assert response.status == falcon.HTTP_ACCEPTED
+
+    def test_list_runs_ndjson(self, client):
+        '''The API can list ``ModelRun`` documents as newline delimited JSON
+        '''
+        self._create_modelrun()
+        self._create_modelrun()
+        response = client.simulate_get('/runs', query_string='format=ndjson')
+        assert response.status == falcon.HTTP_OK
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+        lines = response.text.splitlines()
+        assert len(lines) == 2
+        assert [json.loads(line)['_id'] for line in lines] == [
+            json.loads(run.to_json())['_id'] for run in ModelRun.objects.all()
+        ]
+
+    def test_list_runs_compressed(self, client):
+        '''The streamed run list is compressed for clients which accept it
+        '''
+        for _ in range(20):
+            self._create_modelrun()
+        response = client.simulate_get('/runs', headers={'Accept-Encoding': 'gzip'})
+        assert response.status == falcon.HTTP_OK
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Content-Length' not in response.headers
+        assert gzip.decompress(response.content).decode('utf-8') == ModelRun.objects.to_json()
+
+    def test_paginate_runs(self, client):
+        '''The API can page through runs in descending order,
+        including runs without a start time
+        '''
+        ids = [str(self._create_modelrun().id) for _ in range(3)]
+        started = ModelRun(
+            entry_point='started.tcf',
+            engine='tuflow',
+            time_started=datetime.datetime.now()
+        ).save()
+        seen = []
+        url, query_string = '/runs', 'sort=-time_started&limit=2'
+        while True:
+            response = client.simulate_get(url, query_string=query_string)
+            assert response.status == falcon.HTTP_OK
+            seen.extend(doc['_id']['$oid'] for doc in response.json)
+            link = response.headers.get('Link')
+            if not link:
+                break
+            url, query_string = link[1:link.index('>')].split('?')
+        assert seen == [str(started.id)] + ids[::-1]
+
+    def test_paginate_ordered(self):
+        '''The order of a ``near`` query is kept when the page is limited
+        '''
+        group = str(uuid.uuid4())
+        for name in ('a', 'c', 'b'):
+            ModelRun(entry_point=name, engine='tuflow', group_id=group).save()
+        # Stands in for a $near query, which the test database does not support
+        docs = ModelRun.objects(group_id=group).order_by('-entry_point')
+
+        def page(query_string):
+            req = falcon.Request(testing.create_environ(query_string=query_string))
+            resp = falcon.Response()
+            page = pagination.paginate(req, resp, docs, ('_id',), ordered=True)
+            return [doc.entry_point for doc in page], resp.get_header('Link')
+
+        assert page('limit=2') == (['c', 'b'], None)
+        assert page('limit=2&sort=_id')[0] == ['a', 'c']
+        with pytest.raises(falcon.HTTPBadRequest):
+            page('limit=2&after=abc')
+
+    def test_distinct_matches(self):
+        '''Models are found from the distinct models of the matching runs
+        '''
+        class Collection(object):
+            def distinct(self, key, query):
+                self.called = ('distinct', key, query)
+                return ['a', None]
+
+            def aggregate(self, pipeline):
+                self.called = ('aggregate', pipeline)
+                return [{'_id': 'b'}]
+
+        def query(string):
+            return geo_filter(falcon.Request(testing.create_environ(query_string=string)), 'area')
+
+        collection = Collection()
+        bbox = query('bbox=0,50,1,51')
+        assert not geo.is_near(bbox)
+        assert geo.distinct_matches(collection, bbox, 'model') == ['a']
+        assert collection.called == ('distinct', 'model', bbox)
+
+        near = query('near=1,2&distance=500')
+        assert geo.is_near(near)
+        assert geo.distinct_matches(collection, near, 'model') == ['b']
+        assert collection.called == ('aggregate', [
+            {'$geoNear': {
+                'near': {'type': 'Point', 'coordinates': [1, 2]},
+                'key': 'area',
+                'distanceField': '_distance',
+                'spherical': True,
+                'query': {'model': {'$ne': None}},
+                'maxDistance': 500
+            }},
+            {'$group': {'_id': '$model'}}
+        ])
+
+    def test_sync_run_state(self, client):
+        '''Task events update the state of model runs, which can then
+        be used to filter the list of runs
+        '''
+        run = ModelRun(entry_point='a.tcf', engine='tuflow', task_id='task1', state='PENDING').save()
+        other = ModelRun(entry_point='b.tcf', engine='tuflow', task_id='task2', state='PENDING').save()
+        sync = RunStateSync(ModelRun)
+        sync({'id': 'task1', 'state': 'FAILURE', 'timestamp': 1000.0, 'exception': 'Boom'})
+        # A late event does not change a finished run
+        sync({'id': 'task1', 'state': 'STARTED', 'timestamp': 999.0})
+        sync({'id': 'task2', 'state': 'STARTED', 'timestamp': 999.0})
+
+        run.reload()
+        assert run.state == 'FAILURE'
+        assert run.result_summary == 'Boom'
+        assert run.time_finished is not None
+
+        response = client.simulate_get('/runs', query_string='state=FAILURE')
+        assert [doc['_id']['$oid'] for doc in response.json] == [str(run.id)]
+        response = client.simulate_get('/runs', query_string='state=STARTED')
+        assert [doc['_id']['$oid'] for doc in response.json] == [str(other.id)]
+
+    def test_sync_run_state_pending(self, client):
+        '''Events received before the run of a task is saved are applied once it is
+        '''
+        now = [0]
+        sync = RunStateSync(ModelRun, clock=lambda: now[0])
+        sync({'id': 'early', 'state': 'STARTED', 'timestamp': 999.0})
+        sync({'id': 'early', 'state': 'SUCCESS', 'timestamp': 1000.0})
+        sync({'id': 'unknown', 'state': 'STARTED', 'timestamp': 999.0})
+        run = ModelRun(entry_point='a.tcf', engine='tuflow', task_id='early', state='PENDING').save()
+
+        now[0] = sync.RETRY_INTERVAL
+        sync({'id': 'other', 'state': 'STARTED', 'timestamp': 999.0})
+        run.reload()
+        assert run.state == 'SUCCESS'
+        assert run.time_finished == datetime.datetime.fromtimestamp(1000.0)
+
+        # Events of tasks without a run are eventually dropped
+        now[0] = sync.PENDING_TTL + sync.RETRY_INTERVAL * 2
+        sync.retry_pending()
+        assert not sync._pending
+
+    def test_reconcile_run_state(self, client, monkeypatch):
+        '''Runs are updated from the result backend, finishing when their task did
+        '''
+        run = ModelRun(entry_point='a.tcf', engine='tuflow', task_id='done', state='STARTED').save()
+        monkeypatch.setattr(runs, 'fetch_tasks', lambda task_ids: {
+            task_id: ('SUCCESS', None, 1000.0) for task_id in task_ids
+        })
+        RunStateSync(ModelRun).reconcile()
+        run.reload()
+        assert run.state == 'SUCCESS'
+        assert run.time_finished == datetime.datetime.fromtimestamp(1000.0)
+
+    def test_bulk_post_model_runs(self, client):
+        '''The API can start many runs of a model in one request
+        '''
+        model = Model(
+            name=str(uuid.uuid4()),
+            folder=id_from_path(os.path.dirname(__file__))
+        ).save()
+        model.update(entry_points=['a.tcf', 'b.tcf', 'c.py'])
+        response = client.simulate_post(
+            '/runs/bulk',
+            body=json.dumps({
+                'modelName': model.name,
+                'entrypoints': ['*.tcf', 'runs/d.tcf'],
+                'mock': True
+            })
+        )
+        assert response.status == falcon.HTTP_CREATED
+        group_id = response.json['groupId']
+        assert len(response.json['runs']) == 3
+
+        runs = ModelRun.objects(group_id=group_id)
+        assert sorted(run.entry_point for run in runs) == ['a.tcf', 'b.tcf', 'runs/d.tcf']
+        assert all(run.engine == 'tuflow' and run.task_id for run in runs)
+
+        response = client.simulate_get('/runs', query_string='group={}'.format(group_id))
+        assert len(response.json) == 3
+
+        # The bulk endpoint does not list runs
+        assert client.simulate_get('/runs/bulk').status == falcon.HTTP_METHOD_NOT_ALLOWED
+
+    def test_bulk_post_without_group_results(self, client, monkeypatch):
+        '''Runs are started when the result backend can't store groups
+        '''
+        def save_group(group_id, result):
+            raise NotImplementedError('Backend does not support groups')
+
+        monkeypatch.setattr(tasks.app.backend, 'save_group', save_group)
+        model = Model(
+            name=str(uuid.uuid4()),
+            folder=id_from_path(os.path.dirname(__file__))
+        ).save()
+        response = client.simulate_post(
+            '/runs/bulk',
+            body=json.dumps({'modelName': model.name, 'entrypoints': ['a.tcf'], 'mock': True})
+        )
+        assert response.status == falcon.HTTP_CREATED
+        assert ModelRun.objects(group_id=response.json['groupId']).count() == 1
@@ -1,34 +1,132 @@
 # -*- coding: utf-8 -*-
+import logging
+import os
+import threading
 import falcon
+from pymongo import monitoring
 # Import the celery app to ensure it is initialised when we start the server
 from qflow.celery import app
-from tucluster import resources
+from tucluster import resources, middleware
 from tucluster.conf import settings
-from tucluster.fmdb import connect, Model, ModelRun
+from tucluster.fmdb import connect, indexes, Model, ModelRun, Upload, Job
+
+logger = logging.getLogger(__name__)
+
+components = []
+
+metrics = None
+if settings['METRICS']['enabled']:
+    if middleware.metrics.prometheus_client is None:
+        logger.warning('METRICS is enabled, but prometheus_client is not installed')
+    else:
+        # First, so that it times the other middleware and counts compressed bytes
+        metrics = middleware.metrics.Metrics()
+        components.append(middleware.metrics.MetricsMiddleware(metrics))
+        # Listeners must be registered before connecting
+        monitoring.register(middleware.metrics.MongoCommandListener(metrics))
+
+profiling = settings['PROFILING']
+if profiling['enabled']:
+    # Profile requests which ask for it or are sampled, saving slow ones
+    components.append(middleware.profiling.ProfilingMiddleware(
+        profiling['directory'] or os.path.join(settings['MODEL_DATA_DIR'], '.profiles'),
+        header=profiling['header'],
+        sample_rate=profiling['sample_rate'],
+        threshold=profiling['threshold'],
+        keep=profiling['keep']
+    ))
+
+compression = settings['COMPRESSION']
+if compression['enabled']:
+    # Compress text responses, caching compressed downloads on disk
+    compressed_cache = None
+    if compression['cache_size']:
+        compressed_cache = middleware.compression.CompressedFileCache(
+            os.path.join(settings['MODEL_DATA_DIR'], '.compressed'),
+            compression['cache_size']
+        )
+    components.append(middleware.compression.CompressionMiddleware(
+        min_size=compression['min_size'],
+        encodings=compression['encodings'],
+        levels=compression['levels'],
+        cache=compressed_cache,
+        max_file_size=compression['max_file_size']
+    ))
 
 # Create the WSGI application. It is aliased to ``application``
 # as this is what gunicorn expects.
-api = application = falcon.API()
+api = application = falcon.API(middleware=components)
 
 # Connect to the database
 db = connect(**settings['MONGODB'])
 
+if settings['CHECK_INDEXES']:
+    # Missing indexes make filtered queries scan the whole collection
+    for query in indexes.uncovered_queries():
+        logger.warning(
+            'No index covers %s (%s fields %s)',
+            query.name, query.document.__name__, ', '.join(query.fields)
+        )
+
+# Bounded thread pool shared by resources for blocking filesystem operations
+executor = resources.jobs.JobExecutor(Job, **settings['EXECUTOR'])
+
 # The data store encapsulates saving and retrieving files from
 # the configured storage location and is used by various resources
-data_store = resources.utils.DataStore(settings['MODEL_DATA_DIR'])
+data_store = resources.utils.DataStore(
+    settings['MODEL_DATA_DIR'],
+    content_addressed=settings['CONTENT_ADDRESSED_STORAGE'],
+    chunk_size=settings['UPLOAD_CHUNK_SIZE'],
+    executor=executor
+)
+
+# Directory listings are cached between requests for the file tree
+tree_cache = resources.cache.DirectoryCache(**settings['TREE_CACHE'])
+
+# Task states are cached briefly to absorb repeated polling
+task_cache = resources.tasks.TaskStateCache(settings['TASK_STATE_TTL'])
+
+# Celery task events are received once per process and pushed to clients
+task_events = resources.events.TaskEventBroker(app)
+
+if settings['SYNC_TASK_STATE']:
+    # Copy task states onto the model runs as events are received. Usually this is
+    # done by a single ``tucluster.sync`` process instead
+    run_state_sync = resources.runs.RunStateSync(ModelRun)
+    task_events.add_listener(run_state_sync)
+    threading.Thread(target=run_state_sync.reconcile, daemon=True).start()
 
 # Add the routes
 api.add_route(
     '/models',
     resources.models.ModelCollection(
         data_store,
-        Model
+        Model,
+        ModelRun,
+        executor
     )
 )
 
 api.add_route(
     '/models/{name}',
-    resources.models.ModelItem(data_store, Model)
+    resources.models.ModelItem(data_store, Model, executor=executor)
+)
+
+api.add_route(
+    '/models/{name}/dependencies',
+    resources.models.ModelDependencies(data_store, Model, ModelRun)
+)
+
+api.add_route(
+    '/uploads',
+    resources.uploads.UploadCollection(
+        data_store, Upload, Model, executor, settings['UPLOAD_EXPIRY']
+    )
+)
+
+api.add_route(
+    '/uploads/{uid}',
+    resources.uploads.UploadItem(data_store, Upload, Model, executor)
 )
 
 api.add_route(
@@ -36,14 +134,29 @@ api.add_route(
     resources.runs.ModelRunCollection(ModelRun)
 )
 
+api.add_route(
+    '/runs/bulk',
+    resources.runs.ModelRunBulk(ModelRun)
+)
+
 api.add_route(
     '/runs/{oid}',
     resources.runs.ModelRunItem(ModelRun)
 )
 
+api.add_route(
+    '/tasks',
+    resources.tasks.TaskCollection(task_cache)
+)
+
+api.add_route(
+    '/tasks/events',
+    resources.events.TaskEvents(task_events)
+)
+
 api.add_route(
     '/tasks/{id}',
-    resources.tasks.TaskDetail()
+    resources.tasks.TaskDetail(task_cache, metrics)
 )
 
 api.add_route(
@@ -51,7 +164,25 @@ api.add_route(
     resources.files.FileItem(data_store)
 )
 
+api.add_route(
+    '/files/zip/{fid}',
+    resources.files.FolderArchive(data_store)
+)
+
 api.add_route(
     '/files/tree/{fid}',
-    resources.files.Tree(data_store)
+    resources.files.Tree(data_store, tree_cache, executor)
+)
+
+api.add_route(
+    '/jobs',
+    resources.jobs.JobCollection(executor)
 )
+
+api.add_route(
+    '/jobs/{id}',
+    resources.jobs.JobItem(Job)
+)
+
+if metrics is not None:
+    api.add_route('/metrics', middleware.metrics.MetricsResource())
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+'''Serve the API with an ASGI server, e.g ``uvicorn tucluster.asgi:application``.
+
+The resources are the same as those of the WSGI application in ``tucluster.app``.
+Each request is handled (including its' database queries and celery lookups) in a
+thread pool, while the event loop receives request bodies and sends responses. A slow
+client then only holds a thread while its' response is being read from disk, not while
+it is sent over the network, so one process can serve thousands of concurrent transfers.
+Task event subscribers (``/tasks/events``) wait for events in a separate thread pool, so
+that they can't hold every thread of the main pool.
+'''
+import asyncio
+import concurrent.futures
+import os
+import sys
+import tempfile
+
+from tucluster.conf import settings
+
+# Marks the end of the response iterator
+_DONE = object()
+
+
+class FileWrapper(object):
+    '''``wsgi.file_wrapper`` which reads files in larger blocks than falcon requests,
+    since each block is read in the thread pool.
+    '''
+    def __init__(self, block_size):
+        self._block_size = block_size
+
+    def __call__(self, filelike, block_size=None):
+        return _FileIterator(filelike, self._block_size)
+
+
+class _FileIterator(object):
+    def __init__(self, filelike, block_size):
+        self._filelike = filelike
+        self._block_size = block_size
+
+    def __iter__(self):
+        while True:
+            data = self._filelike.read(self._block_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        close = getattr(self._filelike, 'close', None)
+        if close is not None:
+            close()
+
+
+class ASGIAdapter(object):
+    '''Serve a WSGI application from an ASGI server.
+
+    The request body is received into a temporary file (held in memory up to ``spool_size``
+    bytes) before the application is called, so that slow uploads do not hold a thread.
+    Each chunk of the response is produced in the thread pool and sent by the event loop.
+    Sending stops if the client disconnects.
+
+    Args:
+        wsgi_app (callable): The WSGI application, e.g ``tucluster.app.application``
+        threads (int): Size of the thread pool. This bounds the number of requests being
+            handled at once, but not the number of requests being received or sent.
+        event_threads (int): Size of the thread pool handling the ``event_paths``. Each
+            subscriber holds a thread while it waits for events (up to 60 seconds when
+            long-polling, as long as it is connected for Server-Sent Events), so this bounds
+            the number of subscribers. Further subscribers wait for a thread.
+        event_paths (tuple): Paths of the task event routes
+        spool_size (int): Request bodies larger than this are written to disk
+        spool_dir (str): Folder for request bodies written to disk. Defaults to the system
+            temporary folder (``create_app`` defaults to the ``.spool`` folder of the
+            ``MODEL_DATA_DIR``).
+        block_size (int): Size of the blocks in which files are read and sent
+    '''
+    def __init__(self, wsgi_app, threads=64, spool_size=1024 * 1024, spool_dir=None,
+                 block_size=256 * 1024, event_threads=64, event_paths=('/tasks/events',)):
+        self._app = wsgi_app
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='tucluster-asgi'
+        )
+        self._event_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=event_threads, thread_name_prefix='tucluster-asgi-events'
+        )
+        self._event_paths = frozenset(event_paths)
+        self._spool_size = spool_size
+        self._spool_dir = spool_dir
+        self._file_wrapper = FileWrapper(block_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type {}'.format(scope['type']))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                self._event_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _run(self, func, *args, executor=None):
+        return asyncio.get_event_loop().run_in_executor(
+            executor or self._executor, func, *args
+        )
+
+    async def _receive_body(self, receive):
+        '''Receive the request body into a temporary file.
+
+        Returns:
+            tuple: ``(body, length)``, or ``None`` if the client disconnected
+        '''
+        body = tempfile.SpooledTemporaryFile(max_size=self._spool_size, dir=self._spool_dir)
+        length = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            chunk = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if not chunk:
+                continue
+            if length <= self._spool_size < length + len(chunk) and self._spool_dir:
+                # The body is about to be rolled over to a file
+                await self._run(os.makedirs, self._spool_dir, 0o777, True)
+            length += len(chunk)
+            if length > self._spool_size:
+                # Written to disk, so don't block the event loop
+                await self._run(body.write, chunk)
+            else:
+                body.write(chunk)
+        body.seek(0)
+        return body, length
+
+    def _environ(self, scope, body, length):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'REMOTE_ADDR': str(client[0]),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': self._file_wrapper,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = name
+            else:
+                key = 'HTTP_{}'.format(name)
+            environ[key] = '{},{}'.format(environ[key], value) if key in environ else value
+        # The whole body has been received, so its' length is known even if it was chunked
+        environ['CONTENT_LENGTH'] = str(length)
+        return environ
+
+    async def _http(self, scope, receive, send):
+        received = await self._receive_body(receive)
+        if received is None:
+            return
+        body, length = received
+        environ = self._environ(scope, body, length)
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers
+            ]
+
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch())
+        if scope['path'] in self._event_paths:
+            executor = self._event_executor
+        else:
+            executor = self._executor
+        result = None
+        try:
+            result = await self._run(self._app, environ, start_response, executor=executor)
+            iterator = iter(result)
+            # The response may be started when the first chunk is produced
+            chunk = await self._run(next, iterator, _DONE, executor=executor)
+            await send({
+                'type': 'http.response.start',
+                'status': started['status'],
+                'headers': started['headers']
+            })
+            while chunk is not _DONE and not disconnected.is_set():
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await self._run(next, iterator, _DONE, executor=executor)
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            watcher.cancel()
+            close = getattr(result, 'close', None)
+            if close is not None:
+                await self._run(close, executor=executor)
+            body.close()
+
+
+def create_app(wsgi_app=None, **options):
+    '''Create the ASGI application.
+
+    Request bodies larger than ``spool_size`` are written to ``spool_dir``, or the ``.spool``
+    folder of the ``MODEL_DATA_DIR`` if it is not set. Uploads of model data can be many GB,
+    which the system temporary folder may not have room for.
+
+    Args:
+        wsgi_app (callable): The WSGI application to serve. Defaults to ``tucluster.app``
+        options: Override the ``ASGI`` settings, see ``ASGIAdapter``
+    '''
+    if wsgi_app is None:
+        from tucluster.app import application as wsgi_app
+    kwargs = dict(settings['ASGI'])
+    kwargs.update(options)
+    if kwargs.get('spool_dir') is None:
+        kwargs['spool_dir'] = os.path.join(settings['MODEL_DATA_DIR'], '.spool')
+    return ASGIAdapter(wsgi_app, **kwargs)
+
+
+application = create_app()
@@ -16,17 +16,94 @@ __DEFAULTS = {
     },
     "MODEL_DATA_DIR": os.path.join(os.path.dirname(__file__), 'data'),
     "TUFLOW_PATH": "tuflow",
-    "ANUGA_ENV": "anuga"
+    "ANUGA_ENV": "anuga",
+    # How /files/{fid} sends file contents: 'stream', 'sendfile',
+    # 'x-accel-redirect' or 'x-sendfile'
+    "FILE_SERVING": "stream",
+    # URL prefix of the internal nginx location aliased to MODEL_DATA_DIR
+    # (only used with 'x-accel-redirect')
+    "FILE_SERVING_PREFIX": "/protected/",
+    # Directory listing cache used by /files/tree/{fid}. Set "redis" to a
+    # redis URL to share the cache between processes
+    "TREE_CACHE": {
+        "size": 1024,
+        "redis": None
+    },
+    # Seconds for which the state of an unfinished task is cached
+    "TASK_STATE_TTL": 1.5,
+    # Keep the state of model runs up to date by listening to celery task events in each
+    # API process. Prefer running ``python -m tucluster.sync`` once instead
+    "SYNC_TASK_STATE": False,
+    # Store each distinct uploaded file once and link it into the model folders
+    "CONTENT_ADDRESSED_STORAGE": False,
+    # Largest read/write, in bytes, used when saving uploaded files
+    "UPLOAD_CHUNK_SIZE": 1048576,
+    # Seconds after which a chunked upload which has not received a chunk is removed
+    "UPLOAD_EXPIRY": 604800,
+    # Compression of responses. Compressed downloads are cached in MODEL_DATA_DIR/.compressed
+    # up to "cache_size" bytes
+    "COMPRESSION": {
+        "enabled": True,
+        "min_size": 1024,
+        "encodings": None,
+        "levels": {},
+        "cache_size": 1073741824,
+        "max_file_size": 16777216
+    },
+    # Log a warning at startup for each API query which is not covered by an index
+    "CHECK_INDEXES": True,
+    # Thread pool for blocking filesystem operations (tree walks, archive extraction).
+    # Requests wait up to "wait" seconds before the operation continues as a job
+    "EXECUTOR": {
+        "workers": 4,
+        "max_queue": 64,
+        "wait": 5.0
+    },
+    # Thread pools and request body spooling of the ASGI application (tucluster.asgi).
+    # Subscribers to /tasks/events each hold one of the "event_threads"
+    "ASGI": {
+        "threads": 64,
+        "event_threads": 64,
+        "spool_size": 1048576,
+        "spool_dir": None,
+        "block_size": 262144
+    },
+    # Prometheus metrics on /metrics (requires prometheus_client)
+    "METRICS": {
+        "enabled": True
+    },
+    # Profiling of requests which send "header" or are sampled. Profiles of requests taking
+    # "threshold" seconds or longer are saved in "directory" (MODEL_DATA_DIR/.profiles by default)
+    "PROFILING": {
+        "enabled": False,
+        "header": "X-Profile",
+        "sample_rate": 0.0,
+        "threshold": 1.0,
+        "directory": None,
+        "keep": 100
+    }
 }
 
 
+def __merge(defaults, overrides):
+    '''Merge the ``overrides`` into a copy of the ``defaults``. Nested blocks are merged
+    too, so a block of the user configuration only needs the values it changes.
+    '''
+    config = dict(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            value = __merge(config[key], value)
+        config[key] = value
+    return config
+
+
 def __get_config():
     config_path = os.environ.get('TUCLUSTER_CONFIG', None)
     config = __DEFAULTS
     if config_path:
         with open(config_path) as fin:
             user_config = json.load(fin)
-        config.update(user_config)
+        config = __merge(config, user_config)
     return config
 
 
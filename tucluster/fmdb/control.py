@@ -0,0 +1,419 @@
+'''Parsing of Tuflow control files into a graph of the inputs each entry point depends on
+
+Control files (``.tcf``, ``.tgc``, ``.tbc``, ``.ecf`` etc.) are lists of ``Command == Value``
+lines. Commands which read a file (e.g. ``Geometry Control File``, ``Read GIS Z Shape``,
+``BC Database``) are followed, recursively for other control files. File references are
+resolved relative to the referencing control file, case insensitively, since models are
+often prepared on Windows.
+
+The ``Read GIS Location`` layer, with the ``Grid Size (X,Y)`` command, gives the extent of
+the 2D domain, which is used as the ``model_area`` of model runs. The ``pyproj`` package is
+needed to convert this from the projection of the model to longitude and latitude, unless
+the model is already in longitude and latitude.
+'''
+import hashlib
+import math
+import os
+import re
+import struct
+import time
+
+from tucluster.fmdb.indexing import _RACY_INTERVAL
+
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+# Files with the same syntax as the control file, which are followed
+CONTROL_EXTENSIONS = ('.tcf', '.tgc', '.tbc', '.ecf', '.trd', '.tef', '.toc')
+
+# Files which must accompany a GIS layer
+_SIDECARS = {
+    '.shp': ('.shx', '.dbf'),
+    '.mif': ('.mid',),
+}
+
+_LOCATION_COMMANDS = ('read gis location', 'read mi location')
+
+
+def parse_commands(text):
+    '''Return the ``(command, value)`` pairs of a control file, without comments
+    '''
+    commands = []
+    for line in text.splitlines():
+        line = re.split('[!#]', line, maxsplit=1)[0]
+        if '==' not in line:
+            continue
+        command, value = line.split('==', 1)
+        commands.append((' '.join(command.split()), value.strip()))
+    return commands
+
+
+def _is_input(command):
+    lower = command.lower()
+    if lower.startswith('write') or 'folder' in lower or 'output' in lower:
+        return False
+    return lower.startswith('read') or lower.endswith(('file', 'database'))
+
+
+def _file_references(value):
+    '''The file names in a command value, e.g ``a.shp | b.shp``
+    '''
+    names = []
+    for item in value.split('|'):
+        item = item.strip().strip('"')
+        extension = os.path.splitext(item)[1][1:]
+        if extension and extension.isalnum() and not extension.isdigit():
+            names.append(item)
+    return names
+
+
+def _numbers(value):
+    try:
+        return [float(number) for number in re.split('[,\\s]+', value.strip()) if number]
+    except ValueError:
+        return None
+
+
+def parse_control_file(text):
+    '''Find the input files and the domain settings in the text of a control file.
+
+    Returns:
+        tuple: ``references``, a list of ``[command, file name]`` pairs as written in the
+            file, and ``settings``, a dict which may have the ``location`` file name, the
+            ``grid_size``, ``origin`` and ``orientation`` of the 2D domain.
+    '''
+    references = []
+    settings = {}
+    for command, value in parse_commands(text):
+        lower = command.lower()
+        if lower.startswith('grid size'):
+            numbers = _numbers(value)
+            if numbers and len(numbers) == 2:
+                settings['grid_size'] = numbers
+        elif lower == 'origin':
+            numbers = _numbers(value)
+            if numbers and len(numbers) == 2:
+                settings['origin'] = numbers
+        elif lower in ('orientation angle', 'orientation'):
+            numbers = _numbers(value)
+            if numbers and len(numbers) == 1:
+                settings['orientation'] = numbers[0]
+
+        if not _is_input(command):
+            continue
+        for name in _file_references(value):
+            references.append([command, name])
+            if lower in _LOCATION_COMMANDS and 'location' not in settings:
+                settings['location'] = name
+    return references, settings
+
+
+def _read_shp_line(path):
+    '''The first two vertices and projection of the first line or polygon in a shapefile
+    '''
+    with open(path, 'rb') as fobj:
+        if len(fobj.read(100)) < 100:
+            return None
+        record_header = fobj.read(8)
+        if len(record_header) < 8:
+            return None
+        content = fobj.read(struct.unpack('>i', record_header[4:8])[0] * 2)
+    if len(content) < 44 or struct.unpack('<i', content[:4])[0] not in (3, 5, 13, 15, 23, 25):
+        return None
+    num_parts, num_points = struct.unpack('<ii', content[36:44])
+    offset = 44 + 4 * num_parts
+    if num_points < 2 or len(content) < offset + 32:
+        return None
+    x0, y0, x1, y1 = struct.unpack('<4d', content[offset:offset + 32])
+
+    crs = None
+    prj = os.path.splitext(path)[0] + '.prj'
+    if os.path.exists(prj):
+        with open(prj) as fobj:
+            crs = fobj.read().strip() or None
+    return [[x0, y0], [x1, y1]], crs
+
+
+def _read_mif_line(path):
+    '''The first two vertices of the first line in a MapInfo interchange file.
+
+    Only the ``Earth Projection 1`` (longitude/latitude) coordinate system is recognised.
+    '''
+    crs = None
+    points = []
+    with open(path, errors='replace') as fobj:
+        lines = iter(fobj)
+        for line in lines:
+            words = line.split()
+            if not words:
+                continue
+            keyword = words[0].lower()
+            if keyword == 'coordsys' and re.search(r'earth\s+projection\s+1\s*,', line, re.I):
+                crs = 'EPSG:4326'
+            elif keyword == 'line' and len(words) >= 5:
+                points = [[float(words[1]), float(words[2])], [float(words[3]), float(words[4])]]
+                break
+            elif keyword == 'pline':
+                for vertex in lines:
+                    numbers = _numbers(vertex)
+                    if numbers and len(numbers) == 2:
+                        points.append(numbers)
+                    if len(points) == 2:
+                        break
+                break
+    if len(points) < 2:
+        return None
+    return points, crs
+
+
+def read_location(path):
+    '''Read the first two vertices of a GIS location layer.
+
+    Returns:
+        tuple: ``(vertices, crs)``, where ``crs`` is the projection (WKT or an EPSG code) if
+            known, or ``None`` if the file can not be read
+    '''
+    try:
+        if path.lower().endswith('.shp'):
+            return _read_shp_line(path)
+        if path.lower().endswith('.mif'):
+            return _read_mif_line(path)
+    except (OSError, ValueError, struct.error):
+        pass
+    return None
+
+
+def domain_polygon(settings, location=None):
+    '''Compute the GeoJSON polygon of a 2D domain from its' grid settings.
+
+    The domain starts at the ``origin`` (or the first vertex of the ``location`` line) and
+    is ``grid_size`` long in the direction of the ``orientation`` angle (or the location line).
+
+    Args:
+        settings (dict): Combined settings of the control files (see ``parse_control_file``)
+        location (tuple): Result of ``read_location`` for the location layer
+
+    Returns:
+        dict: GeoJSON polygon in longitude and latitude, or ``None`` if it can not be computed
+    '''
+    crs = None
+    if location is not None:
+        (x0, y0), (x1, y1) = location[0]
+        crs = location[1]
+        origin = settings.get('origin', [x0, y0])
+        angle = math.atan2(y1 - y0, x1 - x0)
+    elif 'origin' in settings:
+        origin = settings['origin']
+        angle = math.radians(settings.get('orientation', 0.0))
+    else:
+        return None
+    if 'grid_size' not in settings:
+        return None
+
+    width, height = settings['grid_size']
+    ux, uy = math.cos(angle), math.sin(angle)
+    vx, vy = -uy, ux
+    ox, oy = origin
+    corners = [
+        (ox, oy),
+        (ox + width * ux, oy + width * uy),
+        (ox + width * ux + height * vx, oy + width * uy + height * vy),
+        (ox + height * vx, oy + height * vy),
+    ]
+
+    if crs is not None and crs != 'EPSG:4326':
+        if pyproj is None:
+            return None
+        try:
+            source = pyproj.CRS.from_user_input(crs)
+            transformer = pyproj.Transformer.from_crs(source, 'EPSG:4326', always_xy=True)
+            corners = [transformer.transform(x, y) for x, y in corners]
+        except pyproj.exceptions.CRSError:
+            return None
+    elif not all(-180 <= x <= 180 and -90 <= y <= 90 for x, y in corners):
+        # Projected coordinates of an unknown projection
+        return None
+
+    ring = [[x, y] for x, y in corners]
+    ring.append(ring[0])
+    return {'type': 'Polygon', 'coordinates': [ring]}
+
+
+class _Resolver(object):
+    '''Resolve file references relative to the model folder, case insensitively
+    '''
+    def __init__(self, root):
+        self._root = os.path.realpath(root)
+        self._listings = {}
+
+    def _listing(self, folder):
+        if folder not in self._listings:
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                names = []
+            self._listings[folder] = {name.lower(): name for name in names}
+        return self._listings[folder]
+
+    def resolve(self, base, name):
+        '''Return the path of ``name`` referenced from the control file ``base`` (both
+        relative to the model folder, separated by ``/``), and whether the file exists.
+        '''
+        relpath = os.path.normpath(os.path.join(
+            os.path.dirname(base), name.replace('\\', '/')
+        )).replace(os.sep, '/')
+        if relpath.startswith('../') or relpath == '..' or os.path.isabs(relpath):
+            # Outside the model folder, so not part of the uploaded data
+            return relpath, False
+        if '~' in relpath or '<<' in relpath:
+            # Scenario/event variables are only known when the model runs
+            return relpath, None
+
+        folder = self._root
+        parts = relpath.split('/')
+        for index, part in enumerate(parts):
+            actual = self._listing(folder).get(part.lower())
+            if actual is None:
+                return relpath, False
+            parts[index] = actual
+            folder = os.path.join(folder, actual)
+        return '/'.join(parts), os.path.isfile(folder)
+
+    def path(self, relpath):
+        return os.path.join(self._root, *relpath.split('/'))
+
+
+def _file_entry(resolver, relpath, cached, kind):
+    '''Parse a control file or read a location layer, reusing ``cached`` if the size and
+    mtime, or else the content hash, are unchanged.
+    '''
+    path = resolver.path(relpath)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if cached and cached['kind'] == kind and [cached['size'], cached['mtime']] == [
+            stat.st_size, stat.st_mtime_ns]:
+        return cached
+
+    with open(path, 'rb') as fobj:
+        content = fobj.read()
+    sha1 = hashlib.sha1(content).hexdigest()
+    # A file modified within the mtime resolution may change again unnoticed,
+    # so its' hash is checked on the next scan
+    mtime = stat.st_mtime_ns if time.time() - stat.st_mtime > _RACY_INTERVAL else None
+    entry = {'path': relpath, 'kind': kind, 'size': stat.st_size, 'mtime': mtime, 'sha1': sha1}
+    if cached and cached['kind'] == kind and cached['sha1'] == sha1:
+        for key in ('references', 'settings', 'location'):
+            if key in cached:
+                entry[key] = cached[key]
+        return entry
+
+    if kind == 'control':
+        references, settings = parse_control_file(content.decode('utf-8', 'replace'))
+        entry['references'] = references
+        entry['settings'] = settings
+    else:
+        location = read_location(path)
+        entry['location'] = list(location) if location else None
+    return entry
+
+
+def index_dependencies(root, entry_points, previous=None):
+    '''Build the dependency graph of the entry points of a model.
+
+    Args:
+        root (str): The model folder
+        entry_points (list): Control files relative to ``root``
+        previous (dict): The result of the previous call, used as a cache. Files whose size
+            and mtime (or failing that, content hash) are unchanged are not parsed again.
+
+    Returns:
+        dict: With the following items:
+
+            - ``files``: The parsed control files and location layers, with their size, mtime,
+                hash and parse results
+            - ``edges``: ``[source, command, target, exists]`` for each file reference.
+                ``exists`` is ``None`` for references containing scenario variables.
+            - ``entry_points``: For each control file entry point, its' ``path``, the
+                ``inputs`` it depends on (directly or through other control files), the
+                ``missing`` inputs and the ``area`` of the 2D domain as a GeoJSON polygon
+    '''
+    previous = previous or {}
+    cache = {entry['path']: entry for entry in previous.get('files', [])}
+    resolver = _Resolver(root)
+    files = {}
+    edges = {}
+
+    def visit(relpath, kind):
+        if relpath not in files:
+            files[relpath] = _file_entry(resolver, relpath, cache.get(relpath), kind)
+        return files[relpath]
+
+    summaries = []
+    for entry_point in entry_points:
+        if not entry_point.lower().endswith('.tcf'):
+            continue
+        inputs, missing = [], []
+        settings = {}
+        location = None
+        seen = set([entry_point])
+        queue = [entry_point]
+        while queue:
+            source = queue.pop(0)
+            entry = visit(source, 'control')
+            if entry is None:
+                continue
+            for key, value in entry['settings'].items():
+                settings.setdefault(key, value)
+            if source not in edges:
+                edges[source] = []
+                for command, name in entry['references']:
+                    target, exists = resolver.resolve(source, name)
+                    edges[source].append([source, command, target, exists])
+                    extension = os.path.splitext(target)[1].lower()
+                    for sidecar in _SIDECARS.get(extension, ()):
+                        other, other_exists = resolver.resolve(
+                            source, os.path.splitext(name)[0] + sidecar
+                        )
+                        edges[source].append([source, command, other, other_exists])
+
+            for _, command, target, exists in edges[source]:
+                if target in seen:
+                    continue
+                seen.add(target)
+                inputs.append(target)
+                if exists is False:
+                    missing.append(target)
+                elif exists and target.lower().endswith(CONTROL_EXTENSIONS):
+                    queue.append(target)
+                if (exists and location is None and 'location' in settings and
+                        command.lower() in _LOCATION_COMMANDS):
+                    location_entry = visit(target, 'location')
+                    if location_entry and location_entry.get('location'):
+                        location = location_entry['location']
+
+        summaries.append({
+            'path': entry_point,
+            'inputs': sorted(inputs),
+            'missing': sorted(missing),
+            'area': domain_polygon(settings, location)
+        })
+
+    return {
+        'files': [files[path] for path in sorted(files) if files[path] is not None],
+        'edges': [edge for source in sorted(edges) for edge in edges[source]],
+        'entry_points': summaries
+    }
+
+
+def dependants(dependencies, relpath):
+    '''Return the entry points which depend on a file, directly or indirectly
+    '''
+    relpath = relpath.strip('/')
+    return [
+        summary['path'] for summary in dependencies.get('entry_points', [])
+        if summary['path'] == relpath or relpath in summary['inputs']
+    ]
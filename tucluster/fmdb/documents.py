@@ -22,16 +22,22 @@ import os
 
 from mongoengine import (
     Document,
+    EmbeddedDocument,
+    EmbeddedDocumentField,
     StringField,
     ListField,
     DateTimeField,
     BooleanField,
+    IntField,
+    DictField,
     ReferenceField,
     PolygonField,
     EmailField,
     CASCADE
 )
 from tucluster.fmdb.serializers import path_from_id
+from tucluster.fmdb.indexing import scan_entry_points
+from tucluster.fmdb.control import index_dependencies
 
 class Model(Document):
     '''Metadata for a single Model.
@@ -50,35 +56,105 @@ class Model(Document):
     entry_points = ListField(
         StringField(),
         help_text=(
-            'List of entry points for the model.'
+            'List of entry points for the model, relative to the folder.'
             ' These may be tuflow control files or anuga python scripts')
     )
 
     meta = {
         'indexes': [
-            'date_created'
+            # Sort key for paginating the model list
+            ('date_created', 'id')
         ],
         'strict': False
     }
 
     def clean(self):
-        if self.folder:
-            # Validate the folder exists
-            path = self.resolve_folder()
-            if not os.path.exists(path):
-                raise NotADirectoryError('Model folder does not exist')
+        # The folder is only scanned when it is set. ``index_entry_points``
+        # should be called after files are added to it.
+        if self.folder and (self._created or 'folder' in self._changed_fields):
+            self.index_entry_points()
 
-            # Gather all the files which have been uploaded to provide
-            # record of initial state of the model folder
-            fnames = [
-                name for name in os.listdir(self.resolve_folder()) if name.endswith(('.tcf', '.py'))
-            ]
-            self.entry_points = fnames
+    def save(self, *args, **kwargs):
+        result = super(Model, self).save(*args, **kwargs)
+        if getattr(self, '_reindexed', False):
+            self.index.model = self
+            self.index.save()
+            self._reindexed = False
+            # Models indexed before there was a ``ModelIndex`` held the index themselves
+            self._get_collection().update_one(
+                {'_id': self.pk}, {'$unset': {'folder_index': '', 'dependencies': ''}}
+            )
+        return result
 
+    @property
+    def index(self):
+        '''The ``ModelIndex`` of the model. It is loaded when first used, and saved
+        with the model.
+        '''
+        if getattr(self, '_index', None) is None:
+            index = ModelIndex.objects(model=self).first() if self.pk else None
+            self._index = index or ModelIndex()
+        return self._index
+
+    @property
+    def dependencies(self):
+        return self.index.dependencies
+
+    def index_entry_points(self):
+        '''Find the entry points in the model folder and its' sub folders (e.g ``runs/``).
+
+        Only folders which have changed since the last scan are listed again.
+        The control files of the entry points are then parsed into a graph of the
+        ``dependencies`` of each entry point. Files which are unchanged since the last
+        scan are not parsed again. Both are kept in the ``index`` of the model.
+
+        Returns:
+            EntryPointScan: See ``indexing.scan_entry_points``
+        '''
+        # Validate the folder exists
+        path = self.resolve_folder()
+        if not os.path.isdir(path):
+            raise NotADirectoryError('Model folder does not exist')
+
+        index = self.index
+        scan = scan_entry_points(path, index.folder_index)
+        self.entry_points = scan.entry_points
+        index.folder_index = scan.index
+        index.dependencies = index_dependencies(path, scan.entry_points, index.dependencies)
+        self._reindexed = True
+        return scan
+
+    def entry_point_dependencies(self, entry_point):
+        '''Return the inputs, missing inputs and area of an entry point, or ``None``
+        if its' control file has not been indexed.
+        '''
+        for summary in (self.dependencies or {}).get('entry_points', []):
+            if summary['path'] == entry_point:
+                return summary
+        return None
 
     def resolve_folder(self):
         return path_from_id(self.folder)
 
+
+class ModelIndex(Document):
+    '''The entry point scan and dependency graph of a ``Model``.
+
+    These grow with the number of files in the model folder, so they are kept apart from
+    the model and only loaded when needed, not with every model which is listed.
+    '''
+    model = ReferenceField(Model, required=True, unique=True, reverse_delete_rule=CASCADE)
+    folder_index = DictField(
+        help_text="Modification times of the folders scanned for entry points"
+    )
+    dependencies = DictField(
+        help_text="Inputs referenced by the control files of each entry point"
+    )
+
+    meta = {
+        'strict': False
+    }
+
 ENGINES = (
     ('tuflow', 'Tuflow'),
     ('anuga', 'Anuga'),
@@ -92,6 +168,15 @@ class ModelRun(Document):
     )
     time_started = DateTimeField()
     task_id = StringField()
+    group_id = StringField(help_text="ID of the celery group if submitted with other runs")
+
+    # The state of the task is copied from celery task events, so that
+    # runs can be searched by state without querying the result backend
+    state = StringField(help_text="State of the task, e.g. PENDING, STARTED, SUCCESS, FAILURE")
+    time_finished = DateTimeField(help_text="Time the task succeeded, failed or was revoked")
+    result_summary = StringField(
+        help_text="Short description of the task result, or the error if it failed"
+    )
 
     engine = StringField(
         max_length=6,
@@ -105,9 +190,113 @@ class ModelRun(Document):
     # The model area is defined by the GIS file referred to in the
     # control file for this run
     # 'Read GIS Location' is the command
-    model_area = PolygonField()
+    model_area = PolygonField(help_text="Extent of the 2D domain, in longitude and latitude")
     model = ReferenceField(Model, reverse_delete_rule=CASCADE)
 
     meta = {
+        'indexes': [
+            # Sort key for paginating the run list
+            ('time_started', 'id'),
+            'task_id',
+            'group_id',
+            'entry_point',
+            'state',
+            ('model', 'state'),
+            ('model', 'is_baseline'),
+            ('model', 'entry_point'),
+            # Spatial queries of the model area, optionally of baseline runs only
+            '(model_area',
+            ('is_baseline', '(model_area')
+        ],
+        'strict': False
+    }
+
+
+UPLOAD_STATES = (
+    ('receiving', 'Receiving'),
+    ('finalizing', 'Finalizing'),
+    ('complete', 'Complete'),
+    ('failed', 'Failed'),
+)
+
+class ByteRange(EmbeddedDocument):
+    '''The [start, end) byte range of a chunk of an upload
+    '''
+    start = IntField(required=True, min_value=0)
+    end = IntField(required=True, min_value=0)
+
+
+class Upload(Document):
+    '''A file being uploaded in chunks, which will be added to a model when complete.
+
+    The chunks may be sent in any order (and in parallel). The byte range of each
+    chunk which has been written is recorded in ``received``.
+    '''
+    length = IntField(required=True, min_value=1, help_text="Total size of the upload in bytes")
+    received = ListField(
+        EmbeddedDocumentField(ByteRange),
+        help_text="The byte ranges which have been received"
+    )
+    content_type = StringField(default='application/zip')
+    filename = StringField(help_text="Name of the file when it is not a zip archive")
+    model = ReferenceField(
+        Model,
+        reverse_delete_rule=CASCADE,
+        help_text="The model which the data is added to. A new model is created if not set"
+    )
+    state = StringField(choices=UPLOAD_STATES, default='receiving')
+    fid = StringField(help_text="Path ID of the saved file, or the model folder for an archive")
+    error = StringField(help_text="Why the upload could not be added to the model")
+    date_created = DateTimeField(default=datetime.datetime.now)
+    date_updated = DateTimeField(
+        default=datetime.datetime.now,
+        help_text="When a chunk was last received, or the upload was last changed"
+    )
+
+    meta = {
+        'indexes': [
+            # Finding abandoned uploads
+            ('state', 'date_updated')
+        ],
+        'strict': False
+    }
+
+    @property
+    def offset(self):
+        '''Number of bytes received from the start of the file without any gaps
+        '''
+        offset = 0
+        for byte_range in sorted(self.received, key=lambda r: (r.start, r.end)):
+            if byte_range.start > offset:
+                break
+            offset = max(offset, byte_range.end)
+        return offset
+
+
+JOB_STATES = (
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('complete', 'Complete'),
+    ('failed', 'Failed'),
+)
+
+class Job(Document):
+    '''A long running operation (e.g. listing a large folder) which continues in the
+    background after the request which started it has been answered.
+    '''
+    operation = StringField(required=True, help_text="Name of the operation, e.g. tree")
+    state = StringField(choices=JOB_STATES, default='queued')
+    progress = DictField(help_text="Progress reported by the operation, e.g bytes processed")
+    result = DictField(help_text="Result of the operation, e.g the location of its' output")
+    error = StringField(help_text="Why the operation failed")
+    date_created = DateTimeField(default=datetime.datetime.now)
+    date_started = DateTimeField()
+    date_finished = DateTimeField()
+
+    meta = {
+        'indexes': [
+            # Finished jobs are removed after a week
+            {'fields': ['date_finished'], 'expireAfterSeconds': 7 * 24 * 3600}
+        ],
         'strict': False
     }
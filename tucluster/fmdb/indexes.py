@@ -0,0 +1,61 @@
+'''Check that the queries made by the API are covered by an index
+'''
+import collections
+
+from tucluster.fmdb.documents import Model, ModelIndex, ModelRun
+
+Query = collections.namedtuple('Query', ['name', 'document', 'fields'])
+
+# The fields which each API query filters on by equality (or a spatial operator).
+# Queries by ``_id`` alone are always covered and not listed.
+API_QUERIES = (
+    Query('GET /models/{name}', Model, ['name']),
+    Query('GET /models (sorted)', Model, ['date_created']),
+    Query('GET /models/{name}/dependencies', ModelIndex, ['model']),
+    Query('GET /runs?entrypoint', ModelRun, ['entry_point']),
+    Query('GET /runs?model', ModelRun, ['model']),
+    Query('GET /runs?state', ModelRun, ['state']),
+    Query('GET /runs?group', ModelRun, ['group_id']),
+    Query('GET /runs?baseline', ModelRun, ['is_baseline']),
+    Query('GET /runs?model&state', ModelRun, ['model', 'state']),
+    Query('GET /runs?model&baseline', ModelRun, ['model', 'is_baseline']),
+    Query('GET /runs?model&entrypoint', ModelRun, ['model', 'entry_point']),
+    Query('GET /runs (sorted)', ModelRun, ['time_started']),
+    Query('GET /runs?intersects|bbox|near', ModelRun, ['model_area']),
+    Query('task state updates', ModelRun, ['task_id']),
+)
+
+
+def index_keys(document):
+    '''Return the key fields of each index of a document's collection, as they exist in
+    the database (mongoengine creates any missing indexes when the collection is first used)
+    '''
+    info = document._get_collection().index_information()
+    return [[field for field, _ in index['key']] for index in info.values()]
+
+
+def _db_fields(document, fields):
+    return [
+        '_id' if name in ('id', '_id') else document._fields[name].db_field
+        for name in fields
+    ]
+
+
+def uncovered_queries(queries=API_QUERIES):
+    '''Find the queries which are not covered by an index.
+
+    A query is covered if the first fields of an index are the fields it filters on
+    (in any order), so the database does not scan the whole collection.
+
+    Returns:
+        list: The ``Query`` tuples which are not covered
+    '''
+    keys = {}
+    uncovered = []
+    for query in queries:
+        if query.document not in keys:
+            keys[query.document] = index_keys(query.document)
+        fields = set(_db_fields(query.document, query.fields))
+        if not any(set(index[:len(fields)]) == fields for index in keys[query.document]):
+            uncovered.append(query)
+    return uncovered
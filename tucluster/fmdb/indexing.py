@@ -0,0 +1,103 @@
+'''Incremental, recursive discovery of model entry points
+'''
+import collections
+import os
+import time
+
+# Files which may be used as the entry point of a model run
+ENTRY_POINT_EXTENSIONS = ('.tcf', '.py')
+
+# Folders modified more recently than this (seconds) are listed again on the next scan,
+# since a further change within the mtime resolution would go unnoticed
+_RACY_INTERVAL = 1.0
+
+EntryPointScan = collections.namedtuple('EntryPointScan', ['entry_points', 'index', 'changed'])
+
+
+def _join(folder, name):
+    return '{}/{}'.format(folder, name) if folder else name
+
+
+def _list_folder(path, extensions):
+    subdirs, names = [], []
+    with os.scandir(path) as iterator:
+        for entry in iterator:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.name.lower().endswith(extensions):
+                    names.append(entry.name)
+            except OSError:
+                # Removed while scanning
+                continue
+    subdirs.sort()
+    names.sort()
+    return subdirs, names
+
+
+def scan_entry_points(root, index=None, extensions=ENTRY_POINT_EXTENSIONS):
+    '''Find the entry points in a folder and all its' sub folders.
+
+    The ``index`` from the previous scan records the modification time and contents of each
+    folder. Folders whose mtime is unchanged are not listed again, so rescanning an unchanged
+    model costs one ``stat`` per folder (and per entry point). Hidden folders are skipped.
+
+    Args:
+        root (str): The model folder
+        index (dict): Index returned by the previous scan of ``root``, if any
+        extensions (tuple): File extensions of entry points
+
+    Returns:
+        EntryPointScan: The sorted ``entry_points`` (paths relative to ``root`` separated by
+            ``/``), the new ``index`` and the entry points which were ``changed`` (added
+            or modified) since the previous scan. The index only holds lists, so it
+            can be stored in a mongo document.
+    '''
+    index = index or {}
+    old_folders = {
+        folder: (mtime, subdirs, names)
+        for folder, mtime, subdirs, names in index.get('folders', [])
+    }
+    old_files = {name: (size, mtime) for name, size, mtime in index.get('files', [])}
+
+    now = time.time()
+    folders, files, changed = [], [], []
+    stack = ['']
+    while stack:
+        folder = stack.pop()
+        path = os.path.join(root, folder) if folder else root
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+
+        cached = old_folders.get(folder)
+        if cached is not None and cached[0] == stat.st_mtime_ns:
+            _, subdirs, names = cached
+        else:
+            try:
+                subdirs, names = _list_folder(path, extensions)
+            except OSError:
+                continue
+        mtime = stat.st_mtime_ns if now - stat.st_mtime > _RACY_INTERVAL else None
+        folders.append([folder, mtime, subdirs, names])
+
+        for name in names:
+            relpath = _join(folder, name)
+            try:
+                file_stat = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            files.append([relpath, file_stat.st_size, file_stat.st_mtime_ns])
+            if old_files.get(relpath) != (file_stat.st_size, file_stat.st_mtime_ns):
+                changed.append(relpath)
+        stack.extend(_join(folder, name) for name in reversed(subdirs))
+
+    files.sort()
+    return EntryPointScan(
+        [name for name, _, _ in files],
+        {'folders': folders, 'files': files},
+        sorted(changed)
+    )
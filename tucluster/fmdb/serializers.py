@@ -1,6 +1,8 @@
 import os
-import json
+import stat as os_stat
+import fnmatch
 import base64
+from bson import json_util
 
 def id_from_path(path):
     ''' Converts a filepath string to a URL safe encoding
@@ -13,33 +15,141 @@ def path_from_id(path_id):
     return base64.urlsafe_b64decode(path_id).decode('utf-8')
 
 
-def directory_tree_serializer(path):
+def stream_json(queryset, batch_size=500, ndjson=False, chunk_size=64 * 1024):
+    '''Encode the documents of a queryset as JSON, one chunk at a time.
+
+    Documents are read from the database cursor in batches of ``batch_size``, so
+    memory use does not depend on the number of documents.
+
+    Args:
+        queryset (QuerySet): The documents to serialize
+        batch_size (int): Number of documents fetched per database round trip
+        ndjson (bool): If true, produce newline delimited JSON (one document per line)
+            instead of a JSON array
+        chunk_size (int): Approximate size of each yielded chunk, in bytes
+
+    Yields:
+        bytes: UTF-8 encoded JSON. Joined together, the chunks of a JSON array are
+            identical to ``queryset.to_json()``
+    '''
+    if ndjson:
+        separator, start, end = '\n', '', '\n'
+    else:
+        separator, start, end = ', ', '[', ']'
+
+    parts = [start]
+    size = 0
+    first = True
+    for doc in queryset.as_pymongo().batch_size(batch_size):
+        if not first:
+            parts.append(separator)
+        first = False
+        encoded = json_util.dumps(doc)
+        parts.append(encoded)
+        size += len(encoded)
+        if size >= chunk_size:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+            size = 0
+
+    if not ndjson or not first:
+        parts.append(end)
+    yield ''.join(parts).encode('utf-8')
+
+
+def scan_directory(path):
+    '''List the contents of a directory with a single ``os.scandir`` call.
+
+    Args:
+        path (str): Directory to list
+
+    Returns:
+        list: ``(name, is_dir, size, mtime)`` tuples, sorted by name.
+    '''
+    entries = []
+    with os.scandir(path) as iterator:
+        for entry in iterator:
+            try:
+                is_dir = entry.is_dir()
+                stat = entry.stat()
+            except OSError:
+                # Broken symlink or the entry was removed while scanning
+                continue
+            entries.append((entry.name, is_dir, stat.st_size, stat.st_mtime))
+    entries.sort()
+    return entries
+
+
+def _tree_node(path, name, is_dir, size, mtime):
+    return {
+        'type': 'folder' if is_dir else 'file',
+        'name': name,
+        'id': id_from_path(path),
+        'size': size,
+        'mtime': mtime
+    }
+
+
+def _add_children(node, path, depth, pattern, scan, offset=0, limit=None):
+    if depth is not None and depth <= 0:
+        return
+    try:
+        entries = scan(path)
+    except OSError:
+        entries = []
+
+    if pattern:
+        entries = [
+            entry for entry in entries
+            if entry[1] or fnmatch.fnmatch(entry[0], pattern)
+        ]
+    if offset or limit is not None:
+        node['total'] = len(entries)
+        end = None if limit is None else offset + limit
+        entries = entries[offset:end]
+
+    child_depth = None if depth is None else depth - 1
+    children = []
+    for name, is_dir, size, mtime in entries:
+        child_path = os.path.join(path, name)
+        child = _tree_node(child_path, name, is_dir, size, mtime)
+        if is_dir:
+            _add_children(child, child_path, child_depth, pattern, scan)
+        children.append(child)
+    node['children'] = children
+
+
+def directory_tree_serializer(path, depth=None, offset=0, limit=None, pattern=None,
+                              scan=scan_directory):
     '''Output a directory tree as a json representation
 
     Args:
 
-        fid (str): base64 encoding of root directory path (see ``path_from_id``)
+        path (str): Root directory path (see ``path_from_id``)
+        depth (int): Number of levels below ``path`` to include. ``None`` includes
+            the whole tree and ``0`` only describes ``path`` itself.
+        offset (int): Number of children of ``path`` to skip.
+        limit (int): Maximum number of children of ``path`` to include.
+        pattern (str): Only include files whose name matches this glob pattern.
+            Folders are always included.
+        scan (callable): Function listing a directory. See ``scan_directory``.
 
     Returns:
-        str: JSON representation of the directory tree. Each object has the following attributes:
+        dict: Representation of the directory tree. Each object has the following attributes:
             'type': file or folder
             'name': The base name of the file/folder
-            'path': Absolute path to the object.
-            'id': The URL-safe base64 encoding of the ``path``
+            'id': The URL-safe base64 encoding of the path
+            'size': Size in bytes
+            'mtime': Modification time as a POSIX timestamp
 
-            If 'type' is 'folder', then a 'children' attribute is also present. This is a list
-            containing all sub-folders/files
+            If 'type' is 'folder' and it is within ``depth``, then a 'children' attribute
+            is also present. This is a list containing all sub-folders/files, sorted by name.
+            When ``offset`` or ``limit`` are given, the root object has a 'total' attribute
+            with the number of children before pagination.
     '''
-    hierarchy = {
-        'type': 'folder',
-        'name': os.path.basename(path),
-        'id': id_from_path(path)
-    }
-    try:
-        hierarchy['children'] = [
-            directory_tree_serializer(os.path.join(path, contents))
-            for contents in os.listdir(path)
-        ]
-    except NotADirectoryError:
-        hierarchy['type'] = 'file'
+    stat = os.stat(path)
+    is_dir = os_stat.S_ISDIR(stat.st_mode)
+    hierarchy = _tree_node(path, os.path.basename(path), is_dir, stat.st_size, stat.st_mtime)
+    if is_dir:
+        _add_children(hierarchy, path, depth, pattern, scan, offset, limit)
     return hierarchy
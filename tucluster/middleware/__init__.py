@@ -0,0 +1 @@
+from tucluster.middleware import compression, metrics, profiling
@@ -0,0 +1,373 @@
+'''Compression of responses negotiated with ``Accept-Encoding``
+'''
+import hashlib
+import os
+import tempfile
+import threading
+import zlib
+import falcon
+from tucluster.resources import httputils
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Media types which are worth compressing, as well as all ``text/`` types
+COMPRESSIBLE_TYPES = frozenset([
+    'application/json',
+    'application/x-ndjson',
+    'application/xml',
+    'application/javascript',
+    'application/geo+json',
+    'image/svg+xml',
+])
+
+# Compressing these would delay each event until the compressor emits data
+UNBUFFERED_TYPES = frozenset(['text/event-stream'])
+
+_BLOCK_SIZE = 64 * 1024
+
+
+def _gzip_encoder(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+
+def _zstd_encoder(level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return compressor.compress, compressor.flush
+
+
+def _brotli_encoder(level):
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.finish
+
+
+# Supported encodings with their default level. The first
+# of these accepted by the client is used.
+ENCODINGS = (
+    ('zstd', _zstd_encoder, 3, zstandard is not None),
+    ('br', _brotli_encoder, 4, brotli is not None),
+    ('gzip', _gzip_encoder, 6, True),
+)
+
+
+def parse_accept_encoding(value):
+    '''Parse an ``Accept-Encoding`` header into a mapping of coding to quality
+    '''
+    qualities = {}
+    for item in value.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, number = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def _media_type(content_type):
+    return (content_type or '').split(';')[0].strip().lower()
+
+
+class CompressedFileCache(object):
+    '''Compressed variants of responses kept on disk, so that files which are downloaded
+    many times are only compressed once.
+
+    Entries are written to a temporary file while the response is sent, and only added
+    once complete. The least recently used entries are removed when the cache grows
+    beyond ``max_size`` bytes.
+
+    Args:
+        directory (str): Folder holding the cached files
+        max_size (int): Maximum total size of the cached files in bytes
+    '''
+    def __init__(self, directory, max_size=1024 ** 3):
+        self._directory = directory
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+    def _path(self, key, encoding):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, '{}.{}'.format(name, encoding))
+
+    def open(self, key, encoding):
+        '''Open the cached variant, or return ``None`` if there is none
+        '''
+        path = self._path(key, encoding)
+        try:
+            stream = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        # Record the use, for eviction
+        os.utime(path)
+        return stream
+
+    def writer(self, key, encoding):
+        '''Return a ``CacheWriter`` which adds a variant once committed
+        '''
+        os.makedirs(self._directory, exist_ok=True)
+        return CacheWriter(self, self._path(key, encoding))
+
+    def _add(self, tmp, path):
+        os.replace(tmp, path)
+        with self._lock:
+            entries = []
+            total = 0
+            with os.scandir(self._directory) as iterator:
+                for entry in iterator:
+                    if entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            entries.sort()
+            for _, size, old in entries:
+                if total <= self._max_size:
+                    break
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+                total -= size
+
+
+class CacheWriter(object):
+    def __init__(self, cache, path):
+        self._cache = cache
+        self._path = path
+        fd, self._tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+
+    def commit(self):
+        self._file.close()
+        self._cache._add(self._tmp, self._path)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp)
+        except OSError:
+            pass
+
+
+class CompressedBody(object):
+    '''Iterable which compresses a response body as it is sent.
+
+    Args:
+        source: File-like object or iterable of ``bytes`` giving the uncompressed body
+        encoder (tuple): ``(compress, finish)`` callables of the compressor
+        writer (CacheWriter): Optional writer which receives a copy of the compressed body
+    '''
+    def __init__(self, source, encoder, writer=None):
+        self._source = source
+        self._compress, self._finish = encoder
+        self._writer = writer
+
+    def _chunks(self):
+        if hasattr(self._source, 'read'):
+            while True:
+                chunk = self._source.read(_BLOCK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+        else:
+            for chunk in self._source:
+                yield chunk
+
+    def __iter__(self):
+        complete = False
+        try:
+            for chunk in self._chunks():
+                data = self._compress(chunk)
+                if data:
+                    if self._writer:
+                        self._writer.write(data)
+                    yield data
+            data = self._finish()
+            if self._writer:
+                self._writer.write(data)
+                self._writer.commit()
+                self._writer = None
+            complete = True
+            yield data
+        finally:
+            if not complete:
+                self.close()
+
+    def close(self):
+        if self._writer:
+            # The client went away before the whole body was sent
+            self._writer.abort()
+            self._writer = None
+        close = getattr(self._source, 'close', None)
+        if close is not None:
+            close()
+
+
+class CompressionMiddleware(object):
+    '''Compress response bodies with the best encoding accepted by the client:
+    zstd or brotli (if the ``zstandard`` or ``brotli`` packages are installed) or gzip.
+
+    Only textual media types are compressed (e.g. ``text/*``, JSON), and only if the body
+    is at least ``min_size`` bytes. Streamed bodies are compressed as they are sent.
+    Partial (range) responses are sent uncompressed.
+
+    A resource may set ``resp.context['compression_cache_key']`` to a key which
+    identifies the content, such as the path and ``ETag`` of a file. The compressed
+    variant is then cached and reused by later requests. A download of a compressed
+    variant can be resumed with a ``Range`` request whose ``If-Range`` is the ``ETag``
+    of the variant, while it is cached.
+
+    Args:
+        min_size (int): Smallest body, in bytes, which is compressed
+        encodings (list): Encodings which may be used, in order of preference.
+            Defaults to all available.
+        levels (dict): Compression level for each encoding, e.g ``{"gzip": 9}``
+        cache (CompressedFileCache): Optional cache of compressed files
+        max_file_size (int): Largest cacheable body (i.e. file download), in bytes,
+            which is compressed. Larger files are sent as they are, so their downloads can
+            always be resumed with range requests. ``None`` for no limit.
+    '''
+    def __init__(self, min_size=1024, encodings=None, levels=None, cache=None,
+                 max_file_size=None):
+        self._min_size = min_size
+        self._cache = cache
+        self._max_file_size = max_file_size
+        levels = levels or {}
+        available = {
+            name: (factory, levels.get(name, level))
+            for name, factory, level, installed in ENCODINGS if installed
+        }
+        order = encodings or [name for name, _, _, _ in ENCODINGS]
+        self._encodings = [(name,) + available[name] for name in order if name in available]
+        self._etag_suffixes = tuple('-{}"'.format(name) for name, _, _ in self._encodings)
+
+    def _choose(self, accept_encoding):
+        qualities = parse_accept_encoding(accept_encoding or '')
+        best = None
+        for name, factory, level in self._encodings:
+            quality = qualities.get(name, qualities.get('*', 0.0))
+            if quality > 0 and (best is None or quality > best[0]):
+                best = (quality, name, factory, level)
+        return best[1:] if best else None
+
+    def process_request(self, req, resp):
+        # Entity tags of compressed responses have a suffix, which is removed so that
+        # the resource compares the tag of its' uncompressed representation
+        if_none_match = req.env.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and self._etag_suffixes:
+            tags = []
+            for tag in if_none_match.split(','):
+                tag = tag.strip()
+                for suffix in self._etag_suffixes:
+                    if tag.endswith(suffix):
+                        tag = tag[:-len(suffix)] + '"'
+                        break
+                tags.append(tag)
+            req.env['HTTP_IF_NONE_MATCH'] = ', '.join(tags)
+
+    def _length(self, resp):
+        if resp.body is not None:
+            return len(resp.body)
+        if resp.data is not None:
+            return len(resp.data)
+        if resp.stream is not None:
+            return resp.stream_len
+        return 0
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        media_type = _media_type(resp.content_type)
+        compressible = (
+            media_type in COMPRESSIBLE_TYPES or
+            (media_type.startswith('text/') and media_type not in UNBUFFERED_TYPES)
+        )
+        if not compressible:
+            return
+        resp.append_header('Vary', 'Accept-Encoding')
+
+        length = self._length(resp)
+        if (req.method == 'HEAD' or not resp.status.startswith('200') or
+                resp.get_header('Content-Encoding') or
+                (length is not None and length < self._min_size)):
+            return
+        key = resp.context.get('compression_cache_key')
+        if (key and self._max_file_size is not None and length is not None and
+                length > self._max_file_size):
+            return
+
+        choice = self._choose(req.get_header('Accept-Encoding'))
+        if choice is None:
+            return
+        name, factory, level = choice
+
+        resp.set_header('Content-Encoding', name)
+        etag = resp.etag
+        if etag and etag.endswith('"'):
+            resp.etag = '{}-{}"'.format(etag[:-1], name)
+
+        if resp.body is not None or resp.data is not None:
+            body = resp.body if resp.body is not None else resp.data
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+            compress, finish = factory(level)
+            resp.body = None
+            resp.data = compress(body) + finish()
+            return
+
+        writer = None
+        if key and self._cache is not None:
+            cached = self._cache.open(key, name)
+            if cached is not None:
+                close = getattr(resp.stream, 'close', None)
+                if close is not None:
+                    close()
+                size = os.fstat(cached.fileno()).st_size
+                if not self._send_range(req, resp, cached, size):
+                    resp.set_stream(cached, size)
+                return
+            writer = self._cache.writer(key, name)
+
+        resp.stream = CompressedBody(resp.stream, factory(level), writer)
+        resp.stream_len = None
+
+    def _send_range(self, req, resp, cached, size):
+        '''Send a single range of a cached variant, if it was requested with an ``If-Range``
+        matching the ``ETag`` of the variant (the resource only compares its' own ``ETag``).
+
+        Returns:
+            bool: Whether a range is sent
+        '''
+        value = req.get_header('Range')
+        if not value or not resp.etag or req.if_range != resp.etag:
+            return False
+        try:
+            ranges = httputils.parse_range(value, size)
+        except falcon.HTTPRangeNotSatisfiable:
+            return False
+        if not ranges or len(ranges) > 1:
+            return False
+        start, end = ranges[0]
+        resp.status = falcon.HTTP_PARTIAL_CONTENT
+        resp.content_range = (start, end, size)
+        resp.set_stream(httputils.RangeReader(cached, start, end - start + 1), end - start + 1)
+        return True
@@ -0,0 +1,223 @@
+'''Prometheus metrics of requests, database commands and celery result lookups
+
+Requires the ``prometheus_client`` package. When the API is served by several worker
+processes (e.g. gunicorn), set the ``PROMETHEUS_MULTIPROC_DIR`` environment variable to an
+empty folder shared by the workers before they start. ``/metrics`` then reports the combined
+metrics of all the workers, whichever worker answers it.
+'''
+import os
+import threading
+import time
+import falcon
+from pymongo import monitoring
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+# Buckets of the response size histogram, in bytes
+SIZE_BUCKETS = (256, 4096, 65536, 1048576, 16777216, 268435456, 4294967296, float('inf'))
+
+# Route of the request being handled by each thread, used to label database commands
+_local = threading.local()
+
+
+def current_route():
+    '''The route of the request being handled by this thread, if any
+    '''
+    return getattr(_local, 'route', None) or 'none'
+
+
+def multiprocess_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir')
+
+
+class Metrics(object):
+    '''The metrics recorded by tucluster.
+
+    Args:
+        registry: ``prometheus_client`` registry to add the metrics to. Defaults to the
+            global registry.
+    '''
+    def __init__(self, registry=None):
+        registry = registry or prometheus_client.REGISTRY
+        self.requests = prometheus_client.Counter(
+            'tucluster_requests_total', 'Requests handled',
+            ['method', 'route', 'status'], registry=registry
+        )
+        self.latency = prometheus_client.Histogram(
+            'tucluster_request_duration_seconds',
+            'Time to handle a request. Streamed bodies are sent afterwards.',
+            ['method', 'route'], registry=registry
+        )
+        self.response_size = prometheus_client.Histogram(
+            'tucluster_response_size_bytes', 'Size of response bodies',
+            ['method', 'route'], buckets=SIZE_BUCKETS, registry=registry
+        )
+        self.streamed = prometheus_client.Counter(
+            'tucluster_streamed_bytes_total', 'Bytes of streamed response bodies (e.g. files) sent',
+            ['route'], registry=registry
+        )
+        self.mongo = prometheus_client.Histogram(
+            'tucluster_mongo_command_duration_seconds', 'Time taken by MongoDB commands',
+            ['route', 'command'], registry=registry
+        )
+        self.celery = prometheus_client.Histogram(
+            'tucluster_celery_lookup_duration_seconds',
+            'Time to look up task states in the celery result backend',
+            ['route'], registry=registry
+        )
+
+    def observe_celery_lookup(self, seconds):
+        self.celery.labels(current_route()).observe(seconds)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    '''Record the duration of each MongoDB command, labelled by the route of the request
+    which made it. Register it with ``pymongo.monitoring.register`` before connecting.
+    '''
+    def __init__(self, metrics):
+        self._metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._observe(event)
+
+    def failed(self, event):
+        self._observe(event)
+
+    def _observe(self, event):
+        self._metrics.mongo.labels(current_route(), event.command_name).observe(
+            event.duration_micros / 1e6
+        )
+
+
+class _CountingStream(object):
+    '''Wrap a streamed body to count the bytes sent, recording the count when it is closed.
+
+    The body is produced after ``process_response`` (e.g. a list read from MongoDB in
+    batches), so the route of the request is set while each chunk is produced and cleared
+    when the body is closed.
+    '''
+    def __init__(self, stream, record, route):
+        self._stream = stream
+        self._record = record
+        self._route = route
+        self._count = 0
+
+    def _produce(self, produce, *args):
+        previous = getattr(_local, 'route', None)
+        _local.route = self._route
+        try:
+            return produce(*args)
+        finally:
+            _local.route = previous
+
+    def close(self):
+        if self._record is not None:
+            self._record(self._count)
+            self._record = None
+        close = getattr(self._stream, 'close', None)
+        if close is not None:
+            self._produce(close)
+        _local.route = None
+
+
+class _CountingReader(_CountingStream):
+    def read(self, size=-1):
+        data = self._produce(self._stream.read, size)
+        self._count += len(data)
+        return data
+
+
+class _CountingIterable(_CountingStream):
+    def __iter__(self):
+        chunks = iter(self._stream)
+        while True:
+            try:
+                chunk = self._produce(next, chunks)
+            except StopIteration:
+                return
+            self._count += len(chunk)
+            yield chunk
+
+
+class MetricsMiddleware(object):
+    '''Record the count, latency and response size of requests per route, and the bytes of
+    streamed bodies as they are sent.
+
+    This should be the first middleware, so that it times the others and counts the bytes
+    actually sent (e.g. after compression).
+
+    Args:
+        metrics (Metrics): The metrics to record
+    '''
+    def __init__(self, metrics):
+        self._metrics = metrics
+
+    def process_request(self, req, resp):
+        req.context['metrics_start'] = time.perf_counter()
+        _local.route = None
+
+    def process_resource(self, req, resp, resource, params):
+        # The URI template of the route, e.g ``/files/{fid}``
+        _local.route = req.uri_template
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        route = current_route()
+        _local.route = None
+        start = req.context.get('metrics_start')
+        if start is not None:
+            self._metrics.latency.labels(req.method, route).observe(time.perf_counter() - start)
+        self._metrics.requests.labels(req.method, route, resp.status.split(' ', 1)[0]).inc()
+
+        if resp.body is not None or resp.data is not None:
+            body = resp.body if resp.body is not None else resp.data
+            size = len(body.encode('utf-8') if isinstance(body, str) else body)
+            self._metrics.response_size.labels(req.method, route).observe(size)
+        elif resp.stream is not None:
+            self._count_stream(req, resp, route)
+
+    def _count_stream(self, req, resp, route):
+        def record(count):
+            self._metrics.streamed.labels(route).inc(count)
+            self._metrics.response_size.labels(req.method, route).observe(count)
+
+        stream = resp.stream
+        if hasattr(stream, 'fileno') and resp.stream_len is not None:
+            # Keep the file descriptor for ``wsgi.file_wrapper`` (sendfile)
+            record(resp.stream_len)
+        elif hasattr(stream, 'read'):
+            resp.stream = _CountingReader(stream, record, route)
+        else:
+            resp.stream = _CountingIterable(stream, record, route)
+
+
+class MetricsResource(object):
+    '''Expose the metrics in the Prometheus text format
+    '''
+    def __init__(self, registry=None):
+        self._registry = registry
+
+    def on_get(self, req, resp):
+        '''Retrieve the metrics for Prometheus.
+
+        Example::
+
+            http localhost:8000/metrics
+        '''
+        registry = self._registry
+        if registry is None:
+            if multiprocess_dir():
+                # Combine the metrics written by every worker process
+                registry = prometheus_client.CollectorRegistry()
+                multiprocess.MultiProcessCollector(registry)
+            else:
+                registry = prometheus_client.REGISTRY
+        resp.content_type = prometheus_client.CONTENT_TYPE_LATEST
+        resp.data = prometheus_client.generate_latest(registry)
+        resp.status = falcon.HTTP_OK
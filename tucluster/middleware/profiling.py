@@ -0,0 +1,254 @@
+'''Profile individual requests, to find out why a request is slow.
+
+A profiled request records a ``cProfile`` profile of the thread handling it, the time taken
+by each MongoDB command it makes and the number of filesystem calls it makes (from the
+``open``, ``os.*`` and ``shutil.*`` audit events). If the request takes longer than a
+threshold, two files are saved: ``<name>.prof``, which can be read with ``pstats`` or
+``snakeviz``, and ``<name>.json``, with the request, its' duration, MongoDB commands and
+filesystem call counts. Audit events need python 3.8 or later. On older versions, the
+calls to the ``posix.*`` and ``io.open`` builtins in the profile are counted instead.
+
+A streamed response is profiled while each chunk of it is produced, and the profile is
+saved once it has been sent. Work done by other threads (e.g. tree walks in the
+``JobExecutor`` pool) is not included.
+'''
+import cProfile
+import collections
+import datetime
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from pymongo import monitoring
+
+# Profile of the request being handled by each thread
+_local = threading.local()
+
+# Audit events counted as filesystem calls
+_FS_EVENTS = re.compile(r'^(open|os\.\w+|shutil\.\w+|glob\.glob|tempfile\.mkstemp)$')
+
+# Builtins counted as filesystem calls when there are no audit events
+_FS_BUILTINS = re.compile(r'^<built-in method (posix\.\w+|io\.open)>$')
+
+_hooks_lock = threading.Lock()
+_hooks_installed = False
+
+
+class _Profile(object):
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.mongo = []
+        self.filesystem = collections.Counter()
+        self.start = time.perf_counter()
+
+
+def _builtin_filesystem_calls(profiler):
+    '''Count the calls to filesystem builtins recorded by a profiler
+    '''
+    profiler.create_stats()
+    calls = collections.Counter()
+    for (filename, _, function), stats in profiler.stats.items():
+        match = _FS_BUILTINS.match(function)
+        if filename == '~' and match:
+            calls[match.group(1)] += stats[1]
+    return calls
+
+
+def _audit(event, args):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None and _FS_EVENTS.match(event):
+        profile.filesystem[event] += 1
+
+
+class _MongoListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event, 'ok')
+
+    def failed(self, event):
+        self._record(event, 'failed')
+
+    def _record(self, event, outcome):
+        profile = getattr(_local, 'profile', None)
+        if profile is not None:
+            profile.mongo.append({
+                'command': event.command_name,
+                'database': event.database_name,
+                'ms': event.duration_micros / 1000.0,
+                'outcome': outcome
+            })
+
+
+def install_hooks():
+    '''Install the audit hook and MongoDB command listener used by profiled requests.
+
+    Audit hooks can't be removed and listeners must be registered before connecting to
+    the database, so this is done once per process, before connecting. Both do nothing
+    for requests which are not profiled.
+    '''
+    global _hooks_installed
+    with _hooks_lock:
+        if not _hooks_installed:
+            if hasattr(sys, 'addaudithook'):
+                sys.addaudithook(_audit)
+            monitoring.register(_MongoListener())
+            _hooks_installed = True
+
+
+class _ProfiledBody(object):
+    '''Wrap a streamed body to profile the production of each chunk, finishing the
+    profile when the body is closed. Chunks may be produced by different threads.
+    '''
+    def __init__(self, stream, profile, finish):
+        self._stream = stream
+        self._profile = profile
+        self._finish = finish
+
+    def _produce(self, produce, *args):
+        profiler = self._profile.profiler
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active in this thread
+            profiler = None
+        previous = getattr(_local, 'profile', None)
+        _local.profile = self._profile
+        try:
+            return produce(*args)
+        finally:
+            _local.profile = previous
+            if profiler is not None:
+                profiler.disable()
+
+    def close(self):
+        close = getattr(self._stream, 'close', None)
+        if close is not None:
+            self._produce(close)
+        if self._finish is not None:
+            finish, self._finish = self._finish, None
+            finish()
+
+
+class _ProfiledReader(_ProfiledBody):
+    def read(self, size=-1):
+        return self._produce(self._stream.read, size)
+
+
+class _ProfiledIterable(_ProfiledBody):
+    def __iter__(self):
+        chunks = iter(self._stream)
+        while True:
+            try:
+                chunk = self._produce(next, chunks)
+            except StopIteration:
+                return
+            yield chunk
+
+
+class ProfilingMiddleware(object):
+    '''Profile requests which send the ``header``, and a random ``sample_rate`` fraction
+    of other requests.
+
+    Profiled requests taking ``threshold`` seconds or longer are saved to ``directory``,
+    keeping the ``keep`` most recent. Requests which asked to be profiled with the header
+    are always saved, and the name of the saved files is returned in the header.
+
+    Args:
+        directory (str): Folder to save profiles in
+        header (str): Request header which turns on profiling, e.g ``X-Profile``. ``None``
+            to only profile sampled requests.
+        sample_rate (float): Fraction of requests to profile, between 0 and 1
+        threshold (float): Seconds a profiled request must take to be saved
+        keep (int): Number of saved profiles to keep
+    '''
+    def __init__(self, directory, header='X-Profile', sample_rate=0.0, threshold=1.0, keep=100):
+        install_hooks()
+        self._directory = directory
+        self._header = header
+        self._sample_rate = sample_rate
+        self._threshold = threshold
+        self._keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+    def process_request(self, req, resp):
+        requested = self._header is not None and req.get_header(self._header) is not None
+        if not requested and (not self._sample_rate or random.random() >= self._sample_rate):
+            return
+        profile = _Profile()
+        try:
+            profile.profiler.enable()
+        except ValueError:
+            # Another profiler is active in this thread
+            return
+        req.context['profile'] = profile
+        req.context['profile_requested'] = requested
+        _local.profile = profile
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        profile = req.context.pop('profile', None)
+        if profile is None:
+            return
+        profile.profiler.disable()
+        _local.profile = None
+        requested = req.context.pop('profile_requested')
+        # The header is sent before a streamed body, so the name can't include its' duration
+        name = '{}-{}-{}'.format(
+            datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f'),
+            req.method,
+            re.sub(r'[^\w.-]+', '_', req.uri_template or req.path).strip('_') or 'root'
+        )
+        if requested:
+            resp.set_header(self._header, name)
+
+        def finish():
+            seconds = time.perf_counter() - profile.start
+            if requested or seconds >= self._threshold:
+                self._save(req, resp, profile, name, seconds)
+
+        if resp.body is not None or resp.data is not None or resp.stream is None:
+            finish()
+        elif hasattr(resp.stream, 'read'):
+            resp.stream = _ProfiledReader(resp.stream, profile, finish)
+        else:
+            resp.stream = _ProfiledIterable(resp.stream, profile, finish)
+
+    def _save(self, req, resp, profile, name, seconds):
+        path = os.path.join(self._directory, name)
+        profile.profiler.dump_stats(path + '.prof')
+        filesystem = profile.filesystem
+        if not hasattr(sys, 'addaudithook'):
+            filesystem = _builtin_filesystem_calls(profile.profiler)
+        with open(path + '.json', 'w') as summary:
+            json.dump({
+                'method': req.method,
+                'uri': req.relative_uri,
+                'route': req.uri_template,
+                'status': resp.status,
+                'seconds': seconds,
+                'mongo': {
+                    'count': len(profile.mongo),
+                    'ms': sum(command['ms'] for command in profile.mongo),
+                    'commands': profile.mongo
+                },
+                'filesystem': dict(filesystem)
+            }, summary, indent=2)
+        self._prune()
+
+    def _prune(self):
+        '''Remove the oldest saved profiles, keeping ``keep``
+        '''
+        names = sorted(
+            name[:-len('.json')] for name in os.listdir(self._directory)
+            if name.endswith('.json')
+        )
+        for name in names[:max(len(names) - self._keep, 0)]:
+            for extension in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self._directory, name + extension))
+                except FileNotFoundError:
+                    pass
@@ -1 +1,4 @@
-from tucluster.resources import models, runs, tasks, utils, files
\ No newline at end of file
+from tucluster.resources import (
+    models, runs, tasks, utils, files, httputils, cache, pagination, events,
+    archive, uploads, geo, jobs
+)
@@ -0,0 +1,442 @@
+'''Extraction and creation of zip archives as they are streamed
+
+The central directory of a zip archive is at its' end, so ``zipfile`` needs the whole
+archive on a seekable file. Instead, the entries are read here in order from their local
+file headers, so an upload can be extracted while it is received, without first
+being written to disk.
+
+Archives of a folder are likewise generated a chunk at a time for download.
+'''
+import bz2
+import fnmatch
+import os
+import struct
+import time
+import zipfile
+import zlib
+
+_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_LOCAL_SIGNATURE = b'PK\x03\x04'
+_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+# Signatures of the records after the last entry (central directory, digital
+# signature, zip64 end of central directory and end of central directory)
+_END_SIGNATURES = (b'PK\x01\x02', b'PK\x05\x05', b'PK\x06\x06', b'PK\x05\x06')
+
+_STORED = 0
+_DEFLATED = 8
+_BZIP2 = 12
+
+_FLAG_ENCRYPTED = 0x01
+_FLAG_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+
+_ZIP64_LIMIT = 0xFFFFFFFF
+
+# Files which are already compressed are stored rather than deflated again
+STORED_EXTENSIONS = frozenset([
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar',
+    '.png', '.jpg', '.jpeg', '.gif', '.ecw', '.jp2', '.mp4'
+])
+
+
+class BadZipStream(ValueError):
+    '''The stream is not a zip archive, is corrupt or uses unsupported features
+    '''
+
+
+class _Input(object):
+    '''Buffered reader over the archive stream which supports pushing data back
+    '''
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._buffer = b''
+        # Total bytes consumed from the archive
+        self.position = 0
+
+    def read(self, size):
+        '''Read up to ``size`` bytes. Returns ``b''`` only at the end of the stream.
+        '''
+        if not self._buffer:
+            self._buffer = self._stream.read(max(size, self._chunk_size)) or b''
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.position += len(data)
+        return data
+
+    def read_exact(self, size):
+        parts = []
+        remaining = size
+        while remaining:
+            data = self.read(remaining)
+            if not data:
+                raise BadZipStream('Unexpected end of archive')
+            parts.append(data)
+            remaining -= len(data)
+        return b''.join(parts)
+
+    def unread(self, data):
+        self._buffer = data + self._buffer
+        self.position -= len(data)
+
+
+class ZipEntry(object):
+    '''A single file in the archive. ``read`` returns the uncompressed data.
+
+    The CRC of the data is checked once it has all been read.
+    '''
+    def __init__(self, source, name, method, flags, crc, compress_size, file_size):
+        self.name = name
+        self.is_dir = name.endswith('/')
+        # Uncompressed size, or ``None`` if it is only given after the data
+        self.size = None
+        self._source = source
+        self._method = method
+        self._flags = flags
+        self._crc = crc
+        # Bytes of uncompressed data read so far
+        self._file_size = 0
+        self._running_crc = 0
+        self._pending = b''
+        self._done = False
+
+        # With a data descriptor, the sizes in the local header are usually zero and
+        # the end of the data must be found from the data itself
+        if flags & _FLAG_DESCRIPTOR and compress_size in (0, _ZIP64_LIMIT):
+            self._compressed_remaining = None
+            self._expected_size = None
+        else:
+            self._compressed_remaining = compress_size
+            self._expected_size = self.size = file_size
+
+        if method == _STORED:
+            self._decompressor = None
+        elif method == _DEFLATED:
+            self._decompressor = zlib.decompressobj(-15)
+        elif method == _BZIP2:
+            self._decompressor = bz2.BZ2Decompressor()
+        else:
+            raise BadZipStream('{}: unsupported compression method {}'.format(name, method))
+
+    def _read_compressed(self, size):
+        if self._compressed_remaining is not None:
+            size = min(size, self._compressed_remaining)
+            if not size:
+                return b''
+        data = self._source.read(size)
+        if not data:
+            raise BadZipStream('{}: unexpected end of archive'.format(self.name))
+        if self._compressed_remaining is not None:
+            self._compressed_remaining -= len(data)
+        return data
+
+    def _read_stored_until_descriptor(self, size):
+        '''Stored data of unknown size ends at a data descriptor holding its' CRC and size
+        '''
+        while True:
+            index = self._pending.find(_DESCRIPTOR_SIGNATURE)
+            while index != -1:
+                # Signature, CRC and 32 or 64 bit sizes
+                if len(self._pending) < index + 24:
+                    break
+                crc, size32 = struct.unpack('<II', self._pending[index + 4:index + 12])
+                size64, = struct.unpack('<Q', self._pending[index + 8:index + 16])
+                crc_so_far = zlib.crc32(self._pending[:index], self._running_crc)
+                length = self._file_size + index
+                if crc == crc_so_far and length in (size32, size64):
+                    data = self._pending[:index]
+                    # Leave the descriptor to be read by ``_finish``
+                    self._source.unread(self._pending[index:])
+                    self._pending = b''
+                    self._done = True
+                    return data
+                index = self._pending.find(_DESCRIPTOR_SIGNATURE, index + 1)
+            else:
+                # No possible descriptor. Keep back enough bytes to match a signature
+                # split across reads.
+                if len(self._pending) > size + 3:
+                    data = self._pending[:size]
+                    self._pending = self._pending[size:]
+                    return data
+            chunk = self._source.read(64 * 1024)
+            if not chunk:
+                raise BadZipStream('{}: unexpected end of archive'.format(self.name))
+            self._pending += chunk
+
+    def _read_chunk(self, size):
+        if self._method == _STORED:
+            if self._compressed_remaining is None:
+                return self._read_stored_until_descriptor(size)
+            data = self._read_compressed(size)
+            if not data:
+                self._done = True
+            return data
+
+        decompressor = self._decompressor
+        while True:
+            if decompressor.eof:
+                self._source.unread(decompressor.unused_data)
+                self._done = True
+                return b''
+            # Output is limited to ``size`` bytes per call, so memory use is bounded
+            # even for very highly compressed data
+            if self._method == _DEFLATED:
+                compressed = decompressor.unconsumed_tail or self._read_compressed(64 * 1024)
+            elif decompressor.needs_input:
+                compressed = self._read_compressed(64 * 1024)
+            else:
+                compressed = b''
+            if not compressed and (self._method == _DEFLATED or decompressor.needs_input):
+                raise BadZipStream('{}: truncated compressed data'.format(self.name))
+            try:
+                data = decompressor.decompress(compressed, size)
+            except (zlib.error, OSError, EOFError) as error:
+                raise BadZipStream('{}: {}'.format(self.name, error))
+            if data:
+                return data
+
+    def read(self, size=-1):
+        '''Read up to ``size`` bytes of the uncompressed file
+        '''
+        if self._done:
+            return b''
+        if size is None or size < 0:
+            size = 1024 * 1024
+        data = self._read_chunk(size)
+        self._running_crc = zlib.crc32(data, self._running_crc)
+        self._file_size += len(data)
+        if self._done:
+            self._finish()
+        return data
+
+    def _finish(self):
+        crc, file_size = self._crc, self._expected_size
+        if self._flags & _FLAG_DESCRIPTOR:
+            head = self._source.read_exact(4)
+            if head != _DESCRIPTOR_SIGNATURE:
+                # The descriptor signature is optional
+                self._source.unread(head)
+            crc, = struct.unpack('<I', self._source.read_exact(4))
+            # The sizes are 4 bytes each, or 8 bytes for zip64 archives. In the first
+            # case the next record of the archive immediately follows.
+            sizes = self._source.read_exact(12)
+            if sizes[8:12] in (_LOCAL_SIGNATURE,) + _END_SIGNATURES:
+                file_size, = struct.unpack('<I', sizes[4:8])
+                self._source.unread(sizes[8:])
+            else:
+                sizes += self._source.read_exact(4)
+                file_size, = struct.unpack('<Q', sizes[8:16])
+        if crc != self._running_crc:
+            raise BadZipStream('{}: CRC check failed'.format(self.name))
+        if file_size is not None and file_size != self._file_size:
+            raise BadZipStream('{}: size check failed'.format(self.name))
+
+    @property
+    def archive_position(self):
+        '''Number of bytes read from the archive so far
+        '''
+        return self._source.position
+
+    def drain(self):
+        '''Read and discard the rest of the entry
+        '''
+        while self.read(1024 * 1024):
+            pass
+
+
+def _zip64_sizes(extra, compress_size, file_size):
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack('<HH', extra[offset:offset + 4])
+        if header_id == 0x0001:
+            data = extra[offset + 4:offset + 4 + size]
+            values = []
+            for index in range(0, len(data) - 7, 8):
+                values.append(struct.unpack('<Q', data[index:index + 8])[0])
+            if file_size == _ZIP64_LIMIT and values:
+                file_size = values.pop(0)
+            if compress_size == _ZIP64_LIMIT and values:
+                compress_size = values.pop(0)
+            break
+        offset += 4 + size
+    return compress_size, file_size
+
+
+def iter_zip_stream(stream):
+    '''Iterate over the entries of a zip archive read sequentially from ``stream``.
+
+    Each ``ZipEntry`` must be read before the next one is produced; any unread data
+    is skipped automatically.
+
+    Args:
+        stream: File-like object with a ``read`` method. It need not be seekable.
+
+    Yields:
+        ZipEntry: The entries in the order they are stored
+
+    Raises:
+        BadZipStream: The archive is corrupt, encrypted or uses an unsupported
+            compression method.
+    '''
+    source = _Input(stream)
+    first = True
+    while True:
+        signature = source.read(4)
+        if len(signature) < 4 and signature:
+            signature += source.read_exact(4 - len(signature))
+        if signature in _END_SIGNATURES or (not signature and not first):
+            return
+        if signature != _LOCAL_SIGNATURE:
+            raise BadZipStream('Not a zip archive, or the archive is corrupt')
+        first = False
+
+        (_, _, flags, method, _, _, crc, compress_size, file_size,
+         name_length, extra_length) = _LOCAL_HEADER.unpack(
+             signature + source.read_exact(_LOCAL_HEADER.size - 4)
+         )
+        raw_name = source.read_exact(name_length)
+        extra = source.read_exact(extra_length)
+        name = raw_name.decode('utf-8' if flags & _FLAG_UTF8 else 'cp437')
+
+        if flags & _FLAG_ENCRYPTED:
+            raise BadZipStream('{}: encrypted archives are not supported'.format(name))
+        compress_size, file_size = _zip64_sizes(extra, compress_size, file_size)
+
+        entry = ZipEntry(source, name, method, flags, crc, compress_size, file_size)
+        yield entry
+        entry.drain()
+
+
+def entry_path(root, name):
+    '''Return the path an archive entry should be extracted to, or ``None`` if the
+    entry would be outside ``root`` (e.g. ``../../etc/passwd``).
+    '''
+    parts = [
+        part for part in name.replace('\\', '/').split('/')
+        if part and part != '.'
+    ]
+    if not parts or '..' in parts or ':' in parts[0]:
+        return None
+    return os.path.join(root, *parts)
+
+
+def extract_stream(stream, root, write, progress=None):
+    '''Extract a zip archive read from ``stream`` into the folder ``root``.
+
+    Args:
+        stream: File-like object from which the archive is read
+        root (str): Destination folder
+        write (callable): ``write(path, fileobj, size)`` saves the data read from ``fileobj``
+            to ``path``, where ``size`` is the size of the file if known. E.g ``DataStore._write``.
+        progress (callable): Optional ``progress(path, bytes_read)`` called after each
+            file is extracted, where ``bytes_read`` is the archive bytes read so far.
+
+    Returns:
+        int: Number of files extracted
+    '''
+    count = 0
+    for entry in iter_zip_stream(stream):
+        path = entry_path(root, entry.name)
+        if path is None:
+            continue
+        if entry.is_dir:
+            os.makedirs(path, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write(path, entry, entry.size)
+        count += 1
+        if progress:
+            progress(path, entry.archive_position)
+    return count
+
+
+class _ZipOutput(object):
+    '''Unseekable file for ``zipfile.ZipFile`` which holds the written data until it is taken
+    '''
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _walk_files(root, pattern=None):
+    for folder, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(folder, name)
+            if pattern and not fnmatch.fnmatch(name, pattern):
+                continue
+            if os.path.islink(path):
+                # A link may point outside the storage location
+                continue
+            yield path, os.path.relpath(path, root).replace(os.sep, '/')
+
+
+def _zip_info(path, arcname):
+    '''Build the ``ZipInfo`` of a file, like ``ZipInfo.from_file`` with
+    ``strict_timestamps=False`` (which needs python 3.8).
+    '''
+    stat = os.stat(path)
+    date_time = time.localtime(stat.st_mtime)[:6]
+    # The zip format can't store times before 1980 or after 2107
+    if date_time[0] < 1980:
+        date_time = (1980, 1, 1, 0, 0, 0)
+    elif date_time[0] > 2107:
+        date_time = (2107, 12, 31, 23, 59, 59)
+    info = zipfile.ZipInfo(arcname, date_time)
+    info.external_attr = (stat.st_mode & 0xFFFF) << 16
+    info.file_size = stat.st_size
+    return info
+
+
+def stream_zip(root, pattern=None, compression=zipfile.ZIP_STORED, chunk_size=64 * 1024):
+    '''Generate a zip archive of the files in a folder, a chunk at a time.
+
+    The archive is written with data descriptors, so it never needs to be seeked or held in
+    memory. Memory use is bounded by ``chunk_size`` regardless of the size of the files.
+
+    Args:
+        root (str): The folder to archive. Paths in the archive are relative to it.
+        pattern (str): Only include files whose name matches this glob pattern
+        compression (int): ``zipfile.ZIP_STORED`` or ``zipfile.ZIP_DEFLATED``. Files
+            which are already compressed (e.g. ``.zip``, ``.png``) are always stored.
+        chunk_size (int): Size of each read from the files
+
+    Yields:
+        bytes: The next part of the archive
+    '''
+    output = _ZipOutput()
+    with zipfile.ZipFile(output, mode='w', compression=compression, allowZip64=True) as archive:
+        for path, arcname in _walk_files(root, pattern):
+            try:
+                info = _zip_info(path, arcname)
+                source = open(path, 'rb')
+            except OSError:
+                # Removed since the folder was listed
+                continue
+            if os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = compression
+
+            with source, archive.open(info, mode='w') as target:
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    data = output.take()
+                    if data:
+                        yield data
+            yield output.take()
+    # The central directory
+    yield output.take()
@@ -0,0 +1,128 @@
+'''In-process caches used by the resources
+'''
+import collections
+import json
+import os
+import threading
+import time
+from tucluster.fmdb.serializers import scan_directory
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class LRUCache(object):
+    '''A thread safe mapping holding at most ``maxsize`` items.
+
+    The least recently used item is evicted when the cache is full.
+    '''
+    def __init__(self, maxsize=1024):
+        self._maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+                return self._items[key]
+            except KeyError:
+                return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class DirectoryCache(object):
+    '''Cache of directory listings, validated against the directory modification time.
+
+    ``scan`` is a drop in replacement for ``serializers.scan_directory``. A cached
+    listing is reused as long as the directory mtime is unchanged, so serializing a
+    tree only costs one ``stat`` per folder unless something in it changed.
+    Only the folders which did change are listed again.
+
+    Note that the mtime of a folder changes when entries are added, removed or renamed,
+    but not when an existing file is rewritten in place. The size and mtime of such a
+    file are refreshed the next time its' folder changes.
+
+    Listings are kept in process, and optionally shared between processes (e.g. gunicorn
+    workers) through redis.
+
+    Args:
+        size (int): Maximum number of directory listings held in process
+        redis (str): Optional URL of a redis database, e.g. ``redis://localhost:6379/1``
+        ttl (int): Expiry time of listings stored in redis, in seconds
+    '''
+    # Listings of folders modified more recently than this (seconds) are not
+    # cached, since a further change within the mtime resolution would go unnoticed
+    _RACY_INTERVAL = 1.0
+
+    def __init__(self, size=1024, redis=None, ttl=86400, prefix='tucluster:tree:'):
+        self._local = LRUCache(size)
+        self._ttl = ttl
+        self._prefix = prefix
+        self._redis = None
+        if redis:
+            self._redis = _redis_client(redis)
+
+    def _get(self, path):
+        cached = self._local.get(path)
+        if cached is None and self._redis is not None:
+            value = self._redis.get(self._prefix + path)
+            if value is not None:
+                mtime_ns, entries = json.loads(value.decode('utf-8'))
+                cached = (mtime_ns, [tuple(entry) for entry in entries])
+                self._local.set(path, cached)
+        return cached
+
+    def _set(self, path, mtime_ns, entries):
+        self._local.set(path, (mtime_ns, entries))
+        if self._redis is not None:
+            self._redis.set(
+                self._prefix + path,
+                json.dumps([mtime_ns, entries]),
+                ex=self._ttl
+            )
+
+    def scan(self, path):
+        '''List the contents of a directory. See ``serializers.scan_directory``.
+        '''
+        stat = os.stat(path)
+        cached = self._get(path)
+        if cached is not None and cached[0] == stat.st_mtime_ns:
+            return cached[1]
+
+        entries = scan_directory(path)
+        if time.time() - stat.st_mtime > self._RACY_INTERVAL:
+            self._set(path, stat.st_mtime_ns, entries)
+        return entries
+
+    def invalidate(self, path):
+        '''Remove the cached listing of a directory
+        '''
+        self._local.pop(path)
+        if self._redis is not None:
+            self._redis.delete(self._prefix + path)
+
+
+def _redis_client(url):
+    if redis is None:
+        raise ImportError('The redis package is required to share the tree cache through redis')
+    return redis.StrictRedis.from_url(url)
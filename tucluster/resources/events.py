@@ -0,0 +1,248 @@
+'''Push notification of task state changes, using celery task events
+'''
+import collections
+import json
+import queue
+import threading
+import time
+import falcon
+
+# Task state after each type of celery task event
+EVENT_STATES = {
+    'task-sent': 'PENDING',
+    'task-received': 'RECEIVED',
+    'task-started': 'STARTED',
+    'task-succeeded': 'SUCCESS',
+    'task-failed': 'FAILURE',
+    'task-rejected': 'REJECTED',
+    'task-revoked': 'REVOKED',
+    'task-retried': 'RETRY',
+}
+
+# Longest time a long-poll request may wait, in seconds
+MAX_WAIT = 60
+
+
+class Subscription(object):
+    '''Queue of task events for a single client.
+
+    If the client falls behind and the queue fills up, new events are dropped
+    and ``overflowed`` is set.
+    '''
+    def __init__(self, task_ids=None, maxsize=1000):
+        self.task_ids = set(task_ids) if task_ids else None
+        self.overflowed = False
+        self._queue = queue.Queue(maxsize)
+
+    def put(self, event):
+        if self.task_ids is not None and event['id'] not in self.task_ids:
+            return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        '''Return the next event, or ``None`` if none arrived within ``timeout`` seconds
+        '''
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def drain(self):
+        '''Return all events which are waiting, without blocking
+        '''
+        events = []
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                return events
+
+
+class TaskEventBroker(object):
+    '''Receives celery task events and fans them out to subscribers.
+
+    A single daemon thread per process consumes the events. It is started by the first
+    subscription (or ``start``), and reconnects if the connection to the celery broker
+    is lost. Recent events are kept so that clients which reconnect can catch up.
+
+    Celery workers must be sending events (``worker_send_task_events``/``send_events``
+    and ``task_send_sent_event`` in the celery configuration).
+
+    Args:
+        app (celery.Celery): The celery application
+        history (int): Number of recent events to keep
+        reconnect_interval (float): Seconds to wait before reconnecting after an error
+    '''
+    def __init__(self, app, history=1000, reconnect_interval=5):
+        self._app = app
+        self._reconnect_interval = reconnect_interval
+        self._subscriptions = set()
+        self._listeners = []
+        self._history = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        '''Start consuming task events, if not already started
+        '''
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='task-events', daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self._app.connection() as connection:
+                    receiver = self._app.events.Receiver(
+                        connection, handlers={'*': self._on_event}
+                    )
+                    receiver.capture(limit=None, timeout=None, wakeup=True)
+            except Exception:
+                # Keep the thread alive through broker restarts
+                time.sleep(self._reconnect_interval)
+
+    def _on_event(self, event):
+        state = EVENT_STATES.get(event.get('type'))
+        if state is None:
+            # Worker heartbeats etc.
+            return
+        self.publish({
+            'id': event['uuid'],
+            'state': state,
+            'type': event['type'],
+            'timestamp': event.get('timestamp', time.time()),
+            'result': event.get('result'),
+            'exception': event.get('exception')
+        })
+
+    def publish(self, event):
+        '''Send a task event to all subscribers and listeners.
+
+        Args:
+            event (dict): Has at least the ``id``, ``state`` and ``timestamp`` of the task
+        '''
+        with self._lock:
+            self._history.append(event)
+            subscriptions = list(self._subscriptions)
+            listeners = list(self._listeners)
+        for subscription in subscriptions:
+            subscription.put(event)
+        for listener in listeners:
+            listener(event)
+
+    def add_listener(self, callback):
+        '''Call ``callback(event)`` in the consumer thread for every task event.
+        This also starts the consumer.
+        '''
+        with self._lock:
+            self._listeners.append(callback)
+        self.start()
+
+    def subscribe(self, task_ids=None, since=None):
+        '''Create a ``Subscription`` to the events of the given tasks (or all tasks).
+
+        Args:
+            task_ids (list): Only receive events for these task ids
+            since (float): Also receive recent events with a later timestamp than this
+        '''
+        subscription = Subscription(task_ids)
+        with self._lock:
+            if since is not None:
+                for event in self._history:
+                    if event['timestamp'] > since:
+                        subscription.put(event)
+            self._subscriptions.add(subscription)
+        self.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+
+class TaskEvents(object):
+    '''Notify clients of task state changes as they happen
+    '''
+    # Seconds between keep-alive comments on an idle event stream
+    _HEARTBEAT = 15
+
+    def __init__(self, broker):
+        # ``TaskEventBroker`` shared by all requests in this process
+        self._broker = broker
+
+    def on_get(self, req, resp):
+        '''Wait for task state changes.
+
+        Clients accepting ``text/event-stream`` receive a Server-Sent Events stream,
+        with one ``task`` event per state change. Other clients are answered by
+        long-polling: the response is sent as soon as there are events (or the ``wait``
+        time elapses) and is a JSON list of events.
+
+        Each event has the attributes ``id`` (the task id), ``state`` (e.g ``STARTED``,
+        ``SUCCESS``), ``type`` (the celery event type) and ``timestamp``.
+
+        The following optional query parameters are accepted:
+
+            - ``ids``: Comma separated task ids. Only events for these tasks are sent.
+            - ``since``: Timestamp of the last event received. Recent events after this
+                are sent straight away, so nothing is missed between polls. SSE clients
+                reconnecting with a ``Last-Event-ID`` header are handled the same way.
+            - ``wait``: Long-polling only. Maximum seconds to wait (default and maximum 60).
+
+        Note that each open request holds a server thread, so a threaded or asynchronous
+        server should be used for many concurrent clients.
+
+        Example::
+
+            http --stream localhost:8000/tasks/events Accept:text/event-stream
+            http localhost:8000/tasks/events ids==id1,id2 wait==30
+        '''
+        task_ids = req.get_param_as_list('ids')
+        since = req.get_param('since') or req.get_header('Last-Event-ID')
+        try:
+            since = float(since) if since else None
+        except ValueError:
+            raise falcon.HTTPBadRequest(description='since must be a timestamp')
+
+        subscription = self._broker.subscribe(task_ids, since)
+        if 'text/event-stream' in (req.accept or ''):
+            resp.content_type = 'text/event-stream'
+            resp.set_header('Cache-Control', 'no-cache')
+            resp.stream = self._event_stream(subscription)
+        else:
+            wait = req.get_param_as_int('wait', min=0, max=MAX_WAIT)
+            try:
+                events = self._poll(subscription, MAX_WAIT if wait is None else wait)
+            finally:
+                self._broker.unsubscribe(subscription)
+            resp.body = json.dumps(events)
+        resp.status = falcon.HTTP_OK
+
+    def _poll(self, subscription, wait):
+        events = subscription.drain()
+        if not events:
+            event = subscription.get(timeout=wait)
+            if event is not None:
+                events = [event] + subscription.drain()
+        return events
+
+    def _event_stream(self, subscription):
+        try:
+            yield b'retry: 3000\n\n'
+            while True:
+                event = subscription.get(timeout=self._HEARTBEAT)
+                if event is None:
+                    # Comment lines keep proxies from closing an idle connection
+                    yield b': keep-alive\n\n'
+                    continue
+                yield 'id: {}\nevent: task\ndata: {}\n\n'.format(
+                    event['timestamp'], json.dumps(event)
+                ).encode('utf-8')
+        finally:
+            self._broker.unsubscribe(subscription)
@@ -1,8 +1,21 @@
 '''HTTP interface to user uploaded files and model result files
 '''
+import hashlib
 import json
+import mimetypes
+import os
+import zipfile
+from urllib.parse import quote
 import falcon
+from tucluster.conf import settings
 from tucluster.fmdb import serializers
+from tucluster.resources import archive, httputils
+
+# Compression methods accepted by ``/files/zip/{fid}``
+ZIP_COMPRESSION = {
+    'store': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED
+}
 
 
 class FileItem(object):
@@ -15,6 +28,12 @@ class FileItem(object):
     def on_get(self, req, resp, fid):
         '''Return the requested file as a stream.
 
+        Byte range requests are supported (including multiple ranges, which are
+        returned as ``multipart/byteranges``), so interrupted downloads can be resumed.
+        The response carries ``ETag`` and ``Last-Modified`` headers; sending these back
+        in ``If-None-Match`` or ``If-Modified-Since`` gives a ``304 Not Modified``
+        response if the file is unchanged.
+
         Args:
             fid (str): The file id. This is a URL safe base64 representation
                 of the file path. The representation can be got by first querying
@@ -23,42 +42,195 @@ class FileItem(object):
         Example::
 
                 http --download localhost:8000/files/{fid}
+                http localhost:8000/files/{fid} Range:bytes=0-1023
         '''
         try:
-            resp.stream, resp.stream_len, resp.content_type = self._data_store.open(fid)
+            stat = self._data_store.stat(fid)
         except PermissionError as error:
             resp.status = falcon.HTTP_BAD_REQUEST
             resp.body = str(error)
+            return
+
+        etag = httputils.file_etag(stat)
+        last_modified = httputils.file_last_modified(stat)
+        resp.etag = etag
+        resp.last_modified = last_modified
+        resp.accept_ranges = 'bytes'
+        if httputils.not_modified(req, etag, last_modified):
+            resp.status = falcon.HTTP_NOT_MODIFIED
+            return
+
+        serving = settings['FILE_SERVING']
+        if serving in ('x-accel-redirect', 'x-sendfile'):
+            # Let the fronting web server send the file (and handle any ranges)
+            self._offload(resp, fid, serving)
+            return
+
+        ranges = httputils.requested_ranges(req, stat.st_size, etag, last_modified)
+        stream, stream_len, content_type = self._data_store.open(fid)
+        if not ranges:
+            resp.stream, resp.stream_len, resp.content_type = stream, stream_len, content_type
+            # The file is identified by its' path and ETag, so compressed copies can be reused
+            resp.context['compression_cache_key'] = '{}:{}'.format(fid, etag)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            if serving == 'sendfile':
+                reader = httputils.SendfileRangeReader(stream, start, end - start + 1)
+            else:
+                reader = httputils.RangeReader(stream, start, end - start + 1)
+            resp.status = falcon.HTTP_PARTIAL_CONTENT
+            resp.content_range = (start, end, stream_len)
+            resp.content_type = content_type
+            resp.set_stream(reader, end - start + 1)
+        else:
+            body = httputils.MultipartRanges(stream, ranges, stream_len, content_type)
+            resp.status = falcon.HTTP_PARTIAL_CONTENT
+            resp.content_type = body.content_type
+            resp.set_stream(body, body.length)
+
+    def _offload(self, resp, fid, serving):
+        '''Respond with a header instructing nginx (``X-Accel-Redirect``) or
+        Apache/lighttpd (``X-Sendfile``) to send the file instead of the worker.
+        '''
+        path = self._data_store.validate_fid(fid)
+        if serving == 'x-accel-redirect':
+            prefix = settings['FILE_SERVING_PREFIX'].rstrip('/')
+            relpath = self._data_store.relpath(fid).replace(os.sep, '/')
+            resp.set_header('X-Accel-Redirect', '{}/{}'.format(prefix, quote(relpath)))
+        else:
+            resp.set_header('X-Sendfile', path)
+        resp.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        resp.data = b''
 
 
 class Tree(FileItem):
     '''Serialize a directory tree.
     This is used to explore results folders, uploaded input folders etc.
     '''
+    def __init__(self, data_store, cache=None, executor=None):
+        super(Tree, self).__init__(data_store)
+        # Optional ``DirectoryCache`` used to avoid listing unchanged folders
+        self._cache = cache
+        # Optional ``JobExecutor`` which walks the tree, so a huge folder can't block
+        # the request thread
+        self._executor = executor
+
     def on_get(self, req, resp, fid):
         ''' Return a JSON representation of the directory tree. The JSON response has the
         following attributes:
 
             - ``type``: file or folder
             - ``name``: The base name of the file/folder
-            - ``path``: Absolute path to the object.
-            - ``id``: URL-safe base64 encoding of the ``path``
-            - ``children``: Only present if ``type`` is ``folder``. A list of all
-                children of this folder, each having the same representation.
+            - ``id``: URL-safe base64 encoding of the path
+            - ``size``: Size in bytes
+            - ``mtime``: Modification time as a POSIX timestamp
+            - ``children``: Only present if ``type`` is ``folder`` and the folder is within
+                the requested ``depth``. A list of all children of this folder, sorted by
+                name, each having the same representation.
+            - ``total``: Only present on the root folder if ``offset`` or ``limit`` are
+                given. The number of children before pagination.
 
         Args:
             fid (str): the base64 encoded url safe ID for the path to the root folder
 
+        The following optional query parameters are accepted:
+
+            - ``depth``: Number of levels to include. ``depth=1`` lists only the immediate
+                children, allowing clients to expand large folders one level at a time.
+            - ``offset``, ``limit``: Paginate the children of the root folder.
+            - ``glob``: Only include files matching this pattern, e.g. ``*_d_Max.flt``.
+
+        The response has an ``ETag`` header. Sending it back in ``If-None-Match``
+        gives a ``304 Not Modified`` response if the tree has not changed.
+
+        If walking the tree takes too long, the response is ``202 Accepted`` with the location
+        of a job (``/jobs/{id}``) which walks the tree in the background. Once the job is
+        complete, repeat the request (the ``location`` in the job ``result``). The folders
+        listed by the job are then cached, so the repeated request is quick.
+
         Example::
 
             http localhost:8000/files/tree/{fid}
+            http localhost:8000/files/tree/{fid} depth==1 offset==0 limit==100
 
         '''
         try:
             self._data_store.validate_fid(fid)
-            resp.status = falcon.HTTP_OK
-            path = serializers.path_from_id(fid)
-            resp.body = json.dumps(serializers.directory_tree_serializer(path))
         except PermissionError as error:
             resp.status = falcon.HTTP_BAD_REQUEST
             resp.body = str(error)
+            return
+
+        depth = req.get_param_as_int('depth', min=0)
+        offset = req.get_param_as_int('offset', min=0) or 0
+        limit = req.get_param_as_int('limit', min=0)
+        pattern = req.get_param('glob')
+
+        path = serializers.path_from_id(fid)
+        scan = self._cache.scan if self._cache else serializers.scan_directory
+        args = (path,)
+        kwargs = dict(depth=depth, offset=offset, limit=limit, pattern=pattern, scan=scan)
+        if self._executor is not None:
+            tree = self._executor.run(
+                'tree', serializers.directory_tree_serializer, *args,
+                location=req.relative_uri, **kwargs
+            )
+        else:
+            tree = serializers.directory_tree_serializer(*args, **kwargs)
+        body = json.dumps(tree)
+
+        resp.etag = '"{}"'.format(hashlib.md5(body.encode('utf-8')).hexdigest())
+        if httputils.not_modified(req, resp.etag):
+            resp.status = falcon.HTTP_NOT_MODIFIED
+            return
+
+        resp.status = falcon.HTTP_OK
+        resp.body = body
+
+
+class FolderArchive(FileItem):
+    '''Download a whole folder as a zip archive
+    '''
+    def on_get(self, req, resp, fid):
+        '''Stream a zip archive of all the files in a folder (and its' sub folders).
+
+        The archive is generated as it is sent, so the download starts straight away and the
+        server memory use does not depend on the size of the folder. The response has no
+        ``Content-Length``, and ranges are not supported.
+
+        Args:
+            fid (str): the base64 encoded url safe ID of the folder
+
+        The following optional query parameters are accepted:
+
+            - ``compression``: ``store`` (the default) or ``deflate``. Storing is much faster,
+                deflating gives a smaller download for e.g. ascii grids. Files which are already
+                compressed are always stored.
+            - ``glob``: Only include files matching this pattern, e.g. ``*_d_Max.flt``.
+
+        Example::
+
+            http --download localhost:8000/files/zip/{fid} glob==*_d_Max.flt compression==deflate
+        '''
+        try:
+            path = self._data_store.validate_fid(fid)
+        except PermissionError as error:
+            resp.status = falcon.HTTP_BAD_REQUEST
+            resp.body = str(error)
+            return
+        if not os.path.isdir(path):
+            raise falcon.HTTPBadRequest(description='{} is not a folder'.format(fid))
+
+        method = req.get_param('compression') or 'store'
+        if method not in ZIP_COMPRESSION:
+            raise falcon.HTTPBadRequest(
+                description='compression must be one of store, deflate'
+            )
+
+        resp.status = falcon.HTTP_OK
+        resp.content_type = 'application/zip'
+        name = os.path.basename(path.rstrip(os.sep)) or 'data'
+        resp.set_header('Content-Disposition', 'attachment; filename="{}.zip"'.format(name))
+        resp.stream = archive.stream_zip(
+            path, pattern=req.get_param('glob'), compression=ZIP_COMPRESSION[method]
+        )
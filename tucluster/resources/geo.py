@@ -0,0 +1,129 @@
+'''Spatial query parameters for list resources
+'''
+import json
+import falcon
+
+# Query parameters which select documents by location
+GEO_PARAMS = ('intersects', 'bbox', 'near')
+
+
+def _param(req, name):
+    # Comma separated values are split into a list by falcon
+    value = req.params.get(name)
+    return ','.join(value) if isinstance(value, list) else value
+
+
+def _numbers(req, name, count):
+    value = _param(req, name)
+    try:
+        numbers = [float(number) for number in value.split(',')]
+    except ValueError:
+        numbers = []
+    if len(numbers) != count:
+        raise falcon.HTTPBadRequest(
+            description='{} must be {} comma separated numbers'.format(name, count)
+        )
+    return numbers
+
+
+def _point(req, name):
+    lon, lat = _numbers(req, name, 2)
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        raise falcon.HTTPBadRequest(description='{} must be a longitude,latitude'.format(name))
+    return {'type': 'Point', 'coordinates': [lon, lat]}
+
+
+def _geometry(req, name):
+    value = _param(req, name)
+    if not value.lstrip().startswith('{'):
+        return _point(req, name)
+    try:
+        geometry = json.loads(value)
+    except ValueError:
+        geometry = None
+    if not isinstance(geometry, dict) or 'type' not in geometry or 'coordinates' not in geometry:
+        raise falcon.HTTPBadRequest(description='{} must be a GeoJSON geometry'.format(name))
+    return geometry
+
+
+def geo_filter(req, field):
+    '''Build a query on a GeoJSON field from the spatial query parameters of a request:
+
+    - ``intersects``: A ``longitude,latitude`` point or a GeoJSON geometry which
+        the area must intersect
+    - ``bbox``: ``min longitude,min latitude,max longitude,max latitude`` of a box
+        which the area must lie within
+    - ``near``: A ``longitude,latitude`` point. Results are sorted by distance from the
+        point (unless ``sort`` is given) and may be limited to ``distance`` metres.
+        This can't be combined with ``intersects`` or ``bbox``.
+
+    The field should have a ``2dsphere`` index.
+
+    Args:
+        req (falcon.Request): The incoming request
+        field (str): Database name of the GeoJSON field
+
+    Returns:
+        dict: Raw query, or ``None`` if no spatial parameters were given
+    '''
+    query = {}
+    if req.get_param('intersects'):
+        query.setdefault(field, {})['$geoIntersects'] = {
+            '$geometry': _geometry(req, 'intersects')
+        }
+    if req.get_param('bbox'):
+        west, south, east, north = _numbers(req, 'bbox', 4)
+        if west >= east or south >= north:
+            raise falcon.HTTPBadRequest(description='bbox must be west,south,east,north')
+        query.setdefault(field, {})['$geoWithin'] = {'$geometry': {
+            'type': 'Polygon',
+            'coordinates': [[[west, south], [east, south], [east, north],
+                             [west, north], [west, south]]]
+        }}
+    if req.get_param('near'):
+        if query:
+            raise falcon.HTTPBadRequest(
+                description='near can not be combined with intersects or bbox'
+            )
+        near = {'$geometry': _point(req, 'near')}
+        distance = req.get_param_as_int('distance', min=0)
+        if distance is not None:
+            near['$maxDistance'] = distance
+        query[field] = {'$near': near}
+    return query or None
+
+
+def is_near(query):
+    '''Return whether a query built by ``geo_filter`` sorts by distance
+    '''
+    return bool(query) and any('$near' in condition for condition in query.values())
+
+
+def distinct_matches(collection, query, key):
+    '''Return the distinct values of ``key`` in the documents matching a query built by
+    ``geo_filter``, without loading the documents. Documents without the key are ignored.
+
+    ``$near`` can't be used with ``distinct``, so it is done with a ``$geoNear`` aggregation.
+
+    Args:
+        collection (pymongo.collection.Collection): The collection to query
+        query (dict): Raw query returned by ``geo_filter``
+        key (str): Database name of the field
+
+    Returns:
+        list: The values of the field
+    '''
+    if not is_near(query):
+        return [value for value in collection.distinct(key, query) if value is not None]
+    (field, condition), = query.items()
+    stage = {
+        'near': condition['$near']['$geometry'],
+        'key': field,
+        'distanceField': '_distance',
+        'spherical': True,
+        'query': {key: {'$ne': None}}
+    }
+    if '$maxDistance' in condition['$near']:
+        stage['maxDistance'] = condition['$near']['$maxDistance']
+    pipeline = [{'$geoNear': stage}, {'$group': {'_id': '$' + key}}]
+    return [doc['_id'] for doc in collection.aggregate(pipeline)]
@@ -0,0 +1,254 @@
+'''HTTP helpers for streamed, conditional and partial (range) responses
+'''
+import datetime
+import uuid
+import falcon
+from tucluster.fmdb import serializers
+
+# Requests asking for more ranges than this are answered with the
+# whole representation rather than a very fragmented multipart body
+MAX_RANGES = 32
+
+
+def file_etag(stat):
+    '''Create a strong entity tag for a file from its' ``os.stat`` result.
+
+    The tag changes whenever the file is modified or resized, which is
+    sufficient for model inputs and results which are written once.
+    '''
+    return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def file_last_modified(stat):
+    '''Return the modification time of a file as a naive UTC ``datetime``,
+    truncated to whole seconds as required by HTTP dates.
+    '''
+    return datetime.datetime.utcfromtimestamp(int(stat.st_mtime))
+
+
+def stream_documents(req, resp, queryset):
+    '''Stream the documents of ``queryset`` as the response body.
+
+    The documents are sent as a JSON array unless the client asks for newline
+    delimited JSON, either with ``Accept: application/x-ndjson`` or ``format=ndjson``.
+    '''
+    ndjson = (
+        req.get_param('format') == 'ndjson' or
+        'application/x-ndjson' in (req.accept or '')
+    )
+    resp.content_type = 'application/x-ndjson' if ndjson else falcon.MEDIA_JSON
+    resp.stream = serializers.stream_json(queryset, ndjson=ndjson)
+
+
+def _etag_list(value):
+    return [tag.strip() for tag in value.split(',') if tag.strip()]
+
+
+def _weak_equal(tag1, tag2):
+    if tag1.startswith('W/'):
+        tag1 = tag1[2:]
+    if tag2.startswith('W/'):
+        tag2 = tag2[2:]
+    return tag1 == tag2
+
+
+def _header_date(req, header):
+    try:
+        return req.get_header_as_datetime(header)
+    except falcon.HTTPInvalidHeader:
+        # An invalid date is treated as if the header was absent
+        return None
+
+
+def not_modified(req, etag, last_modified=None):
+    '''Evaluate the ``If-None-Match`` and ``If-Modified-Since`` preconditions.
+
+    Args:
+        req (falcon.Request): The incoming request
+        etag (str): Entity tag of the current representation
+        last_modified (datetime): Modification time of the current representation
+
+    Returns:
+        bool: True if the client copy is current and a 304 response should be sent.
+    '''
+    if_none_match = req.if_none_match
+    if if_none_match:
+        # If-Modified-Since is ignored when If-None-Match is given (RFC 7232, 3.3)
+        tags = _etag_list(if_none_match)
+        return '*' in tags or any(_weak_equal(tag, etag) for tag in tags)
+
+    if last_modified is not None and req.method in ('GET', 'HEAD'):
+        since = _header_date(req, 'If-Modified-Since')
+        if since is not None:
+            return last_modified <= since
+
+    return False
+
+
+def parse_range(value, length):
+    '''Parse the value of a ``Range`` header.
+
+    Args:
+        value (str): The header value, e.g. ``bytes=0-99,200-``
+        length (int): Length of the representation in bytes
+
+    Returns:
+        list: Sorted, non-overlapping ``(first, last)`` byte positions (inclusive),
+            or ``None`` if the header should be ignored and the whole representation
+            sent. This is the case for malformed headers and unknown range units.
+
+    Raises:
+        falcon.HTTPRangeNotSatisfiable: None of the ranges overlap the representation
+    '''
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        if not sep:
+            return None
+        try:
+            if not first:
+                # Suffix range: the final N bytes
+                suffix = int(last)
+                if suffix <= 0 or length == 0:
+                    continue
+                ranges.append((max(length - suffix, 0), length - 1))
+            else:
+                start = int(first)
+                end = int(last) if last.strip() else length - 1
+                if start < 0 or end < start:
+                    return None
+                if start >= length:
+                    continue
+                ranges.append((start, min(end, length - 1)))
+        except ValueError:
+            return None
+
+    if not ranges:
+        raise falcon.HTTPRangeNotSatisfiable(length)
+
+    # Coalesce overlapping and adjacent ranges
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        prev_start, prev_end = merged[-1]
+        if start <= prev_end + 1:
+            merged[-1] = (prev_start, max(prev_end, end))
+        else:
+            merged.append((start, end))
+
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def requested_ranges(req, length, etag, last_modified=None):
+    '''Return the byte ranges requested by the client, if any.
+
+    ``If-Range`` is honoured, so a client resuming a download of a file which
+    has since changed receives the whole new file.
+
+    Returns:
+        list: See ``parse_range``. ``None`` means send the whole representation.
+    '''
+    value = req.get_header('Range')
+    if not value:
+        return None
+
+    if_range = req.if_range
+    if if_range:
+        if if_range.startswith(('"', 'W/')):
+            # Weak tags never match in If-Range (RFC 7233, 3.2)
+            if if_range.startswith('W/') or if_range != etag:
+                return None
+        else:
+            since = _header_date(req, 'If-Range')
+            if since is None or last_modified is None or last_modified != since:
+                return None
+
+    return parse_range(value, length)
+
+
+class RangeReader(object):
+    '''File-like wrapper which reads ``length`` bytes of ``stream`` starting
+    at ``start``.
+    '''
+    def __init__(self, stream, start, length):
+        self._stream = stream
+        self._remaining = length
+        stream.seek(start)
+
+    def read(self, size=-1):
+        if self._remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._stream.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._stream.close()
+
+
+class SendfileRangeReader(RangeReader):
+    '''``RangeReader`` which exposes the file descriptor of the underlying file.
+
+    A ``wsgi.file_wrapper`` which supports ``os.sendfile`` (such as gunicorn's) will
+    then send the range straight from the page cache, starting at the current file
+    offset and stopping after ``Content-Length`` bytes.
+    '''
+    def fileno(self):
+        return self._stream.fileno()
+
+
+class MultipartRanges(object):
+    '''A ``multipart/byteranges`` body for several ranges of a single file.
+
+    The parts are read lazily from ``stream`` as the body is iterated.
+    '''
+    _BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, stream, ranges, length, content_type=None):
+        self._stream = stream
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/byteranges; boundary={}'.format(self.boundary)
+
+        part_type = content_type or 'application/octet-stream'
+        self._parts = []
+        for start, end in ranges:
+            head = (
+                '\r\n--{boundary}\r\n'
+                'Content-Type: {ctype}\r\n'
+                'Content-Range: bytes {start}-{end}/{length}\r\n\r\n'
+            ).format(
+                boundary=self.boundary, ctype=part_type,
+                start=start, end=end, length=length
+            ).encode('ascii')
+            self._parts.append((head, start, end - start + 1))
+        self._tail = '\r\n--{}--\r\n'.format(self.boundary).encode('ascii')
+
+        self.length = sum(len(head) + size for head, _, size in self._parts) + len(self._tail)
+
+    def __iter__(self):
+        try:
+            for head, start, size in self._parts:
+                yield head
+                reader = RangeReader(self._stream, start, size)
+                while True:
+                    chunk = reader.read(self._BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            yield self._tail
+        finally:
+            self.close()
+
+    def close(self):
+        self._stream.close()
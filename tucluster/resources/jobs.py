@@ -0,0 +1,296 @@
+'''A bounded thread pool for blocking filesystem operations (walking large folder trees,
+extracting archives, removing folders), so they can't occupy every server thread.
+
+Operations which take longer than a request should wait are tracked as a ``Job``, and the
+client receives a ``202 Accepted`` response with the location of the job.
+'''
+import collections
+import concurrent.futures
+import datetime
+import json
+import threading
+import time
+import falcon
+from mongoengine import ValidationError
+
+
+class QueueFull(falcon.HTTPServiceUnavailable):
+    '''Raised when an operation is submitted while the queue of a ``JobExecutor`` is full
+    '''
+
+
+class OperationMetrics(object):
+    '''Queue depth, counts and latency of one kind of operation
+    '''
+    def __init__(self):
+        # Submitted operations which are waiting for a thread
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        # Rejected because the queue was full
+        self.rejected = 0
+        # Not finished in time, so continued as a job
+        self.deferred = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self.max_run_seconds = 0.0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class _Task(object):
+    def __init__(self):
+        self.job_id = None
+
+
+class ProgressReporter(object):
+    '''Record the progress of a job, writing it to the database at most every ``interval`` seconds
+    '''
+    def __init__(self, job_document, job_id, interval=1.0):
+        self._document = job_document
+        self._job_id = job_id
+        self._interval = interval
+        self._written = 0.0
+        self.progress = {}
+
+    def __call__(self, **progress):
+        self.progress.update(progress)
+        now = time.monotonic()
+        if now - self._written >= self._interval:
+            self._written = now
+            self._document.objects(id=self._job_id).update_one(set__progress=self.progress)
+
+
+class JobExecutor(object):
+    '''Run blocking operations in a shared, bounded thread pool.
+
+    Args:
+        job_document: The ``Job`` document class, used to track deferred operations
+        workers (int): Number of threads
+        max_queue (int): Number of operations which may wait for a thread. Operations
+            submitted when the queue is full are rejected with ``503 Service Unavailable``.
+        wait (float): Seconds a request waits for an operation before it is continued
+            as a job (see ``run``)
+    '''
+    # Seconds a client is asked to wait before retrying a rejected request
+    RETRY_AFTER = 5
+
+    def __init__(self, job_document, workers=4, max_queue=64, wait=5.0):
+        self._document = job_document
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='tucluster-jobs'
+        )
+        self.workers = workers
+        self.max_queue = max_queue
+        self._wait = wait
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._metrics = collections.defaultdict(OperationMetrics)
+
+    def metrics(self):
+        '''Return a snapshot of the ``OperationMetrics`` of each operation, as dicts
+        '''
+        with self._lock:
+            return {name: metrics.as_dict() for name, metrics in self._metrics.items()}
+
+    def submit(self, operation, func, *args, **kwargs):
+        '''Queue ``func(*args, **kwargs)`` to run in the pool.
+
+        Returns:
+            concurrent.futures.Future: The result of ``func``
+
+        Raises:
+            QueueFull: A ``503 Service Unavailable`` error, if the queue is full
+        '''
+        return self._submit(operation, _Task(), func, args, kwargs)
+
+    def _submit(self, operation, task, func, args, kwargs):
+        with self._lock:
+            metrics = self._metrics[operation]
+            if self._queued >= self.max_queue:
+                metrics.rejected += 1
+                raise QueueFull(
+                    description='The server is busy, please try again later',
+                    retry_after=self.RETRY_AFTER
+                )
+            self._queued += 1
+            metrics.queued += 1
+        submitted = time.monotonic()
+
+        def run():
+            started = time.monotonic()
+            with self._lock:
+                self._queued -= 1
+                metrics.queued -= 1
+                metrics.running += 1
+                metrics.wait_seconds += started - submitted
+            if task.job_id is not None:
+                self._document.objects(id=task.job_id).update_one(
+                    set__state='running', set__date_started=datetime.datetime.now()
+                )
+            succeeded = False
+            try:
+                result = func(*args, **kwargs)
+                succeeded = True
+                return result
+            finally:
+                elapsed = time.monotonic() - started
+                with self._lock:
+                    metrics.running -= 1
+                    metrics.run_seconds += elapsed
+                    metrics.max_run_seconds = max(metrics.max_run_seconds, elapsed)
+                    if succeeded:
+                        metrics.completed += 1
+                    else:
+                        metrics.failed += 1
+
+        return self._pool.submit(run)
+
+    def call(self, operation, func, *args, **kwargs):
+        '''Run an operation in the pool and wait for its' result.
+
+        This bounds the number of such operations running at once, e.g. archives which
+        are extracted as they are uploaded.
+        '''
+        return self.submit(operation, func, *args, **kwargs).result()
+
+    def run(self, operation, func, *args, location=None, **kwargs):
+        '''Run an operation in the pool, waiting for its' result for up to ``wait`` seconds.
+
+        If it has not finished by then, it continues as a ``Job`` and the request is answered
+        with ``202 Accepted``, the location of the job (``/jobs/{id}``) and its' JSON
+        representation. The ``result`` of the job is ``{"location": location}`` when done.
+
+        Args:
+            operation (str): Name of the operation, for metrics
+            location (str): Where the output of the operation can be fetched once finished,
+                e.g. the URL of the request to repeat
+
+        Raises:
+            falcon.HTTPStatus: ``202 Accepted`` if the operation is continued as a job
+            QueueFull: If the queue is full
+        '''
+        task = _Task()
+        future = self._submit(operation, task, func, args, kwargs)
+        try:
+            return future.result(timeout=self._wait)
+        except concurrent.futures.TimeoutError:
+            pass
+
+        job = self._document(
+            operation=operation,
+            state='running' if future.running() else 'queued'
+        ).save()
+        task.job_id = job.id
+        with self._lock:
+            self._metrics[operation].deferred += 1
+        future.add_done_callback(lambda done: self._finish(
+            job.id, done, lambda value: {'location': location} if location else {}
+        ))
+        raise falcon.HTTPStatus(
+            falcon.HTTP_ACCEPTED,
+            headers={'Location': '/jobs/{}'.format(job.id)},
+            body=job.to_json()
+        )
+
+    def start(self, operation, func, *args, **kwargs):
+        '''Run an operation in the pool as a ``Job``, without waiting for it.
+
+        ``func`` is called with a ``progress`` keyword argument, a ``ProgressReporter``
+        which records the keyword arguments it is called with as the ``progress`` of the job.
+        The dict returned by ``func`` becomes the ``result`` of the job.
+
+        Returns:
+            Job: The queued job
+
+        Raises:
+            QueueFull: If the queue is full
+        '''
+        job = self._document(operation=operation).save()
+        reporter = ProgressReporter(self._document, job.id)
+        task = _Task()
+        task.job_id = job.id
+        try:
+            future = self._submit(operation, task, func, args, dict(kwargs, progress=reporter))
+        except QueueFull:
+            job.delete()
+            raise
+        future.add_done_callback(
+            lambda done: self._finish(job.id, done, lambda value: value or {}, reporter)
+        )
+        return job
+
+    def _finish(self, job_id, future, describe, reporter=None):
+        '''Record the outcome of a job. ``describe`` gives the ``result`` of the job
+        from the return value of the operation.
+        '''
+        error = future.exception()
+        update = {'set__date_finished': datetime.datetime.now()}
+        if reporter is not None:
+            update['set__progress'] = reporter.progress
+        if error is not None:
+            update['set__state'] = 'failed'
+            update['set__error'] = str(error) or error.__class__.__name__
+        else:
+            update['set__state'] = 'complete'
+            update['set__result'] = describe(future.result())
+        self._document.objects(id=job_id).update_one(**update)
+
+
+def run_blocking(executor, operation, func, *args, **kwargs):
+    '''Run an operation with ``executor.call``, or in the calling thread if ``executor``
+    is ``None``
+    '''
+    if executor is None:
+        return func(*args, **kwargs)
+    return executor.call(operation, func, *args, **kwargs)
+
+
+class JobCollection(object):
+    '''Metrics of the operations run by a ``JobExecutor``
+    '''
+    def __init__(self, executor):
+        self._executor = executor
+
+    def on_get(self, req, resp):
+        '''Retrieve the queue depth, counts and timings of each kind of operation, to help
+        size the thread pool (``EXECUTOR`` setting).
+
+        For each operation, ``queued`` and ``running`` are the number waiting for a thread
+        and running now. ``wait_seconds`` and ``run_seconds`` are the total time spent
+        waiting and running, and ``rejected`` is the number refused because the queue was full.
+
+        Example::
+
+            http localhost:8000/jobs
+        '''
+        resp.body = json.dumps({
+            'workers': self._executor.workers,
+            'maxQueue': self._executor.max_queue,
+            'operations': self._executor.metrics()
+        })
+        resp.status = falcon.HTTP_OK
+
+
+class JobItem(object):
+    '''The state of a background job
+    '''
+    def __init__(self, job_document):
+        self._document = job_document
+
+    def on_get(self, req, resp, id):
+        '''Retrieve a JSON representation of a job, with its' ``state`` (``queued``,
+        ``running``, ``complete`` or ``failed``), ``progress``, ``result`` and ``error``.
+
+        Example::
+
+            http localhost:8000/jobs/{id}
+        '''
+        try:
+            job = self._document.objects.get(id=id)
+        except (self._document.DoesNotExist, ValidationError):
+            raise falcon.HTTPNotFound(description='Job {} does not exist'.format(id))
+        resp.body = job.to_json()
+        resp.status = falcon.HTTP_OK
@@ -3,12 +3,83 @@ import mimetypes
 import uuid
 import falcon
 from tucluster import fmdb
+from tucluster.fmdb.control import dependants
+from tucluster.resources import geo, httputils, pagination
+from tucluster.resources.archive import BadZipStream
+from tucluster.resources.jobs import QueueFull, run_blocking
+
+
+def save_model_data(data_store, model, stream, content_type, filename=None, length=None):
+    '''Add uploaded data to the folder of a model and save the model.
+
+    A zip archive is extracted into the folder. Any other file is saved
+    as ``filename``, or a name generated from the content type. ``length`` is
+    the size of the file, if known.
+
+    Returns:
+        str: The fid of the saved file, or ``None`` for a zip archive
+
+    Raises:
+        BadZipStream: The archive is corrupt or unsupported
+    '''
+    if model.folder:
+        folder = model.resolve_folder()
+    else:
+        folder = model.name
+
+    fid = None
+    if content_type == 'application/zip':
+        # Extract any uploaded zip file into the model data folder
+        root, _ = data_store.save_zip(stream, content_type, folder)
+    else:
+        if not filename:
+            ext = mimetypes.guess_extension(content_type)
+            filename = '{}{}'.format(uuid.uuid4(), ext)
+        root, fid = data_store.save(stream, folder, filename, length)
+
+    model.folder = root
+    model.index_entry_points()
+    model.save()
+    return fid
+
+
+def extract_upload(data_store, model_document, uid, content_type, length, progress=None):
+    '''Create a model from an archive saved with ``DataStore.save_upload``, then remove
+    the upload.
+
+    Args:
+        progress (callable): Optional ``ProgressReporter``, given the archive ``bytes``
+            read out of its' ``length`` and the number of ``files`` extracted
+
+    Returns:
+        dict: The ``location`` and ``name`` of the model
+
+    Raises:
+        BadZipStream: The archive is corrupt or unsupported
+    '''
+    files = [0]
+
+    def extracted(path, bytes_read):
+        files[0] += 1
+        if progress:
+            progress(bytes=bytes_read, length=length, files=files[0])
+
+    try:
+        with data_store.open_upload(uid) as stream:
+            folder, name = data_store.save_zip(stream, content_type, progress=extracted)
+    finally:
+        data_store.remove_upload(uid)
+    if progress:
+        progress(bytes=length, length=length, files=files[0])
+    # Saving the model indexes the folder
+    model = model_document(name=name, folder=folder).save()
+    return {'location': '/models/{}'.format(model.name), 'name': model.name}
 
 
 class ModelCollection(object):
     '''List and create ``Model`` documents
     '''
-    def __init__(self, data_store, model_document):
+    def __init__(self, data_store, model_document, run_document=None, executor=None):
         # Instance supporting `save()` which will handle writing
         # incoming zip data streams to disk
         self._data_store = data_store
@@ -17,6 +88,13 @@ class ModelCollection(object):
         # resource
         self._document = model_document
 
+        # ``Document`` class of the model runs, used for spatial queries
+        self._runs = run_document
+
+        # Optional ``JobExecutor`` which bounds the number of archives being
+        # extracted and folders being indexed at once
+        self._executor = executor
+
     def on_get(self, req, resp):
         '''Retrieve a JSON representation of all ``Model`` documents.
 
@@ -29,28 +107,53 @@ class ModelCollection(object):
         A ``Model`` will typically have a 'baseline' where one of the runs is selected
         as the definitive or primary flood model.
 
+        The list is streamed as it is read from the database. Pass ``format=ndjson``
+        to receive newline delimited JSON (one model per line) instead of an array.
+
+        The list may be sorted, paginated and projected with the following query parameters:
+
+        - ``sort``: ``date_created`` or ``_id``. Prefix with ``-`` for descending order.
+        - ``limit``: Maximum number of models to return. If there are more, the ``Link``
+            header of the response contains the URL of the next page (``rel="next"``).
+        - ``after``: Cursor identifying the start of the page, as given in the ``Link`` header.
+        - ``fields``: Comma separated list of the fields to return, e.g ``name,description``
+
+        Models may be found by location with the ``intersects``, ``bbox`` and ``near``
+        parameters described in ``ModelRunCollection.on_get``. These return the models
+        which have a run whose ``model_area`` matches. The models are not sorted by
+        distance.
+
         Example::
 
             http localhost:8000/models
+            http localhost:8000/models sort==-date_created limit==50 fields==name
+            http localhost:8000/models intersects==-1.5,53.8
         '''
         docs = self._document.objects.all()
-        # Create a JSON representation of the resource
-        resp.body = docs.to_json()
+        query = geo.geo_filter(req, 'model_area') if self._runs is not None else None
+        if query is not None:
+            runs = self._runs._get_collection()
+            docs = docs.filter(id__in=geo.distinct_matches(runs, query, 'model'))
+        docs = pagination.paginate(req, resp, docs, ('date_created', '_id'))
+        # Stream a JSON representation of the resource
+        httputils.stream_documents(req, resp, docs)
         resp.status = falcon.HTTP_OK
 
     def on_post(self, req, resp):
         '''Create a new ``Model`` by uploading a zip file containing the input data
         required to run the model using a supported flood modelling software.
 
-        The zip file will be saved and unpacked to the data folder configured in the
-        ``data_store`` instance. This folder path will be stored in the ``Model`` instance.
+        The zip file is saved as it is uploaded, and the response is sent straight away:
+        ``202 Accepted`` with the location of a job (``/jobs/{id}``) in the location header
+        and its' JSON representation in the body. The job unpacks the archive to the data
+        folder configured in the ``data_store`` and creates the ``Model``. Its' ``progress``
+        gives the ``bytes`` of the archive extracted (of ``length``) and the number of ``files``.
+        Once ``complete``, its' ``result`` has the ``location`` of the created model.
+        A corrupt or unsupported archive makes the job fail with an ``error``.
 
         The name of the model is generated automatically and can be overwritten with a PUT
         request.
 
-        A JSON representation of the created model is returned in the response body and
-        the GET URL in the response location header.
-
         Example::
 
             http post localhost:8000/models @/path/to/my/archive.zip
@@ -72,16 +175,30 @@ class ModelCollection(object):
             resp.body = model.to_json()
 
         elif req.content_type == 'application/zip':
-            directory, name = self._data_store.save_zip(req.stream, req.content_type)
-            # Create the model
-            model = self._document(
-                name=name,
-                folder=directory
-            ).save()
+            # Persist the archive, then extract it once the request is answered
+            uid = str(uuid.uuid4())
+            try:
+                length = self._data_store.save_upload(uid, req.stream, req.content_length)
+                args = (self._data_store, self._document, uid, req.content_type, length)
+                if self._executor is not None:
+                    job = self._executor.start('extract', extract_upload, *args)
+            except (OSError, QueueFull):
+                self._data_store.remove_upload(uid)
+                raise
+
+            if self._executor is not None:
+                resp.status = falcon.HTTP_ACCEPTED
+                resp.location = '/jobs/{}'.format(job.id)
+                resp.body = job.to_json()
+                return
 
+            try:
+                result = extract_upload(*args)
+            except BadZipStream as error:
+                raise falcon.HTTPBadRequest(description=str(error))
             resp.status = falcon.HTTP_CREATED
-            resp.location = '/models/{}'.format(model.name)
-            resp.body = model.to_json()
+            resp.location = result['location']
+            resp.body = self._document.objects.get(name=result['name']).to_json()
         else:
             resp.status = falcon.HTTP_BAD_REQUEST
             resp.body = 'Content type must be zip or json'
@@ -138,15 +255,8 @@ class ModelItem(ModelCollection):
                 resp.body = 'Name {} is already taken'.format(data['name'])
 
         else:
-            if model.folder:
-                folder = model.resolve_folder()
-            else:
-                folder = model.name
-
-            if req.content_type == 'application/zip':
-                # Extract any uploaded zip file into the model data folder
-                root, name = self._data_store.save_zip(req.stream, req.content_type, folder)
-            else:
+            filename = None
+            if req.content_type != 'application/zip':
                 # Save a single uploaded file to the model folder.
                 # If the filename is given, use that, otherwise
                 # try to guess the file type and generate a name
@@ -154,15 +264,62 @@ class ModelItem(ModelCollection):
                 result = disp.split('filename=')
                 if len(result) == 2:
                     filename = result[1].replace('"', '').replace("'", '')
-                else:
-                    ext = mimetypes.guess_extension(req.content_type)
-                    filename = '{}{}'.format(uuid.uuid4(), ext)
-                root, fid = self._data_store.save(req.stream, folder, filename)
+
+            try:
+                fid = run_blocking(
+                    self._executor, 'extract', save_model_data,
+                    self._data_store, model, req.stream, req.content_type, filename,
+                    req.content_length
+                )
+            except BadZipStream as error:
+                raise falcon.HTTPBadRequest(description=str(error))
+            if fid is not None:
                 resp.body = json.dumps({
                     'fid': fid
                 })
+            resp.status = falcon.HTTP_ACCEPTED
 
 
-            model.folder = root
-            model.save()
-            resp.status = falcon.HTTP_ACCEPTED
+class ModelDependencies(ModelItem):
+    '''The graph of files referenced by the control files of a model
+    '''
+    def on_get(self, req, resp, name):
+        '''Retrieve the inputs of each control file entry point of a model.
+
+        The control files are parsed when data is added to the model, so this does not
+        read them again. The response is a JSON object with:
+
+        - ``entryPoints``: For each entry point, the ``inputs`` it refers to (directly or
+            through other control files), the ``missing`` inputs and the ``area`` of its'
+            2D domain as a GeoJSON polygon
+        - ``edges``: ``[control file, command, input, exists]`` for each reference in a
+            control file. ``exists`` is null if the path contains scenario variables.
+
+        Pass a ``file`` path (relative to the model folder) to instead find what a change
+        to that file invalidates: the ``entryPoints`` which depend on it and the ids of
+        their ``runs``.
+
+        Example::
+
+            http localhost:8000/models/{name}/dependencies
+            http localhost:8000/models/{name}/dependencies file==model/gis/2d_code.shp
+        '''
+        model = self.get_object(name)
+        dependencies = model.dependencies or {}
+        relpath = req.get_param('file')
+        if relpath:
+            entry_points = dependants(dependencies, relpath)
+            runs = self._runs.objects(
+                model=model, entry_point__in=entry_points
+            ).scalar('id') if entry_points else []
+            resp.body = json.dumps({
+                'file': relpath,
+                'entryPoints': entry_points,
+                'runs': [str(oid) for oid in runs]
+            })
+        else:
+            resp.body = json.dumps({
+                'entryPoints': dependencies.get('entry_points', []),
+                'edges': dependencies.get('edges', [])
+            })
+        resp.status = falcon.HTTP_OK
@@ -0,0 +1,164 @@
+'''Sorting, keyset (cursor) pagination and field projection for list resources
+'''
+import base64
+import datetime
+from urllib.parse import urlencode
+import falcon
+from bson import json_util
+
+# Largest page size a client may request
+MAX_LIMIT = 1000
+
+# Dates are stored as naive UTC datetimes by mongoengine
+_JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
+
+def encode_cursor(value, oid):
+    '''Encode the sort key of the last document on a page as an opaque, URL safe string
+    '''
+    key = [value, oid]
+    if isinstance(value, datetime.datetime):
+        # Extended JSON dates only hold milliseconds, which MongoDB also stores, but
+        # other stores (e.g. mongomock) may keep the microseconds
+        key.append(value.microsecond % 1000)
+    raw = json_util.dumps(key).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('utf-8')
+
+
+def decode_cursor(cursor):
+    '''Decode a cursor created by ``encode_cursor``, returning the ``(value, oid)`` pair
+    '''
+    try:
+        key = json_util.loads(
+            base64.urlsafe_b64decode(cursor).decode('utf-8'),
+            json_options=_JSON_OPTIONS
+        )
+        value, oid = key[:2]
+        if len(key) == 3 and isinstance(value, datetime.datetime):
+            value = value.replace(microsecond=value.microsecond // 1000 * 1000 + int(key[2]))
+    except (ValueError, TypeError):
+        raise falcon.HTTPBadRequest(description='Invalid cursor')
+    return value, oid
+
+
+def _after(field, value, oid, descending):
+    '''Raw query matching documents which sort after ``(value, oid)``.
+
+    Documents with a null (or missing) sort field sort before all others in
+    ascending order and after all others in descending order.
+    '''
+    id_op = '$lt' if descending else '$gt'
+    if field == '_id':
+        return {'_id': {id_op: oid}}
+
+    if value is None:
+        if descending:
+            return {field: None, '_id': {id_op: oid}}
+        return {'$or': [{field: {'$ne': None}}, {field: None, '_id': {id_op: oid}}]}
+
+    clauses = [
+        {field: {id_op: value}},
+        {field: value, '_id': {id_op: oid}}
+    ]
+    if descending:
+        clauses.append({field: None})
+    return {'$or': clauses}
+
+
+def _projection(req, document):
+    fields = req.get_param_as_list('fields')
+    if not fields:
+        return None
+    # ``as_pymongo`` leaves out the id unless it is projected (in mongoengine 0.15)
+    names = ['id']
+    for name in fields:
+        name = 'id' if name == '_id' else name
+        if name not in document._fields:
+            raise falcon.HTTPBadRequest(description='Unknown field {}'.format(name))
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def paginate(req, resp, queryset, sort_keys, ordered=False):
+    '''Apply the ``sort``, ``limit``, ``after`` and ``fields`` query parameters to a queryset.
+
+    - ``sort``: One of ``sort_keys``, optionally prefixed with ``-`` for descending order.
+        Ties are broken by the document id. Defaults to ``_id``.
+    - ``limit``: Maximum number of documents in the page.
+    - ``after``: Cursor returned by the previous page.
+    - ``fields``: Comma separated list of fields to return. The id is always included.
+
+    If there are more documents, a ``Link`` header with ``rel="next"`` is added to the
+    response which gives the URL of the next page.
+
+    Args:
+        req (falcon.Request): The incoming request
+        resp (falcon.Response): The response, used to add the ``Link`` header
+        queryset (QuerySet): The filtered documents
+        sort_keys (tuple): Names of the fields which the client may sort by.
+            Each should be the first field of a compound index with ``_id``.
+        ordered (bool): The queryset has its' own order (e.g. nearest first for a
+            ``$near`` query), which is kept unless ``sort`` is given. ``limit`` then
+            returns the first documents in that order, without a next page, and
+            ``after`` can't be used.
+
+    Returns:
+        QuerySet: The documents of the requested page
+    '''
+    fields = _projection(req, queryset._document)
+    sort = req.get_param('sort')
+    limit = req.get_param_as_int('limit', min=1, max=MAX_LIMIT)
+    cursor = req.get_param('after')
+    if not (sort or limit or cursor):
+        return queryset.only(*fields) if fields else queryset
+    if ordered and not sort:
+        if cursor:
+            raise falcon.HTTPBadRequest(description='after can only be used with sort')
+        queryset = queryset.limit(limit) if limit is not None else queryset
+        return queryset.only(*fields) if fields else queryset
+
+    sort = sort or '_id'
+    descending = sort.startswith('-')
+    field = sort.lstrip('-+')
+    if field not in sort_keys:
+        raise falcon.HTTPBadRequest(
+            description='Can only sort by {}'.format(', '.join(sort_keys))
+        )
+    db_field = '_id' if field == '_id' else queryset._document._fields[field].db_field
+    direction = '-' if descending else '+'
+    if field == '_id':
+        queryset = queryset.order_by('{}id'.format(direction))
+    else:
+        queryset = queryset.order_by(
+            '{}{}'.format(direction, field),
+            '{}id'.format(direction)
+        )
+
+    if cursor:
+        value, oid = decode_cursor(cursor)
+        queryset = queryset.filter(__raw__=_after(db_field, value, oid, descending))
+
+    if limit is not None:
+        queryset = _limit(req, resp, queryset, field, db_field, descending, limit)
+    return queryset.only(*fields) if fields else queryset
+
+
+def _limit(req, resp, queryset, field, db_field, descending, limit):
+    # Fetch only the sort keys of the page (an index-only query), plus one more to
+    # find out whether there is a next page
+    key_fields = ('id',) if field == '_id' else (field, 'id')
+    keys = list(queryset.only(*key_fields).as_pymongo().limit(limit + 1))
+    if len(keys) <= limit:
+        return queryset
+
+    last = keys[limit - 1]
+    value, oid = last.get(db_field), last['_id']
+    # Bound the page by its' last key, so a document inserted between the two
+    # queries cannot push a document out of this page without it being on the next
+    queryset = queryset.filter(__raw__={'$nor': [_after(db_field, value, oid, descending)]})
+
+    params = dict(req.params)
+    params['after'] = encode_cursor(value, oid)
+    resp.add_link('{}?{}'.format(req.path, urlencode(params, doseq=True)), 'next')
+    return queryset
@@ -1,11 +1,81 @@
 '''Request handlers for ModelRun data
 '''
+import collections
+import datetime
+import fnmatch
+import glob
+import itertools
 import json
 import os
+import threading
+import time
+import uuid
+import bson
+import celery
 import falcon
 from qflow import tasks
 from tucluster.fmdb import Model
 from tucluster.conf import settings
+from tucluster.resources import geo, httputils, pagination
+from tucluster.resources.tasks import TERMINAL_STATES, fetch_tasks
+
+
+# Maximum number of runs which may be submitted in one bulk request
+MAX_BULK_RUNS = 5000
+
+
+def task_arguments(engine, path, email=None, mock=False):
+    '''Return the celery task and its' arguments which run a model with the given engine.
+
+    Returns:
+        tuple: ``(task, args, kwargs)``
+    '''
+    if engine == 'tuflow':
+        return tasks.run_tuflow, (path, settings['TUFLOW_PATH']), {'mock': mock}
+    elif engine == 'anuga':
+        return tasks.run_anuga, (path,), {'env_name': settings['ANUGA_ENV'], 'email': email}
+    raise falcon.HTTPBadRequest(description='Unknown engine {}'.format(engine))
+
+
+def check_inputs(model, entry_points, force=False):
+    '''Check the inputs referenced by the control files of each entry point exist.
+
+    Args:
+        model (Model): The model of the runs
+        entry_points (list): Entry points of the runs
+        force (bool): Don't raise an error for missing inputs
+
+    Returns:
+        dict: The area (GeoJSON polygon coordinates) of each entry point, if known
+
+    Raises:
+        falcon.HTTPBadRequest: If inputs are missing
+    '''
+    areas = {}
+    missing = {}
+    for entry_point in entry_points:
+        summary = model.entry_point_dependencies(entry_point)
+        if summary is None:
+            continue
+        if summary['missing']:
+            missing[entry_point] = summary['missing']
+        if summary['area']:
+            areas[entry_point] = summary['area']['coordinates']
+    if missing and not force:
+        raise falcon.HTTPBadRequest(
+            title='Missing inputs',
+            description='The control files refer to files which do not exist: {}'.format(
+                '; '.join('{}: {}'.format(name, ', '.join(files))
+                          for name, files in sorted(missing.items()))
+            )
+        )
+    return areas
+
+
+def guess_engine(entry_point):
+    '''Choose the engine for an entry point from its' file type
+    '''
+    return 'anuga' if entry_point.endswith('.py') else 'tuflow'
 
 
 class ModelRunCollection(object):
@@ -35,27 +105,83 @@ class ModelRunCollection(object):
 
         - ``model`` - The parent ``Model`` instance to which this run belongs.
 
+        - ``state``, ``time_finished``, ``result_summary``: The state of the task, when it
+            finished and a short description of its result (or error). These are kept up
+            to date from celery task events and may lag the ``/tasks/{id}`` endpoint slightly.
+
+        The list can be filtered by ``entrypoint``, ``model`` (name) and ``state``, e.g. to
+        find the failed runs of a model. Pass the id of the model as ``modelId`` instead of its'
+        name to save looking up the model. Runs can also be filtered by ``group`` to find the runs of a bulk submission
+        and by ``baseline`` (true/false).
+
+        Runs may also be found by their ``model_area`` (in longitude and latitude):
+
+        - ``intersects``: A ``longitude,latitude`` point, or a GeoJSON geometry, which the
+            area intersects
+        - ``bbox``: ``west,south,east,north`` bounds of a box which the area lies within
+        - ``near``: A ``longitude,latitude`` point. Runs are sorted by the distance of their
+            area from the point, unless ``sort`` is given. Pass ``distance`` (metres) to
+            only return runs within that distance. ``limit`` returns the nearest runs,
+            without a next page.
+
+        The list is streamed as it is read from the database. Pass ``format=ndjson``
+        to receive newline delimited JSON (one run per line) instead of an array.
+
+        The list may be sorted, paginated and projected with the ``sort`` (``time_started``
+        or ``_id``), ``limit``, ``after`` and ``fields`` query parameters. These are
+        described in ``ModelCollection.on_get``.
+
         Example::
 
             http localhost:8000/runs
+            http localhost:8000/runs sort==-time_started limit==50 fields==entry_point,model
+            http localhost:8000/runs state==FAILURE model==mymodel
+            http localhost:8000/runs baseline==true intersects==-1.5,53.8
         '''
-        # support optional filtering by entry_point and model
+        # support optional filtering by entry_point, model, state, group and location
         entrypoint = req.get_param('entrypoint')
         model = req.get_param('model')
+        model_id = req.get_param('modelId')
+        state = req.get_param('state')
+        group = req.get_param('group')
+        baseline = req.get_param_as_bool('baseline')
+        query = geo.geo_filter(req, 'model_area')
         kwargs = {}
         if entrypoint:
             kwargs['entry_point'] = entrypoint
-        if model:
-            model = Model.objects.get(name=model)
-            kwargs['model'] = model
+        if state:
+            kwargs['state'] = state
+        if group:
+            kwargs['group_id'] = group
+        if baseline:
+            kwargs['is_baseline'] = True
+        elif baseline is not None:
+            # Runs are not marked as a baseline until patched
+            kwargs['is_baseline__ne'] = True
+        if query is not None:
+            kwargs['__raw__'] = query
+        if model_id:
+            if not bson.ObjectId.is_valid(model_id):
+                raise falcon.HTTPBadRequest(description='Invalid modelId {}'.format(model_id))
+            kwargs['model'] = bson.ObjectId(model_id)
+        elif model:
+            try:
+                kwargs['model'] = Model.objects.only('id').get(name=model).id
+            except Model.DoesNotExist:
+                raise falcon.HTTPBadRequest(
+                    description='A model with the name {} does not exist'.format(model)
+                )
 
         if kwargs:
             docs = self._document.objects(**kwargs)
         else:
             docs = self._document.objects.all()
+        docs = pagination.paginate(
+            req, resp, docs, ('time_started', '_id'), ordered=geo.is_near(query)
+        )
 
-        # Create a JSON representation of the resource
-        resp.body = docs.to_json()
+        # Stream a JSON representation of the resource
+        httputils.stream_documents(req, resp, docs)
 
         # The following line can be omitted because 200 is the default
         # status returned by the framework, but it is included here to
@@ -82,6 +208,11 @@ class ModelRunCollection(object):
                 for ~1 min. No modelling software will be executed and no results created.
                 Intented for testing purposes only.
 
+            - ``force``: Start the run even if files referenced by the control files are
+                missing. Otherwise a 400 error lists the missing files.
+
+        The ``model_area`` of the run is set from the 'Read GIS Location' of the control files.
+
         The response will contain a JSON representation of the resulting ``ModelRun``
         instance and the resource location will be stored in the Location header.
         '''
@@ -92,28 +223,31 @@ class ModelRunCollection(object):
             engine = doc['engine']
             model = Model.objects.get(name=doc['modelName'])
             mock = doc.get('mock', False)
+            areas = check_inputs(model, [entry_point], doc.get('force', False))
 
             # Start the task
             email = None
             if send_email and model.email:
                 email = model.email
             path = os.path.join(model.resolve_folder(), entry_point)
-            if engine == 'tuflow':
-                task = tasks.run_tuflow.delay(
-                    path,
-                    settings['TUFLOW_PATH'],
-                    mock=mock
-                )
-            elif engine == 'anuga':
-                task = tasks.run_anuga.delay(path, env_name=settings['ANUGA_ENV'], email=email)
+            task, args, kwargs = task_arguments(engine, path, email, mock)
 
-            # Create the model run
+            # Create the model run before queueing its' task, so that it exists
+            # when the first events of the task are received
             run = self._document(
                 entry_point=entry_point,
-                task_id=task.id,
+                time_started=datetime.datetime.now(),
+                task_id=str(uuid.uuid4()),
+                state='PENDING',
                 model=model,
-                engine=engine
+                engine=engine,
+                model_area=areas.get(entry_point)
             ).save()
+            try:
+                task.apply_async(args, kwargs, task_id=run.task_id)
+            except Exception:
+                run.delete()
+                raise
 
             resp.location = '/runs/{}'.format(run.id)
             resp.body = run.to_json()
@@ -123,6 +257,125 @@ class ModelRunCollection(object):
             resp.body = str(err)
             resp.status = falcon.HTTP_BAD_REQUEST
 
+
+class ModelRunBulk(object):
+    '''Submit many model runs at once, e.g. for an ensemble or parameter sweep
+    '''
+    def __init__(self, run_document):
+        self._document = run_document
+
+    def on_post(self, req, resp):
+        '''Create many ``ModelRun`` documents and queue their modelling tasks as a
+        single celery group.
+
+        The request body is a JSON object with the following attributes:
+
+            - ``modelName``: The name of the parent ``Model`` instance.
+
+            - ``entrypoints``: A list of entry points (control files or scripts) to run.
+                Items may be glob patterns matched against the ``entry_points`` of the model,
+                e.g. ``["*.tcf"]`` runs every Tuflow control file. Defaults to all entry points.
+
+            - ``engines``: Optional list of engines (``tuflow``/``anuga``). If not given, the
+                engine is chosen from the file type of each entry point.
+
+            - ``mock``, ``sendMail``, ``force``: As for a single run.
+
+        One run is created for each combination (cartesian product) of entry point and engine.
+
+        The response contains the ``groupId`` of the celery group and the ids of the
+        created runs. The runs of the group can be listed with ``/runs?group={groupId}``.
+
+        Example::
+
+            http post localhost:8000/runs/bulk modelName=mymodel entrypoints:='["runs/*.tcf"]'
+        '''
+        doc = json.load(req.bounded_stream)
+        try:
+            model = Model.objects.get(name=doc['modelName'])
+        except KeyError as err:
+            raise falcon.HTTPBadRequest(description='Missing attribute {}'.format(err))
+        except Model.DoesNotExist:
+            raise falcon.HTTPBadRequest(
+                description='A model with the name {} does not exist'.format(doc['modelName'])
+            )
+
+        patterns = doc.get('entrypoints') or ['*']
+        entry_points = [
+            name for name in model.entry_points
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+        ]
+        # Entry points which are not (yet) in the model index may still be named explicitly
+        entry_points.extend(
+            pattern for pattern in patterns
+            if not glob.has_magic(pattern) and pattern not in entry_points
+        )
+        engines = doc.get('engines')
+        if engines:
+            combinations = list(itertools.product(entry_points, engines))
+        else:
+            combinations = [(entry_point, guess_engine(entry_point)) for entry_point in entry_points]
+
+        if not combinations:
+            raise falcon.HTTPBadRequest(description='No entry points matched')
+        if len(combinations) > MAX_BULK_RUNS:
+            raise falcon.HTTPBadRequest(
+                description='At most {} runs may be submitted at once'.format(MAX_BULK_RUNS)
+            )
+
+        areas = check_inputs(
+            model, sorted(set(entry_point for entry_point, _ in combinations)),
+            doc.get('force', False)
+        )
+        email = model.email if doc.get('sendMail', True) else None
+        mock = doc.get('mock', False)
+        folder = model.resolve_folder()
+        group_id = str(uuid.uuid4())
+        now = datetime.datetime.now()
+        signatures = []
+        runs = []
+        for entry_point, engine in combinations:
+            task, args, kwargs = task_arguments(
+                engine, os.path.join(folder, entry_point), email, mock
+            )
+            task_id = str(uuid.uuid4())
+            signatures.append(task.s(*args, **kwargs).set(task_id=task_id))
+            runs.append(self._document(
+                entry_point=entry_point,
+                time_started=now,
+                task_id=task_id,
+                group_id=group_id,
+                state='PENDING',
+                model=model,
+                engine=engine,
+                model_area=areas.get(entry_point)
+            ))
+
+        # Create the runs before queueing their tasks, so that they exist when the first
+        # task events are received
+        ids = self._document.objects.insert(runs, load_bulk=False)
+        try:
+            # Queue all the tasks in one go. The ``task_id`` of a group becomes its' id.
+            result = celery.group(signatures).apply_async(task_id=group_id)
+        except Exception:
+            self._document.objects(group_id=group_id).delete()
+            raise
+        try:
+            # Keep the group result so it can be restored
+            result.save()
+        except NotImplementedError:
+            # The result backend (e.g. RPC) can't store groups. The tasks are already queued,
+            # so failing now would only make the client submit them again
+            pass
+
+        resp.location = '/runs?group={}'.format(group_id)
+        resp.body = json.dumps({
+            'groupId': group_id,
+            'runs': [str(oid) for oid in ids]
+        })
+        resp.status = falcon.HTTP_CREATED
+
+
 class ModelRunItem(ModelRunCollection):
 
     def on_get(self, req, resp, oid):
@@ -152,3 +405,110 @@ class ModelRunItem(ModelRunCollection):
         doc.is_baseline = data['isBaseline']
         doc.save()
         resp.status = falcon.HTTP_ACCEPTED
+
+
+class RunStateSync(object):
+    '''Keeps the task ``state`` of ``ModelRun`` documents in step with celery task events.
+
+    An instance is registered as a listener of the ``TaskEventBroker``. Events of tasks
+    which have no run (e.g. a run which is still being saved) are kept for ``PENDING_TTL``
+    seconds and retried.
+    '''
+    # Number of runs whose task state is fetched per backend round trip by ``reconcile``
+    _BATCH_SIZE = 500
+    # Seconds for which events of unknown tasks are retried
+    PENDING_TTL = 60
+    # Least number of seconds between retries of the events of unknown tasks
+    RETRY_INTERVAL = 1
+    # Most tasks whose events are kept for retrying, e.g. tasks of other applications
+    MAX_PENDING = 1000
+
+    def __init__(self, run_document, clock=time.monotonic):
+        self._document = run_document
+        self._clock = clock
+        # Maps task ids to ``(expires, [update arguments])``, oldest first
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._retried = clock()
+
+    def __call__(self, event):
+        args = (event['id'], event['state'], event.get('timestamp'),
+                event.get('exception') or event.get('result'))
+        if not self.update(*args):
+            self._defer(args)
+        if self._pending and self._clock() - self._retried >= self.RETRY_INTERVAL:
+            self.retry_pending()
+
+    def update(self, task_id, state, timestamp=None, summary=None):
+        '''Set the state of the run(s) for a task.
+
+        Events may arrive out of order, so a finished run is never
+        returned to an unfinished state.
+
+        Returns:
+            bool: ``False`` if there is no run for the task
+        '''
+        runs = self._document.objects(task_id=task_id)
+        update = {'set__state': state}
+        if state in TERMINAL_STATES:
+            when = datetime.datetime.fromtimestamp(timestamp) if timestamp else datetime.datetime.now()
+            update['set__time_finished'] = when
+            if summary is not None:
+                update['set__result_summary'] = str(summary)
+        else:
+            runs = runs.filter(state__nin=list(TERMINAL_STATES))
+        if runs.update(**update):
+            return True
+        return self._document.objects(task_id=task_id).only('id').first() is not None
+
+    def _defer(self, args):
+        with self._lock:
+            expires, updates = self._pending.pop(args[0], (None, []))
+            updates.append(args)
+            self._pending[args[0]] = (expires or self._clock() + self.PENDING_TTL, updates)
+            while len(self._pending) > self.MAX_PENDING:
+                self._pending.popitem(last=False)
+
+    def retry_pending(self):
+        '''Apply the events of unknown tasks whose runs now exist, and forget those
+        which have been kept for ``PENDING_TTL`` seconds.
+        '''
+        with self._lock:
+            self._retried = now = self._clock()
+            for task_id in [task_id for task_id, (expires, _) in self._pending.items()
+                            if expires < now]:
+                del self._pending[task_id]
+            if not self._pending:
+                return
+            found = self._document.objects(task_id__in=list(self._pending)).distinct('task_id')
+            ready = [self._pending.pop(task_id)[1] for task_id in found
+                     if task_id in self._pending]
+        for updates in ready:
+            for args in updates:
+                self.update(*args)
+
+    def reconcile(self):
+        '''Update all unfinished runs from the result backend.
+
+        Events sent while no API process was listening are missed, so this
+        is run when the listener is started.
+        '''
+        runs = self._document.objects(
+            state__nin=list(TERMINAL_STATES), task_id__ne=None
+        ).scalar('task_id')
+        batch = []
+        for task_id in runs:
+            batch.append(task_id)
+            if len(batch) == self._BATCH_SIZE:
+                self._reconcile_batch(batch)
+                batch = []
+        if batch:
+            self._reconcile_batch(batch)
+
+    def _reconcile_batch(self, task_ids):
+        for task_id, (state, result, finished) in fetch_tasks(task_ids).items():
+            if state in TERMINAL_STATES:
+                # The time the task finished, rather than now
+                self.update(task_id, state, finished, summary=result)
+            elif state != 'PENDING':
+                self.update(task_id, state)
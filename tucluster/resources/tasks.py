@@ -1,10 +1,168 @@
+import datetime
 import json
+import time
 import falcon
+from celery.utils.time import maybe_iso8601
 from qflow.celery import app
+from tucluster.resources.cache import LRUCache
+
+# States after which a task will not change again
+TERMINAL_STATES = frozenset(['SUCCESS', 'FAILURE', 'REVOKED'])
+
+# Maximum number of task ids accepted by a single batch request
+MAX_BATCH_SIZE = 1000
+
+
+class TaskStateCache(object):
+    '''Short lived cache of task states.
+
+    Tasks in a terminal state (e.g. ``SUCCESS``) never change, so they are kept until
+    evicted by newer entries. Other states are only reused for ``ttl`` seconds.
+    '''
+    def __init__(self, ttl=1.5, size=100000, clock=time.monotonic):
+        self._ttl = ttl
+        self._clock = clock
+        self._items = LRUCache(size)
+
+    def get(self, task_id):
+        '''Return the cached ``(state, data)`` of a task, or ``None``
+        '''
+        item = self._items.get(task_id)
+        if item is None:
+            return None
+        state, data, expires = item
+        if expires is not None and self._clock() > expires:
+            return None
+        return state, data
+
+    def set(self, task_id, state, data):
+        expires = None if state in TERMINAL_STATES else self._clock() + self._ttl
+        self._items.set(task_id, (state, data, expires))
+
+
+def _task_data(state, result):
+    if state == 'FAILURE':
+        return str(result)
+    return result
+
+
+def _text(key):
+    return key.decode('utf-8') if isinstance(key, bytes) else key
+
+
+def _mget(backend, task_ids):
+    '''Fetch the results of many tasks from a key-value backend in one round trip.
+
+    Like celery's ``_mget_to_results``, this accepts backends whose ``mget`` returns a
+    list of values in the order of the keys (e.g. redis) or a dict of the keys which
+    were found (e.g. memcached).
+
+    Returns:
+        dict: Maps the task id of each stored result to its' decoded meta
+    '''
+    keys = [backend.get_key_for_task(task_id) for task_id in task_ids]
+    values = backend.mget(keys)
+    if hasattr(values, 'items'):
+        task_for_key = {_text(key): task_id for key, task_id in zip(keys, task_ids)}
+        pairs = ((task_for_key.get(_text(key)), value) for key, value in values.items())
+    else:
+        pairs = zip(task_ids, values)
+    return {
+        task_id: backend.decode_result(value)
+        for task_id, value in pairs if task_id is not None and value is not None
+    }
+
+
+def _timestamp(date_done):
+    '''Convert the ``date_done`` of a task result (a datetime or ISO 8601 string, in UTC
+    if naive) to a POSIX timestamp
+    '''
+    date_done = maybe_iso8601(date_done)
+    if date_done is None:
+        return None
+    if date_done.tzinfo is None:
+        date_done = date_done.replace(tzinfo=datetime.timezone.utc)
+    return date_done.timestamp()
+
+
+def fetch_tasks(task_ids):
+    '''Fetch the state, result and finish time of many tasks from the result backend.
+
+    Key-value backends such as redis are queried with a single ``mget`` round trip,
+    other backends one task at a time.
+
+    Returns:
+        dict: Maps each task id to a ``(state, result, finished)`` tuple, where ``finished``
+        is the POSIX timestamp at which the task finished, if it has
+    '''
+    tasks = {}
+    fetched = None
+    backend = app.backend
+    if task_ids and hasattr(backend, 'mget') and hasattr(backend, 'get_key_for_task'):
+        try:
+            fetched = _mget(backend, task_ids)
+        except NotImplementedError:
+            # e.g. the S3 backend inherits an ``mget`` which is not implemented
+            pass
+    if fetched is not None:
+        for task_id in task_ids:
+            meta = fetched.get(task_id)
+            if meta is None:
+                tasks[task_id] = 'PENDING', None, None
+            else:
+                tasks[task_id] = (
+                    meta['status'], meta['result'], _timestamp(meta.get('date_done'))
+                )
+    else:
+        for task_id in task_ids:
+            result = app.AsyncResult(task_id)
+            tasks[task_id] = (
+                result.state, result.result, _timestamp(getattr(result, 'date_done', None))
+            )
+    return tasks
+
+
+def lookup_tasks(task_ids, cache=None, observe=None):
+    '''Get the state and result data of many tasks.
+
+    Tasks which are not in ``cache`` are fetched from the result backend (see
+    ``fetch_tasks``). ``observe`` is called with the seconds spent fetching from the
+    backend, if any tasks were fetched.
+
+    Returns:
+        dict: Maps each task id to a ``(state, data)`` tuple
+    '''
+    states = {}
+    missing = []
+    for task_id in task_ids:
+        cached = cache.get(task_id) if cache else None
+        if cached is None:
+            missing.append(task_id)
+        else:
+            states[task_id] = cached
+
+    if missing:
+        started = time.perf_counter()
+        for task_id, (state, result, _) in fetch_tasks(missing).items():
+            states[task_id] = state, _task_data(state, result)
+        if observe is not None:
+            observe(time.perf_counter() - started)
+
+    if cache:
+        for task_id in missing:
+            cache.set(task_id, *states[task_id])
+    return states
+
 
 class TaskDetail(object):
     '''Get information about an executing task
     '''
+    def __init__(self, cache=None, metrics=None):
+        # Optional ``TaskStateCache`` shared with the ``TaskCollection``
+        self._cache = cache
+        # Optional ``tucluster.middleware.metrics.Metrics`` to record backend lookup times
+        self._observe = metrics.observe_celery_lookup if metrics is not None else None
+
     def on_get(self, req, resp, id):
         '''Retrive a JSON representation of a tasks' results.
 
@@ -30,15 +188,52 @@ class TaskDetail(object):
             http localhost:8000/tasks/{task_id}
 
         '''
-        result = app.AsyncResult(id)
-
-        if result.state == 'FAILURE':
-            data = str(result.result)
-        else:
-            data = result.result
+        state, data = lookup_tasks([id], self._cache, self._observe)[id]
 
         resp.body = json.dumps({
-            'state': result.state,
+            'state': state,
             'data': data
         })
         resp.status = falcon.HTTP_OK
+
+
+class TaskCollection(TaskDetail):
+    '''Get information about many tasks at once
+    '''
+    def _respond(self, resp, task_ids):
+        if len(task_ids) > MAX_BATCH_SIZE:
+            raise falcon.HTTPBadRequest(
+                description='At most {} task ids may be requested at once'.format(MAX_BATCH_SIZE)
+            )
+        states = lookup_tasks(task_ids, self._cache)
+        resp.body = json.dumps({
+            task_id: {'state': state, 'data': data}
+            for task_id, (state, data) in states.items()
+        })
+        resp.status = falcon.HTTP_OK
+
+    def on_get(self, req, resp):
+        '''Retrieve the state and data of several tasks, given as a comma separated
+        ``ids`` query parameter. The response is a JSON object mapping each task id
+        to an object with the same ``state`` and ``data`` attributes returned by
+        ``/tasks/{id}``.
+
+        Example::
+
+            http localhost:8000/tasks ids==id1,id2,id3
+        '''
+        self._respond(resp, req.get_param_as_list('ids', required=True))
+
+    def on_post(self, req, resp):
+        '''As GET, but the task ids are given as a JSON list in the ``ids`` attribute
+        of the request body. Use this when there are too many ids for a URL.
+
+        Example::
+
+            echo '{"ids": ["id1", "id2"]}' | http post localhost:8000/tasks
+        '''
+        try:
+            task_ids = json.load(req.bounded_stream)['ids']
+        except (ValueError, KeyError, TypeError):
+            raise falcon.HTTPBadRequest(description='Body must be a JSON object with an ids list')
+        self._respond(resp, task_ids)
@@ -0,0 +1,319 @@
+'''Resumable, chunked uploads of model data
+'''
+import base64
+import binascii
+import datetime
+import hashlib
+import json
+import time
+import bson
+import falcon
+from mongoengine.errors import ValidationError
+from tucluster.fmdb import ByteRange
+from tucluster.resources.archive import BadZipStream
+from tucluster.resources.jobs import QueueFull, run_blocking
+from tucluster.resources.models import save_model_data
+from tucluster.resources.utils import ChecksumMismatch
+
+# Algorithms accepted in the ``Upload-Checksum`` header
+CHECKSUM_ALGORITHMS = ('md5', 'sha1', 'sha256')
+
+# Response status when the checksum of a chunk does not match its' data
+HTTP_CHECKSUM_MISMATCH = '460 Checksum Mismatch'
+
+
+def _representation(upload):
+    data = json.loads(upload.to_json())
+    data['received'] = [[byte_range.start, byte_range.end] for byte_range in upload.received]
+    data['offset'] = upload.offset
+    return json.dumps(data)
+
+
+def _checksum(req):
+    '''Parse the ``Upload-Checksum`` header, e.g ``sha1 <base64 digest>``.
+
+    Returns:
+        tuple: A ``hashlib`` object and the expected digest, or ``(None, None)``
+    '''
+    value = req.get_header('Upload-Checksum')
+    if not value:
+        return None, None
+    algorithm, _, digest = value.strip().partition(' ')
+    if algorithm.lower() not in CHECKSUM_ALGORITHMS:
+        raise falcon.HTTPBadRequest(
+            description='Checksum algorithm must be one of {}'.format(
+                ', '.join(CHECKSUM_ALGORITHMS)
+            )
+        )
+    try:
+        expected = base64.b64decode(digest.strip(), validate=True)
+    except (binascii.Error, ValueError):
+        raise falcon.HTTPBadRequest(description='Checksum must be base64 encoded')
+    return hashlib.new(algorithm.lower()), expected
+
+
+def expire_uploads(data_store, upload_document, max_age):
+    '''Remove uploads which have not changed for ``max_age`` seconds, and upload files
+    without an upload (e.g. of a deleted model).
+
+    Abandoned uploads are deleted. Uploads which were interrupted while being added to
+    their model (e.g. by a restart) are marked as failed.
+    '''
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+    for upload in upload_document.objects(
+            state__in=['receiving', 'finalizing'], date_updated__lt=cutoff).only('id', 'state'):
+        data_store.remove_upload(str(upload.id))
+        if upload.state == 'receiving':
+            upload.delete()
+        else:
+            upload.update(
+                set__state='failed', set__error='Interrupted while being added to the model'
+            )
+
+    # Files are listed before their uploads are found, as each upload is saved before its' file
+    uids = data_store.upload_ids()
+    known = set(str(oid) for oid in upload_document.objects(
+        id__in=[uid for uid in uids if bson.ObjectId.is_valid(uid)]
+    ).distinct('id'))
+    for uid in uids:
+        if uid not in known:
+            data_store.remove_upload(uid)
+
+
+class UploadCollection(object):
+    '''Start a chunked upload
+    '''
+    # Least number of seconds between checks for abandoned uploads
+    EXPIRE_INTERVAL = 3600
+
+    def __init__(self, data_store, upload_document, model_document, executor=None,
+                 expiry=None):
+        # ``DataStore`` which holds the partial uploads and the model data
+        self._data_store = data_store
+        self._document = upload_document
+        self._models = model_document
+        # Optional ``JobExecutor`` in which completed uploads are extracted
+        self._executor = executor
+        # Seconds after which an upload which has not changed is removed
+        self._expiry = expiry
+        self._expired = None
+
+    def _expire(self):
+        '''Remove abandoned uploads, at most every ``EXPIRE_INTERVAL`` seconds
+        '''
+        now = time.monotonic()
+        if not self._expiry or (self._expired is not None and
+                                now - self._expired < self.EXPIRE_INTERVAL):
+            return
+        self._expired = now
+        args = (self._data_store, self._document, self._expiry)
+        if self._executor is None:
+            expire_uploads(*args)
+            return
+        try:
+            self._executor.submit('expire', expire_uploads, *args)
+        except QueueFull:
+            # Try again with the next upload
+            self._expired = None
+
+    def on_post(self, req, resp):
+        '''Start a resumable upload of model data.
+
+        Large archives may be sent in chunks with PATCH requests to the returned
+        location, so a failed upload can be resumed rather than restarted.
+        The POST body is a JSON object with the following attributes:
+
+        - ``length``: Size of the file in bytes (required). The space is allocated
+            straight away.
+        - ``model``: Name of the model to add the data to. A new model is created from
+            the archive if this is not given.
+        - ``content_type``: ``application/zip`` (the default) for an archive which is
+            extracted into the model folder. Other files may only be added to an existing model.
+        - ``filename``: Name of the file in the model folder, for files which are not an archive.
+
+        Example::
+
+            http post localhost:8000/uploads length:=1073741824 model=mymodel
+        '''
+        data = json.load(req.bounded_stream)
+        length = data.get('length')
+        if not isinstance(length, int) or length < 1:
+            raise falcon.HTTPBadRequest(description='length must be a positive integer')
+
+        upload = self._document(
+            length=length,
+            content_type=data.get('content_type', 'application/zip'),
+            filename=data.get('filename')
+        )
+        if 'model' in data:
+            try:
+                upload.model = self._models.objects.get(name=data['model'])
+            except self._models.DoesNotExist:
+                raise falcon.HTTPBadRequest(
+                    description="A model with the name {} does not exist".format(data['model'])
+                )
+        elif upload.content_type != 'application/zip':
+            raise falcon.HTTPBadRequest(
+                description='A new model can only be created from a zip archive'
+            )
+        upload.save()
+        self._expire()
+
+        try:
+            self._data_store.create_upload(str(upload.id), length)
+        except OSError:
+            upload.delete()
+            raise falcon.HTTPInsufficientStorage(
+                description='Not enough space to receive {} bytes'.format(length)
+            )
+
+        resp.status = falcon.HTTP_CREATED
+        resp.location = '/uploads/{}'.format(upload.id)
+        resp.set_header('Upload-Offset', '0')
+        resp.body = _representation(upload)
+
+
+class UploadItem(UploadCollection):
+    '''Send, query and cancel the chunks of an upload
+    '''
+    def get_object(self, uid):
+        try:
+            return self._document.objects.get(id=uid)
+        except (self._document.DoesNotExist, ValidationError):
+            raise falcon.HTTPNotFound(description='Upload {} does not exist'.format(uid))
+
+    def on_head(self, req, resp, uid):
+        '''Get the progress of an upload. The ``Upload-Offset`` header gives the number of
+        bytes received from the start of the file, i.e. where to resume from.
+        '''
+        upload = self.get_object(uid)
+        resp.set_header('Upload-Offset', str(upload.offset))
+        resp.set_header('Upload-Length', str(upload.length))
+        resp.cache_control = ['no-store']
+        resp.status = falcon.HTTP_OK
+
+    def on_get(self, req, resp, uid):
+        '''Retrieve a JSON representation of an upload.
+
+        As well as the ``offset``, it has the ``received`` byte ranges, so a client sending
+        chunks in parallel can find any gaps, and the ``state``. Once the upload is
+        ``complete``, ``model`` and ``fid`` give the model and the saved file or folder.
+        '''
+        upload = self.get_object(uid)
+        resp.cache_control = ['no-store']
+        resp.status = falcon.HTTP_OK
+        resp.body = _representation(upload)
+
+    def on_patch(self, req, resp, uid):
+        '''Send a chunk of the file.
+
+        The chunk is the request body and is written at the position given by the
+        ``Upload-Offset`` header. Chunks may be sent in any order, and again if they failed.
+        An ``Upload-Checksum`` header, e.g ``sha1 <base64 digest>``, should be given so
+        a corrupt chunk is rejected (with status 460) and can be sent again. A rejected chunk
+        is not written, so data received before is kept.
+
+        The response has the ``Upload-Offset`` after the chunk. When the last missing chunk
+        is received the data is added to the model, and the response holds the completed
+        upload, with the URL of the model in the ``Location`` header.
+
+        Example::
+
+            http patch localhost:8000/uploads/{uid} Upload-Offset:0 \\
+                "Upload-Checksum:sha1 $(openssl sha1 -binary < chunk | base64)" < chunk
+        '''
+        upload = self.get_object(uid)
+        if upload.state != 'receiving':
+            raise falcon.HTTPConflict(description='Upload is {}'.format(upload.state))
+
+        try:
+            offset = int(req.get_header('Upload-Offset', required=True))
+        except ValueError:
+            raise falcon.HTTPBadRequest(description='Upload-Offset must be an integer')
+        length = req.content_length
+        if length is None:
+            raise falcon.HTTPLengthRequired()
+        if offset < 0 or offset + length > upload.length:
+            raise falcon.HTTPBadRequest(
+                description='Chunk is outside the upload of {} bytes'.format(upload.length)
+            )
+
+        digest, expected = _checksum(req)
+        try:
+            written = self._data_store.write_chunk(
+                str(upload.id), offset, req.bounded_stream, length, digest, expected
+            )
+        except ChecksumMismatch as error:
+            resp.status = HTTP_CHECKSUM_MISMATCH
+            resp.body = str(error)
+            return
+
+        if written:
+            self._document.objects(id=upload.id).update_one(
+                push__received=ByteRange(start=offset, end=offset + written),
+                set__date_updated=datetime.datetime.now()
+            )
+            upload.reload()
+        resp.set_header('Upload-Offset', str(upload.offset))
+        if written < length:
+            raise falcon.HTTPBadRequest(description='Chunk ended early')
+
+        # Only the request which claims the completed upload adds it to the model
+        if upload.offset == upload.length and self._document.objects(
+                id=upload.id, state='receiving').update_one(
+                    set__state='finalizing', set__date_updated=datetime.datetime.now()):
+            self._finalize(upload)
+            resp.location = '/models/{}'.format(upload.model.name)
+            resp.status = falcon.HTTP_OK
+            resp.body = _representation(upload)
+        else:
+            resp.status = falcon.HTTP_NO_CONTENT
+
+    def _finalize(self, upload):
+        try:
+            run_blocking(self._executor, 'extract', self._add_to_model, upload)
+        except QueueFull:
+            # The upload is claimed again when the last chunk is resent
+            self._document.objects(id=upload.id).update_one(set__state='receiving')
+            raise
+
+    def _add_to_model(self, upload):
+        uid = str(upload.id)
+        try:
+            with self._data_store.open_upload(uid) as stream:
+                if upload.model:
+                    model = upload.model
+                    fid = save_model_data(
+                        self._data_store, model, stream, upload.content_type,
+                        upload.filename, upload.length
+                    )
+                else:
+                    folder, name = self._data_store.save_zip(stream, upload.content_type)
+                    model = self._models(name=name, folder=folder).save()
+                    fid = None
+        except BadZipStream as error:
+            upload.update(set__state='failed', set__error=str(error))
+            raise falcon.HTTPBadRequest(description=str(error))
+        except Exception as error:
+            # The data is removed below, so the upload can't be finalized again
+            upload.update(
+                set__state='failed',
+                set__error=getattr(error, 'description', None) or str(error) or
+                error.__class__.__name__
+            )
+            raise
+        finally:
+            self._data_store.remove_upload(uid)
+
+        upload.update(set__state='complete', set__model=model, set__fid=fid or model.folder)
+        upload.reload()
+
+    def on_delete(self, req, resp, uid):
+        '''Cancel an upload and remove the data received so far
+        '''
+        upload = self.get_object(uid)
+        if upload.state == 'finalizing':
+            raise falcon.HTTPConflict(description='Upload is being added to the model')
+        self._data_store.remove_upload(str(upload.id))
+        upload.delete()
+        resp.status = falcon.HTTP_NO_CONTENT
@@ -1,57 +1,300 @@
 '''User data storage access methods
 '''
+import errno
+import hashlib
 import uuid
 import mimetypes
 import os
 import shutil
 import io
-from qflow.utils import extract_model, ensure_dir
+import tempfile
+import threading
+from qflow.utils import ensure_dir
 from tucluster import fmdb
+from tucluster.resources.archive import BadZipStream, extract_stream
+from tucluster.resources.jobs import QueueFull
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Text files of Tuflow models and results which are not known to ``mimetypes``
+TEXT_EXTENSIONS = frozenset([
+    '.asc', '.tlf', '.tcf', '.tgc', '.tbc', '.ecf', '.tmf', '.tef', '.trd', '.toc', '.log'
+])
+
+class ChecksumMismatch(ValueError):
+    '''Raised when a chunk of an upload does not have the expected digest
+    '''
+
+
+# ioctl request which makes a file share the blocks of another (a reflink).
+# Supported by e.g. btrfs and xfs.
+_FICLONE = 0x40049409
+
+
+def _allocate(fd, length):
+    try:
+        os.posix_fallocate(fd, 0, length)
+        return
+    except AttributeError:
+        pass
+    except OSError as error:
+        # Out of space errors are raised
+        if error.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+            raise
+    # Preallocation is not supported by the platform or file system. The
+    # file is still extended, but sparsely.
+    os.ftruncate(fd, length)
+
+
+def _clone(source, path):
+    '''Copy a file, as a reflink where the file system supports it
+    '''
+    with open(source, 'rb') as fin, open(path, 'wb') as fout:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+                return
+            except OSError:
+                pass
+        shutil.copyfileobj(fin, fout)
 
 
 class DataStore(object):
     '''Data storage and retrieval for all user uploaded files.
     An instance of ``DataStore`` is the interface to the location of all modelling
     inputs and results.
+
+    If ``content_addressed`` is true, each file is stored once in an object store, named
+    by the SHA-256 digest of its' contents, and hard linked into the model folders. A file
+    uploaded to many models then only uses its' space once. The stored files are read only,
+    since a change to one would change every model linking to it.
+    Where hard links are not possible, the file is copied (as a reflink if the
+    file system supports it).
     '''
-    _CHUNK_SIZE_BYTES = 4096
+    # Largest single read or write. Reads start at ``_MIN_CHUNK_SIZE_BYTES`` and double
+    # while the stream keeps filling them, so small files need not use a large buffer
+    # and large files are copied with few calls.
+    _CHUNK_SIZE_BYTES = 1024 * 1024
+    _MIN_CHUNK_SIZE_BYTES = 64 * 1024
+    # Files at least this large are allocated up front when their length is known
+    _PREALLOCATE_MIN_BYTES = 1024 * 1024
+    # Folder of the storage location holding incomplete chunked uploads
+    _UPLOAD_FOLDER = '.uploads'
+    # Folder of the storage location holding the content addressed objects
+    _OBJECT_FOLDER = '.objects'
+    # Folder of removed folders which are being deleted
+    _TRASH_FOLDER = '.trash'
 
-    def __init__(self, storage_path, uuidgen=uuid.uuid4, fopen=io.open):
+    def __init__(self, storage_path, uuidgen=uuid.uuid4, fopen=io.open,
+                 content_addressed=False, chunk_size=None, executor=None):
         # Dependency injection used so monkeypatching can be avoided if needed
         self._storage_path = storage_path
         self._uuidgen = uuidgen
         self._fopen = fopen
+        self._content_addressed = content_addressed
+        self._chunk_size = chunk_size or self._CHUNK_SIZE_BYTES
+        # Optional ``JobExecutor`` in which removed folders are deleted
+        self._executor = executor
+        # Each thread reuses a single buffer for all its' reads
+        self._local = threading.local()
+
+    def _buffer(self):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = self._local.buffer = memoryview(bytearray(self._chunk_size))
+        return buffer
+
+    def _copy(self, stream, write, limit=None, digest=None):
+        '''Copy data from the stream to the ``write`` callable.
+
+        Streams with ``readinto`` (e.g files) are read into the thread's buffer, so no
+        memory is allocated per chunk. The data given to ``write`` is only valid until it returns.
 
+        Args:
+            stream: File-like object from which the data is read
+            write (callable): Called with each chunk of data
+            limit (int): Maximum number of bytes to copy
+            digest: Optional ``hashlib`` object updated with the data
 
-    def _write(self, path, stream):
+        Returns:
+            int: The number of bytes copied
+        '''
+        readinto = getattr(stream, 'readinto', None)
+        buffer = self._buffer() if readinto is not None else None
+        size = min(self._MIN_CHUNK_SIZE_BYTES, self._chunk_size)
+        total = 0
+        while limit is None or total < limit:
+            wanted = size if limit is None else min(size, limit - total)
+            if buffer is not None:
+                count = readinto(buffer[:wanted])
+                chunk = buffer[:count]
+            else:
+                chunk = stream.read(wanted)
+                count = len(chunk)
+            if not count:
+                break
+            if digest is not None:
+                digest.update(chunk)
+            write(chunk)
+            total += count
+            if count == wanted and size < self._chunk_size:
+                size = min(size * 2, self._chunk_size)
+        return total
+
+    def _write_file(self, path, stream, length=None, digest=None):
         with self._fopen(path, 'wb') as fout:
-            while True:
-                chunk = stream.read(self._CHUNK_SIZE_BYTES)
-                if not chunk:
-                    break
-                fout.write(chunk)
+            preallocated = bool(length) and length >= self._PREALLOCATE_MIN_BYTES
+            if preallocated:
+                # Allocating the whole file at once avoids fragmentation and
+                # fails early if there is not enough space
+                _allocate(fout.fileno(), length)
+            written = self._copy(stream, fout.write, digest=digest)
+            if preallocated and written != length:
+                fout.truncate()
+
+    def _write(self, path, stream, length=None):
+        '''Write the stream to a file.
 
+        Args:
+            path (str): Path of the file
+            stream: File-like object from which the data is read
+            length (int): Expected size of the data, if known
+        '''
+        if self._content_addressed:
+            self._write_object(path, stream, length)
+        else:
+            self._write_file(path, stream, length)
+
+    def _object_path(self, digest):
+        return os.path.join(self._storage_path, self._OBJECT_FOLDER, digest[:2], digest[2:])
+
+    def _write_object(self, path, stream, length=None):
+        '''Hash the stream while writing it to a temporary file, then link the object
+        with that digest to ``path``, keeping the new file only if there was no such object.
+        '''
+        tmp_dir = os.path.join(self._storage_path, self._OBJECT_FOLDER, 'tmp')
+        ensure_dir(tmp_dir)
+        fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+        os.close(fd)
+        try:
+            digest = hashlib.sha256()
+            self._write_file(tmp, stream, length, digest)
+
+            obj = self._object_path(digest.hexdigest())
+            if os.path.exists(obj):
+                try:
+                    self._link(obj, path)
+                    return
+                except FileNotFoundError:
+                    # Removed by ``collect_garbage`` in the meantime
+                    pass
+            ensure_dir(os.path.dirname(obj))
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, obj)
+            self._link(obj, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _link(self, obj, path):
+        # Link to a temporary name first, so an existing file is replaced atomically
+        tmp = '{}.{}.tmp'.format(path, self._uuidgen())
+        try:
+            os.link(obj, tmp)
+        except OSError:
+            # Different file systems, too many links or not supported
+            _clone(obj, tmp)
+        os.replace(tmp, path)
+
+    def verify(self):
+        '''Check the integrity of the content addressed object store, by comparing the
+        contents of each object with the digest it is named by.
+
+        Returns:
+            list: Paths of the objects which are corrupt
+        '''
+        corrupt = []
+        for path in self._objects():
+            digest = hashlib.sha256()
+            with self._fopen(path, 'rb') as fobj:
+                self._copy(fobj, lambda chunk: None, digest=digest)
+            name = os.path.basename(os.path.dirname(path)) + os.path.basename(path)
+            if digest.hexdigest() != name:
+                corrupt.append(path)
+        return corrupt
+
+    def collect_garbage(self):
+        '''Remove stored objects which are no longer linked to from any model folder,
+        e.g after a model was removed.
 
-    def save_zip(self, stream, content_type, name=None):
-        '''Save the zip stream to disk and extract its contents
+        Returns:
+            int: The number of bytes freed
+        '''
+        freed = 0
+        for path in self._objects():
+            stat = os.stat(path)
+            if stat.st_nlink == 1:
+                os.remove(path)
+                freed += stat.st_size
+        return freed
+
+    def _objects(self):
+        root = os.path.join(self._storage_path, self._OBJECT_FOLDER)
+        if not os.path.isdir(root):
+            return
+        for prefix in sorted(os.listdir(root)):
+            folder = os.path.join(root, prefix)
+            if len(prefix) != 2 or not os.path.isdir(folder):
+                continue
+            for name in sorted(os.listdir(folder)):
+                yield os.path.join(folder, name)
+
+
+    def save_zip(self, stream, content_type, name=None, progress=None):
+        '''Extract a zip archive read from the stream into a folder of the storage location.
+
+        The archive is extracted as it is read, so it is never written to disk itself.
+
+        Args:
+            stream: File-like object from which the archive is read
+            content_type (str): Content type of the upload
+            name (str): Name of (or path to) the folder to extract to. A new
+                folder is created if not given
+            progress (callable): Optional ``progress(path, bytes_read)`` called
+                after each file is extracted
+
+        Returns:
+            tuple: The fid of the folder and its' name
+
+        Raises:
+            BadZipStream: The archive is corrupt or unsupported. A newly created
+                folder is removed.
         '''
         # Make sure the storage path exists
         ensure_dir(self._storage_path)
 
-        ext = mimetypes.guess_extension(content_type)
         if not name:
             name = str(self._uuidgen())
-        fname = '{uuid}{ext}'.format(uuid=name, ext=ext)
-        archive_path = os.path.join(self._storage_path, fname)
-
-        self._write(archive_path, stream)
-        # extract the zip file
-        directory = extract_model(archive_path, name, self._storage_path)
+        directory = os.path.join(self._storage_path, name)
+        created = not os.path.exists(directory)
+        try:
+            extract_stream(stream, directory, self._write, progress)
+        except BadZipStream:
+            if created:
+                shutil.rmtree(directory, ignore_errors=True)
+            raise
+        ensure_dir(directory)
         return fmdb.id_from_path(directory), name
 
 
-    def save(self, stream, folder, filename):
-        '''Save the file stream to disk
+    def save(self, stream, folder, filename, length=None):
+        '''Save the file stream to disk.
+
+        The ``length`` of the data should be given if it is known (e.g from the
+        ``Content-Length`` header), so that space for the file can be allocated up front.
         '''
         if os.path.isabs(folder):
             root = folder
@@ -61,10 +304,107 @@ class DataStore(object):
         ensure_dir(root)
         path = os.path.join(root, filename)
 
-        self._write(path, stream)
+        self._write(path, stream, length)
         return fmdb.id_from_path(root), fmdb.id_from_path(path)
 
 
+    def _upload_path(self, uid):
+        return os.path.join(self._storage_path, self._UPLOAD_FOLDER, uid)
+
+    def create_upload(self, uid, length):
+        '''Create the file which receives a chunked upload.
+
+        The full ``length`` is allocated up front, so chunks can be written at any
+        offset and the upload cannot run out of disk space part way through.
+        '''
+        path = self._upload_path(uid)
+        ensure_dir(os.path.dirname(path))
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            _allocate(fd, length)
+        finally:
+            os.close(fd)
+
+    def write_chunk(self, uid, offset, stream, length, digest=None, expected=None):
+        '''Write a chunk of an upload read from the stream at the given offset.
+
+        Args:
+            uid (str): ID of the upload
+            offset (int): Position of the chunk in the file
+            stream: File-like object from which the chunk is read
+            length (int): Size of the chunk
+            digest: Optional ``hashlib`` object updated with the chunk data
+            expected (bytes): The digest the chunk must have. The chunk is then received
+                into a temporary file and only written if it matches, so a corrupt chunk
+                can't overwrite data received before. Requires ``digest``.
+
+        Returns:
+            int: The number of bytes written. This is less than ``length`` if the
+                stream ended early, and 0 if it ended early and a digest was expected.
+
+        Raises:
+            ChecksumMismatch: If the digest of the chunk is not ``expected``
+        '''
+        if expected is not None:
+            with tempfile.SpooledTemporaryFile(
+                    self._chunk_size, prefix='.chunk-',
+                    dir=os.path.dirname(self._upload_path(uid))) as spool:
+                if self._copy(stream, spool.write, length, digest) < length:
+                    return 0
+                if digest.digest() != expected:
+                    raise ChecksumMismatch('Checksum of the chunk does not match')
+                spool.seek(0)
+                return self.write_chunk(uid, offset, spool, length)
+
+        fd = os.open(self._upload_path(uid), os.O_WRONLY)
+        position = offset
+
+        def write(chunk):
+            nonlocal position
+            view = memoryview(chunk)
+            while view:
+                count = os.pwrite(fd, view, position)
+                view = view[count:]
+                position += count
+
+        try:
+            return self._copy(stream, write, length, digest)
+        finally:
+            os.close(fd)
+
+    def save_upload(self, uid, stream, length=None):
+        '''Save a whole upload read from the stream, so it can be processed once the
+        request has been answered (see ``open_upload``).
+
+        Returns:
+            int: The size of the upload
+        '''
+        path = self._upload_path(uid)
+        ensure_dir(os.path.dirname(path))
+        self._write_file(path, stream, length)
+        return os.path.getsize(path)
+
+    def open_upload(self, uid):
+        '''Open the file of a chunked upload for reading
+        '''
+        return self._fopen(self._upload_path(uid), 'rb')
+
+    def upload_ids(self):
+        '''List the IDs of the uploads which have a file
+        '''
+        try:
+            names = os.listdir(os.path.join(self._storage_path, self._UPLOAD_FOLDER))
+        except FileNotFoundError:
+            return []
+        # Excluding the temporary files of chunks being checked
+        return [name for name in names if not name.startswith('.')]
+
+    def remove_upload(self, uid):
+        try:
+            os.remove(self._upload_path(uid))
+        except FileNotFoundError:
+            pass
+
     def open(self, fid):
         '''Open the file path given by its' fid and return the stream
         '''
@@ -72,18 +412,42 @@ class DataStore(object):
 
         stream = self._fopen(filepath, 'rb')
         stream_len = os.path.getsize(filepath)
-        content_type = mimetypes.guess_type(filepath)[0]
+        if os.path.splitext(filepath)[1].lower() in TEXT_EXTENSIONS:
+            content_type = 'text/plain'
+        else:
+            content_type = mimetypes.guess_type(filepath)[0]
 
         return stream, stream_len, content_type
 
+    def stat(self, fid):
+        '''Return the ``os.stat`` result for the file or folder given by its' fid
+        '''
+        return os.stat(self.validate_fid(fid))
+
+    def relpath(self, fid):
+        '''Return the path of a file relative to the storage location
+        '''
+        return os.path.relpath(self.validate_fid(fid), self._storage_path)
+
     def remove(self, fid):
-        '''Remove the file or folder by its' id
+        '''Remove the file or folder by its' id.
+
+        With an ``executor``, a folder is moved out of the way (to the ``.trash`` folder)
+        and deleted in the background, so removing a large folder does not block.
         '''
         path = self.validate_fid(fid)
         if os.path.isfile(path):
             os.remove(path)
-        else:
+        elif self._executor is None:
             shutil.rmtree(path)
+        else:
+            trash = os.path.join(self._storage_path, self._TRASH_FOLDER, str(self._uuidgen()))
+            ensure_dir(os.path.dirname(trash))
+            os.rename(path, trash)
+            try:
+                self._executor.submit('remove', shutil.rmtree, trash, ignore_errors=True)
+            except QueueFull:
+                shutil.rmtree(trash, ignore_errors=True)
 
 
     def validate_fid(self, fid):
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+'''Keep the state of model runs in step with celery task events.
+
+Run this in a single process alongside the API servers::
+
+    python -m tucluster.sync
+
+rather than enabling ``SYNC_TASK_STATE``, which listens for events in every API process.
+'''
+import time
+from qflow.celery import app
+from tucluster.conf import settings
+from tucluster.fmdb import connect, ModelRun
+from tucluster.resources.events import TaskEventBroker
+from tucluster.resources.runs import RunStateSync
+
+
+def main():
+    connect(**settings['MONGODB'])
+    sync = RunStateSync(ModelRun)
+    TaskEventBroker(app).add_listener(sync)
+    # Catch up with the tasks which finished while nothing was listening
+    sync.reconcile()
+    while True:
+        # Events are retried as they arrive, so this only matters when events stop
+        time.sleep(sync.RETRY_INTERVAL)
+        sync.retry_pending()
+
+
+if __name__ == '__main__':
+    main()